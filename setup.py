@@ -1,4 +1,5 @@
 from builtins import object
+import os
 import sys
 import setuptools
 
@@ -67,13 +68,60 @@ def cpp_flag(compiler):
                            'is needed!')
 
 
+def native_arch_requested():
+    """Return True if the user asked for a build tuned to the current CPU.
+
+    Binaries built with `-march=native` will crash with an illegal
+    instruction on older CPUs, so this is opt-in through the environment
+    variable `STRAINGE_NATIVE_ARCH`, and should not be used for wheels
+    that are distributed.
+    """
+    return os.environ.get('STRAINGE_NATIVE_ARCH', '').lower() in (
+        '1', 'true', 'yes')
+
+
+def pgo_flags():
+    """Return the compiler flags for profile-guided optimization of the
+    k-mer extension, which is opt-in through the environment variable
+    `STRAINGE_PGO`:
+
+    - `generate`: build an instrumented extension, which records a profile
+      in `STRAINGE_PGO_DIR` (default: build/pgo) when it's used. Run a
+      typical workload (e.g. `straingst kmerize`) afterwards.
+    - `use`: rebuild the extension optimized with the recorded profile.
+
+    Both builds should use the same build directory, e.g. by running
+    `python setup.py build_ext --inplace` twice.
+    """
+    mode = os.environ.get('STRAINGE_PGO', '').lower()
+    profile_dir = os.path.abspath(
+        os.environ.get('STRAINGE_PGO_DIR', os.path.join('build', 'pgo')))
+
+    if mode == 'generate':
+        # Counters are updated from multiple OpenMP threads
+        return ['-fprofile-generate=' + profile_dir,
+                '-fprofile-update=atomic']
+    elif mode == 'use':
+        return ['-fprofile-use=' + profile_dir, '-fprofile-correction']
+
+    return []
+
+
 class BuildExt(build_ext):
     """A custom build extension for adding compiler-specific options."""
     c_opts = {
-        'msvc': ['/EHsc'],
+        'msvc': ['/EHsc', '/O2'],
         'unix': [],
     }
 
+    # Optimization flags, only added when supported by the compiler
+    unix_opt_flags = ['-O3', '-funroll-loops']
+    unix_native_flags = ['-march=native', '-mtune=native']
+
+    # Multi-threaded sorting and merging of k-mers, only added when
+    # supported by the compiler (e.g. not by Apple's clang)
+    unix_openmp_flags = ['-fopenmp']
+
     if sys.platform == 'darwin':
         c_opts['unix'] += ['-stdlib=libc++', '-mmacosx-version-min=10.9']
 
@@ -86,9 +134,20 @@ class BuildExt(build_ext):
             opts.append(cpp_flag(self.compiler))
             if has_flag(self.compiler, '-fvisibility=hidden'):
                 opts.append('-fvisibility=hidden')
+
+            flags = self.unix_opt_flags + self.unix_openmp_flags
+            if native_arch_requested():
+                flags += self.unix_native_flags
+
+            flags += pgo_flags()
+
+            opts.extend(f for f in flags if has_flag(self.compiler, f))
         elif ct == 'msvc':
             opts.append('/DVERSION_INFO=\\"%s\\"' %
                         self.distribution.get_version())
+            if native_arch_requested():
+                opts.append('/arch:AVX2')
+            opts.append('/openmp')
         for ext in self.extensions:
             ext.extra_compile_args = opts
             ext.extra_link_args = opts
@@ -3,18 +3,47 @@
  */
 
 #include <vector>
-#include <set>
+#include <array>
+#include <algorithm>
+#include <queue>
+#include <functional>
+#include <cstring>
 #include "kmerizer.h"
 
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
 using std::vector;
-using std::set;
 using std::size_t;
 
 namespace strainge {
 
-    static vector<kmer_t> kmerize_internal(int k, const std::string& sequence) {
-        vector<kmer_t> kmers;
+    /**
+     * Lookup table mapping each character to its 2-bit base encoding, or -1
+     * for non-ACGT characters. Handles both upper and lower case.
+     */
+    static std::array<int8_t, 256> build_base_encoding() {
+        std::array<int8_t, 256> encoding;
+        encoding.fill(-1);
+
+        const char bases[] = "ACGT";
+        for(int i = 0; i < 4; ++i) {
+            encoding[static_cast<unsigned char>(bases[i])] = i;
+            encoding[static_cast<unsigned char>(tolower(bases[i]))] = i;
+        }
 
+        return encoding;
+    }
+
+    static const std::array<int8_t, 256> BASE_ENCODING = build_base_encoding();
+
+    /**
+     * Walk over all k-mers in the given sequence and call `emit` with each
+     * canonical k-mer. k-mers containing a non-ACGT base are skipped.
+     */
+    template<typename F>
+    static void for_each_kmer(int k, const std::string& sequence, F&& emit) {
         int shift = 2 * (k - 1);
         kmer_t mask = (k < 32) ? ((kmer_t) 1 << (2 * k)) - 1 : -1;
 
@@ -23,35 +52,27 @@ namespace strainge {
         kmer_t reverse = 0;
 
         for(char b : sequence) {
-            b = toupper(b);
-
-            Base value;
-            switch(b) {
-                case 'A':
-                    value = Base::A;
-                    break;
-                case 'C':
-                    value = Base::C;
-                    break;
-                case 'G':
-                    value = Base::G;
-                    break;
-                case 'T':
-                    value = Base::T;
-                    break;
-                default:
-                    fw = reverse = n = 0;
-                    continue;
-            }
-
-            fw = ((fw << 2) & mask) | static_cast<uint64_t>(value);
-            reverse = ((reverse >> 2) & mask) | (static_cast<uint64_t>(rc(value)) << shift);
+            int8_t value = BASE_ENCODING[static_cast<unsigned char>(b)];
+            if(value < 0) {
+                fw = reverse = n = 0;
+                continue;
+            }
+
+            Base base = static_cast<Base>(value);
+            fw = ((fw << 2) & mask) | static_cast<uint64_t>(base);
+            reverse = ((reverse >> 2) & mask) | (static_cast<uint64_t>(rc(base)) << shift);
 
             if(++n >= k) {
-                auto kmer = fw < reverse ? fw : reverse;
-                kmers.push_back(kmer);
+                emit(fw < reverse ? fw : reverse);
             }
         }
+    }
+
+    static vector<kmer_t> kmerize_internal(int k, const std::string& sequence) {
+        vector<kmer_t> kmers;
+        for_each_kmer(k, sequence, [&kmers](kmer_t kmer) {
+            kmers.push_back(kmer);
+        });
 
         return kmers;
     }
@@ -59,7 +80,12 @@ namespace strainge {
     kmerset_t kmerize(int k, const std::string& sequence) {
         check_k(k);
 
-        auto kmers = kmerize_internal(k, sequence);
+        vector<kmer_t> kmers;
+        {
+            // Pure C++ work, other Python threads can continue meanwhile
+            py::gil_scoped_release release;
+            kmers = kmerize_internal(k, sequence);
+        }
 
         // Create NumPy array from found k-mers (copies data)
         kmerset_t kmerset = kmerset_t(py::buffer_info(
@@ -89,171 +115,855 @@ namespace strainge {
             kmerset_t& out_array, unsigned int offset) {
         check_k(k);
 
-        auto kmers = kmerize_internal(k, sequence);
+        // Write k-mers directly into the NumPy array, without an
+        // intermediate buffer.
+        size_t capacity = out_array.shape(0);
+        auto proxy = out_array.mutable_unchecked<1>();
+        size_t pos = offset;
+        bool overflow = false;
+
+        {
+            py::gil_scoped_release release;
+            for_each_kmer(k, sequence, [&](kmer_t kmer) {
+                if(pos < capacity) {
+                    proxy(pos) = kmer;
+                } else {
+                    overflow = true;
+                }
+                ++pos;
+            });
+        }
 
-        if(kmers.size() + offset > out_array.shape(0)) {
+        if(overflow) {
             throw KmerizeError("Number of kmers exceeds space available in NumPy array");
         }
 
+        return pos - offset;
+    }
+
+    /**
+     * MurmurHash3 64-bit finalizer, mixes all bits of the k-mer.
+     */
+    static inline uint64_t mix64(uint64_t x) {
+        x ^= x >> 33;
+        x *= 0xff51afd7ed558ccdULL;
+        x ^= x >> 33;
+        x *= 0xc4ceb9fe1a85ec53ULL;
+        x ^= x >> 33;
+
+        return x;
+    }
+
+    BloomFilter::BloomFilter(size_t num_bits, int num_hashes) :
+            bits((num_bits + 63) / 64, 0), hashes(num_hashes) {
+        if(num_bits == 0 || num_hashes < 1) {
+            throw KmerizeError("Bloom filter needs at least one bit and one hash function");
+        }
+    }
+
+    bool BloomFilter::add(kmer_t kmer) {
+        // Double hashing: the i-th hash is h1 + i * h2
+        uint64_t h1 = mix64(kmer);
+        uint64_t h2 = mix64(kmer ^ 0x9e3779b97f4a7c15ULL) | 1;
+        size_t size = bits.size() * 64;
+
+        bool present = true;
+        for(int i = 0; i < hashes; ++i) {
+            size_t bit = (h1 + i * h2) % size;
+            uint64_t mask = (uint64_t) 1 << (bit & 63);
+
+            if(!(bits[bit >> 6] & mask)) {
+                present = false;
+                bits[bit >> 6] |= mask;
+            }
+        }
+
+        return present;
+    }
+
+    bool BloomFilter::contains(kmer_t kmer) const {
+        uint64_t h1 = mix64(kmer);
+        uint64_t h2 = mix64(kmer ^ 0x9e3779b97f4a7c15ULL) | 1;
+        size_t size = bits.size() * 64;
+
+        for(int i = 0; i < hashes; ++i) {
+            size_t bit = (h1 + i * h2) % size;
+            if(!(bits[bit >> 6] & ((uint64_t) 1 << (bit & 63)))) {
+                return false;
+            }
+        }
+
+        return true;
+    }
+
+    size_t kmerize_into_array_prefiltered(int k, const std::string& sequence,
+            kmerset_t& out_array, unsigned int offset, BloomFilter& bloom) {
+        check_k(k);
+
+        size_t capacity = out_array.shape(0);
         auto proxy = out_array.mutable_unchecked<1>();
+        size_t pos = offset;
+        bool overflow = false;
+
+        {
+            py::gil_scoped_release release;
+            for_each_kmer(k, sequence, [&](kmer_t kmer) {
+                if(!bloom.add(kmer)) {
+                    // First time we see this k-mer
+                    return;
+                }
 
-        for(kmer_t kmer : kmers) {
-            proxy(offset) = kmer;
-            ++offset;
+                if(pos < capacity) {
+                    proxy(pos) = kmer;
+                } else {
+                    overflow = true;
+                }
+                ++pos;
+            });
         }
 
-        return kmers.size();
+        if(overflow) {
+            throw KmerizeError("Number of kmers exceeds space available in NumPy array");
+        }
+
+        return pos - offset;
     }
 
-    size_t count_common(const kmerset_t& kmers1,
-            const kmerset_t& kmers2) {
+    // Use galloping search when one set is this many times larger than the
+    // other
+    const size_t GALLOP_RATIO = 32;
+
+    /**
+     * Find the common elements of two sorted arrays, where the first array
+     * is much smaller than the second. For each element of the small array,
+     * find its position in the large array by exponential search followed
+     * by binary search, starting from the previous position. Calls
+     * `f(small_pos, large_pos)` for each common element.
+     */
+    template<typename F>
+    static void gallop_common(const kmer_t* small, size_t small_size,
+            const kmer_t* large, size_t large_size, F&& f) {
+        size_t pos = 0;
+
+        for(size_t i = 0; i < small_size && pos < large_size; ++i) {
+            kmer_t kmer = small[i];
+
+            // All elements before `pos` are smaller than `kmer`. Find an
+            // upper bound by doubling the step size.
+            size_t step = 1;
+            size_t bound = pos;
+            while(bound < large_size && large[bound] < kmer) {
+                pos = bound + 1;
+                bound = std::min(pos + step, large_size);
+                step *= 2;
+            }
+
+            size_t search_end = std::min(bound + 1, large_size);
+            pos = std::lower_bound(large + pos, large + search_end, kmer) - large;
+            if(pos < large_size && large[pos] == kmer) {
+                f(i, pos);
+                ++pos;
+            }
+        }
+    }
+
+    /**
+     * Count common elements of two sorted arrays, where the first array is
+     * much smaller than the second.
+     */
+    static size_t count_common_gallop(const kmer_t* small, size_t small_size,
+            const kmer_t* large, size_t large_size) {
         size_t common = 0;
-        size_t size1 = kmers1.shape(0);
-        size_t size2 = kmers2.shape(0);
+        gallop_common(small, small_size, large, large_size,
+                      [&common](size_t, size_t) { ++common; });
 
-        auto proxy1 = kmers1.unchecked<1>();
-        auto proxy2 = kmers2.unchecked<1>();
+        return common;
+    }
+
+    /**
+     * Call `f(i1, i2)` for each pair of positions with
+     * kmers1[i1] == kmers2[i2], in increasing order. Switches to galloping
+     * search if the arrays differ a lot in size.
+     */
+    template<typename F>
+    static void for_each_common(const kmer_t* kmers1, size_t size1,
+            const kmer_t* kmers2, size_t size2, F&& f) {
+        if(size1 * GALLOP_RATIO < size2) {
+            gallop_common(kmers1, size1, kmers2, size2, f);
+            return;
+        } else if(size2 * GALLOP_RATIO < size1) {
+            gallop_common(kmers2, size2, kmers1, size1,
+                          [&f](size_t i2, size_t i1) { f(i1, i2); });
+            return;
+        }
 
-        // Arrays should be sorted, walk through them in parallel
         for(size_t i1 = 0, i2 = 0; i1 < size1 && i2 < size2;) {
-            kmer_t kmer1 = proxy1(i1);
-            kmer_t kmer2 = proxy2(i2);
+            kmer_t kmer1 = kmers1[i1];
+            kmer_t kmer2 = kmers2[i2];
 
             if(kmer1 == kmer2) {
-                // In both sets
-                ++common;
-
+                f(i1, i2);
                 ++i1;
                 ++i2;
             } else if(kmer1 < kmer2) {
-                // First set lags
                 ++i1;
             } else {
                 ++i2;
             }
         }
+    }
+
+    /**
+     * Count common elements of two sorted arrays. Branchless merge: both
+     * indices advance by the result of a comparison, which avoids branch
+     * mispredictions on (random) k-mer data. Switches to galloping search
+     * if the arrays differ a lot in size.
+     */
+    static size_t count_common_internal(const kmer_t* kmers1, size_t size1,
+            const kmer_t* kmers2, size_t size2) {
+        if(size1 * GALLOP_RATIO < size2) {
+            return count_common_gallop(kmers1, size1, kmers2, size2);
+        } else if(size2 * GALLOP_RATIO < size1) {
+            return count_common_gallop(kmers2, size2, kmers1, size1);
+        }
+
+        size_t common = 0;
+        size_t i1 = 0;
+        size_t i2 = 0;
+
+        while(i1 < size1 && i2 < size2) {
+            kmer_t kmer1 = kmers1[i1];
+            kmer_t kmer2 = kmers2[i2];
+
+            common += kmer1 == kmer2;
+            i1 += kmer1 <= kmer2;
+            i2 += kmer2 <= kmer1;
+        }
 
         return common;
     }
 
-    std::tuple<kmerset_t, kmercounts_t> merge_counts(
-            const kmerset_t& kmers1,
-            const kmercounts_t& counts1,
-            const kmerset_t& kmers2,
-            const kmercounts_t& counts2) {
-        size_t size1 = kmers1.shape(0);
-        size_t size2 = kmers2.shape(0);
-        size_t new_size = size1 + size2 - count_common(kmers1, kmers2);
+    /**
+     * Compute a similarity score from the number of common k-mers and the
+     * sizes of both sets.
+     */
+    static double score_from_counts(size_t common, size_t size1, size_t size2,
+            SimilarityMode mode) {
+        double c = static_cast<double>(common);
+
+        switch(mode) {
+            case SimilarityMode::JACCARD:
+                return c / static_cast<double>(size1 + size2 - common);
+            case SimilarityMode::MINSIZE:
+                return c / static_cast<double>(std::min(size1, size2));
+            case SimilarityMode::MEANSIZE:
+                return c / (static_cast<double>(size1 + size2) / 2);
+            case SimilarityMode::MAXSIZE:
+                return c / static_cast<double>(std::max(size1, size2));
+            case SimilarityMode::REFERENCE:
+                return c / static_cast<double>(size2);
+            case SimilarityMode::SUBSET:
+                return c / static_cast<double>(size1);
+        }
 
-        kmerset_t new_set(new_size);
-        kmercounts_t new_counts(new_size);
+        throw KmerizeError("Invalid similarity mode");
+    }
 
-        // Direct access proxies
-        auto proxy1 = kmers1.unchecked<1>();
-        auto proxy2 = kmers2.unchecked<1>();
-        auto proxyc1 = counts1.unchecked<1>();
-        auto proxyc2 = counts2.unchecked<1>();
+    double similarity(const kmerset_t& kmers1, const kmerset_t& kmers2,
+            SimilarityMode mode) {
+        size_t common = count_common(kmers1, kmers2);
+        return score_from_counts(common, kmers1.shape(0), kmers2.shape(0),
+                mode);
+    }
 
-        auto proxy_new = new_set.mutable_unchecked<1>();
-        auto proxy_counts = new_counts.mutable_unchecked<1>();
+    py::array_t<double> pairwise_similarity(
+            const std::vector<contiguous_kmerset_t>& kmersets,
+            SimilarityMode mode) {
+        size_t num = kmersets.size();
+        py::array_t<double> matrix({num, num});
+        auto proxy = matrix.mutable_unchecked<2>();
+
+        vector<const kmer_t*> data(num);
+        vector<size_t> sizes(num);
+        for(size_t i = 0; i < num; ++i) {
+            data[i] = kmersets[i].data();
+            sizes[i] = kmersets[i].shape(0);
+        }
 
-        size_t kcount = 0;
-        size_t i1, i2;
-        for(i1 = 0, i2 = 0; i1 < size1 && i2 < size2;) {
-            kmer_t kmer1 = proxy1(i1);
-            kmer_t kmer2 = proxy2(i2);
+        bool symmetric = mode != SimilarityMode::REFERENCE
+            && mode != SimilarityMode::SUBSET;
 
-            if(kmer1 == kmer2) {
-                // In both sets
-                proxy_new(kcount) = kmer1;
-                proxy_counts(kcount) = proxyc1(i1) + proxyc2(i2);
-                ++i1;
-                ++i2;
-            } else if (kmer1 < kmer2) {
-                // Only in set 1
-                proxy_new(kcount) = kmer1;
-                proxy_counts(kcount) = proxyc1(i1);
-                ++i1;
-            } else {
-                proxy_new(kcount) = kmer2;
-                proxy_counts(kcount) = proxyc2(i2);
-                ++i2;
+        {
+            py::gil_scoped_release release;
+            for(size_t i = 0; i < num; ++i) {
+                proxy(i, i) = score_from_counts(sizes[i], sizes[i], sizes[i],
+                        mode);
+
+                for(size_t j = i + 1; j < num; ++j) {
+                    size_t common = count_common_internal(data[i], sizes[i],
+                            data[j], sizes[j]);
+
+                    proxy(i, j) = score_from_counts(common, sizes[i],
+                            sizes[j], mode);
+                    proxy(j, i) = symmetric ? proxy(i, j) :
+                        score_from_counts(common, sizes[j], sizes[i], mode);
+                }
             }
-            ++kcount;
         }
 
-        // Check for leftovers
-        while(i1 < size1) {
-            proxy_new(kcount) = proxy1(i1);
-            proxy_counts(kcount) = proxyc1(i1);
-            ++kcount;
-            ++i1;
+        return matrix;
+    }
+
+    size_t count_common(const kmerset_t& kmers1,
+            const kmerset_t& kmers2) {
+        // Only copies if the given arrays are not contiguous
+        contiguous_kmerset_t contiguous1 = kmers1;
+        contiguous_kmerset_t contiguous2 = kmers2;
+
+        size_t size1 = contiguous1.shape(0);
+        size_t size2 = contiguous2.shape(0);
+        const kmer_t* data1 = contiguous1.data();
+        const kmer_t* data2 = contiguous2.data();
+
+        // Pure C++ work, allows comparing k-mer sets from multiple threads
+        py::gil_scoped_release release;
+
+        // Arrays should be sorted, walk through them in parallel
+        return count_common_internal(data1, size1, data2, size2);
+    }
+
+    std::tuple<size_t, size_t> intersect_sorted_u64(const kmerset_t& kmers1,
+            const kmerset_t& kmers2) {
+        // Only copies if the given arrays are not contiguous
+        contiguous_kmerset_t contiguous1 = kmers1;
+        contiguous_kmerset_t contiguous2 = kmers2;
+
+        size_t size1 = contiguous1.shape(0);
+        size_t size2 = contiguous2.shape(0);
+        const kmer_t* data1 = contiguous1.data();
+        const kmer_t* data2 = contiguous2.data();
+
+        size_t common;
+        {
+            py::gil_scoped_release release;
+            common = count_common_internal(data1, size1, data2, size2);
         }
-        while(i2 < size2) {
-            proxy_new(kcount) = proxy2(i2);
-            proxy_counts(kcount) = proxyc2(i2);
-            ++kcount;
-            ++i2;
+
+        return std::make_tuple(common, size1 + size2 - common);
+    }
+
+    /**
+     * Convert a (summed) count to count_t, saturating at MAX_COUNT.
+     */
+    static inline count_t saturate_count(uint64_t count) {
+        return static_cast<count_t>(std::min<uint64_t>(count, MAX_COUNT));
+    }
+
+    std::tuple<kmerset_t, kmercounts_t> count_sorted(const kmerset_t& kmers) {
+        // Only copies if the given array is not contiguous
+        contiguous_kmerset_t contiguous = kmers;
+        const kmer_t* data = contiguous.data();
+        size_t size = contiguous.shape(0);
+
+        size_t num_distinct = 0;
+        {
+            py::gil_scoped_release release;
+            for(size_t i = 0; i < size; ++i) {
+                num_distinct += (i == 0 || data[i] != data[i-1]);
+            }
+        }
+
+        kmerset_t distinct(num_distinct);
+        kmercounts_t counts(num_distinct);
+        kmer_t* distinct_data = distinct.mutable_data();
+        count_t* counts_data = counts.mutable_data();
+
+        {
+            py::gil_scoped_release release;
+
+            size_t pos = 0;
+            for(size_t i = 0; i < size; ++pos) {
+                size_t j = i + 1;
+                while(j < size && data[j] == data[i]) {
+                    ++j;
+                }
+
+                distinct_data[pos] = data[i];
+                counts_data[pos] = saturate_count(j - i);
+                i = j;
+            }
         }
 
-        return std::make_tuple(new_set, new_counts);
+        return std::make_tuple(distinct, counts);
     }
 
-    std::tuple<vector<kmer_t>, py::array_t<uint64_t>> build_kmer_count_matrix(
-            const std::vector<kmers_with_counts_t>& kmersets) {
-        // Sorted set, because we want our output matrix to be sorted too.
-        set<kmer_t> all_unique_kmers;
+    /**
+     * Number of threads to use for a parallel operation: the given number, or
+     * the OpenMP default (OMP_NUM_THREADS) when zero or negative. Always one
+     * if the extension is built without OpenMP.
+     */
+    static int resolve_num_threads(int num_threads) {
+#ifdef _OPENMP
+        return num_threads > 0 ? num_threads : omp_get_max_threads();
+#else
+        (void) num_threads;
+        return 1;
+#endif
+    }
 
-        for(auto& elem : kmersets) {
-            const kmerset_t& kmers = std::get<0>(elem);
+    /**
+     * Sorted run of distinct k-mers with their counts.
+     */
+    struct CountedRun {
+        const kmer_t* kmers;
+        const count_t* counts;
+        size_t size;
+    };
+
+    /**
+     * Maximum number of runs merged by scanning all run heads for the
+     * smallest k-mer; more runs are merged with a min-heap.
+     */
+    const size_t MAX_SCAN_MERGE_RUNS = 16;
+
+    /**
+     * Merge sorted runs of distinct k-mers, summing the counts of k-mers
+     * present in multiple runs (saturating at MAX_COUNT). Calls
+     * `emit(kmer, count)` for each distinct k-mer in sorted order.
+     */
+    template<typename Emit>
+    static void merge_counted_runs(const vector<CountedRun>& runs, Emit emit) {
+        size_t num_runs = runs.size();
+
+        if(num_runs <= MAX_SCAN_MERGE_RUNS) {
+            // Remaining part of each non-empty run, exhausted runs are
+            // removed from the list.
+            vector<CountedRun> active;
+            for(const CountedRun& run : runs) {
+                if(run.size > 0) {
+                    active.push_back(run);
+                }
+            }
+
+            while(!active.empty()) {
+                kmer_t smallest = active[0].kmers[0];
+                for(size_t r = 1; r < active.size(); ++r) {
+                    smallest = std::min(smallest, active[r].kmers[0]);
+                }
+
+                uint64_t count = 0;
+                for(size_t r = 0; r < active.size();) {
+                    CountedRun& run = active[r];
+                    if(run.kmers[0] == smallest) {
+                        count += run.counts[0];
+                        ++run.kmers;
+                        ++run.counts;
+
+                        if(--run.size == 0) {
+                            active[r] = active.back();
+                            active.pop_back();
+                            continue;
+                        }
+                    }
+
+                    ++r;
+                }
+
+                emit(smallest, saturate_count(count));
+            }
+
+            return;
+        }
+
+        typedef std::pair<kmer_t, size_t> head_t;
+        std::priority_queue<head_t, vector<head_t>, std::greater<head_t>> heap;
+        vector<size_t> positions(num_runs, 0);
 
-            auto proxy = kmers.unchecked<1>();
-            for(int i = 0; i < kmers.size(); ++i) {
-                all_unique_kmers.insert(proxy(i));
+        for(size_t r = 0; r < num_runs; ++r) {
+            if(runs[r].size > 0) {
+                heap.emplace(runs[r].kmers[0], r);
             }
         }
 
-        py::array_t<uint64_t> kmer_matrix({all_unique_kmers.size(), kmersets.size()});
+        while(!heap.empty()) {
+            kmer_t kmer = heap.top().first;
+            uint64_t count = 0;
 
-        // Keep track where we are for each individual kmerset
-        vector<size_t> positions;
-        for(size_t i = 0; i < kmersets.size(); ++i) {
-            positions.push_back(0);
+            // Runs contain distinct k-mers, so all equal heads are from
+            // different runs
+            while(!heap.empty() && heap.top().first == kmer) {
+                size_t r = heap.top().second;
+                heap.pop();
+
+                count += runs[r].counts[positions[r]];
+                if(++positions[r] < runs[r].size) {
+                    heap.emplace(runs[r].kmers[positions[r]], r);
+                }
+            }
+
+            emit(kmer, saturate_count(count));
         }
+    }
+
+    std::tuple<kmerset_t, kmercounts_t> count_sorted_chunks(
+            contiguous_kmerset_t& kmers, size_t chunk_size, int num_threads) {
+        kmer_t* data = kmers.mutable_data();
+        size_t size = kmers.shape(0);
 
-        // Loop over all k-mers and and see which of the kmer sets contain this
-        // k-mer. Add the corresponding counts to the matrix
-        auto proxy = kmer_matrix.mutable_unchecked<2>();
-        int i = 0;
-        for(auto kmer : all_unique_kmers) {
-            int j = 0;
-            for(auto& elem : kmersets) {
-                const kmerset_t& kmers = std::get<0>(elem);
-                const kmercounts_t& counts = std::get<1>(elem);
+        if(chunk_size == 0) {
+            throw KmerizeError("Chunk size should be larger than zero.");
+        }
 
-                auto set_proxy = kmers.unchecked<1>();
-                auto counts_proxy = counts.unchecked<1>();
-                size_t set_pos = positions[j];
+        int threads = resolve_num_threads(num_threads);
+        size_t num_chunks = std::max<size_t>(1,
+                (size + chunk_size - 1) / chunk_size);
+
+        // Run-length encode each chunk. The distinct k-mers are compacted at
+        // the start of the chunk itself.
+        vector<vector<count_t>> chunk_counts(num_chunks);
+        vector<CountedRun> runs(num_chunks);
+
+        // The merge is split in ranges of k-mer values, so each range can be
+        // merged independently. Range r contains the k-mers in
+        // [splitters[r-1], splitters[r]).
+        vector<kmer_t> splitters;
+        vector<vector<CountedRun>> range_runs;
+        vector<size_t> range_offsets;
+
+        {
+            py::gil_scoped_release release;
+
+#pragma omp parallel for num_threads(threads) schedule(dynamic, 1)
+            for(long c = 0; c < static_cast<long>(num_chunks); ++c) {
+                size_t start = std::min(size, c * chunk_size);
+                size_t end = std::min(size, start + chunk_size);
+                kmer_t* chunk = data + start;
+                size_t chunk_len = end - start;
+
+                vector<count_t>& counts = chunk_counts[c];
+                size_t pos = 0;
+                for(size_t i = 0; i < chunk_len; ++pos) {
+                    size_t j = i + 1;
+                    while(j < chunk_len && chunk[j] == chunk[i]) {
+                        ++j;
+                    }
+
+                    chunk[pos] = chunk[i];
+                    counts.push_back(saturate_count(j - i));
+                    i = j;
+                }
+
+                runs[c] = CountedRun{chunk, counts.data(), pos};
+            }
+
+            // Splitters are evenly spaced k-mers from the largest run
+            const CountedRun& largest = *std::max_element(runs.begin(),
+                    runs.end(), [](const CountedRun& a, const CountedRun& b) {
+                        return a.size < b.size;
+                    });
+            size_t num_ranges = threads;
+            for(size_t r = 1; r < num_ranges && largest.size > 0; ++r) {
+                kmer_t splitter = largest.kmers[r * largest.size / num_ranges];
+                if(splitters.empty() || splitter > splitters.back()) {
+                    splitters.push_back(splitter);
+                }
+            }
+
+            num_ranges = splitters.size() + 1;
+            range_runs.assign(num_ranges, vector<CountedRun>());
+            for(const CountedRun& run : runs) {
+                size_t prev = 0;
+                for(size_t r = 0; r < num_ranges; ++r) {
+                    size_t next = run.size;
+                    if(r < splitters.size()) {
+                        next = std::lower_bound(run.kmers, run.kmers + run.size,
+                                splitters[r]) - run.kmers;
+                    }
+
+                    range_runs[r].push_back(CountedRun{run.kmers + prev,
+                            run.counts + prev, next - prev});
+                    prev = next;
+                }
+            }
+
+            range_offsets.assign(num_ranges + 1, 0);
+
+#pragma omp parallel for num_threads(threads) schedule(dynamic, 1)
+            for(long r = 0; r < static_cast<long>(num_ranges); ++r) {
+                size_t num_distinct = 0;
+                merge_counted_runs(range_runs[r], [&](kmer_t, count_t) {
+                    ++num_distinct;
+                });
+
+                range_offsets[r + 1] = num_distinct;
+            }
 
-                if(set_proxy(set_pos) == kmer) {
-                    proxy(i, j) = counts_proxy(set_pos);
-                    ++positions[j];
+            for(size_t r = 0; r < num_ranges; ++r) {
+                range_offsets[r + 1] += range_offsets[r];
+            }
+        }
+
+        size_t num_distinct = range_offsets.back();
+        kmerset_t distinct(num_distinct);
+        kmercounts_t counts(num_distinct);
+        kmer_t* distinct_data = distinct.mutable_data();
+        count_t* counts_data = counts.mutable_data();
+
+        {
+            py::gil_scoped_release release;
+
+#pragma omp parallel for num_threads(threads) schedule(dynamic, 1)
+            for(long r = 0; r < static_cast<long>(range_runs.size()); ++r) {
+                size_t pos = range_offsets[r];
+                merge_counted_runs(range_runs[r], [&](kmer_t kmer, count_t count) {
+                    distinct_data[pos] = kmer;
+                    counts_data[pos] = count;
+                    ++pos;
+                });
+            }
+        }
+
+        return std::make_tuple(distinct, counts);
+    }
+
+    /**
+     * Merge two k-mer sets and their counts, and count the number of
+     * singletons (k-mers with a merged count of one) on the way.
+     */
+    static std::tuple<kmerset_t, kmercounts_t, size_t> merge_counts_internal(
+            const kmerset_t& kmers1,
+            const kmercounts_t& counts1,
+            const kmerset_t& kmers2,
+            const kmercounts_t& counts2) {
+        // Only copies if the given arrays are not contiguous
+        contiguous_kmerset_t contiguous1 = kmers1;
+        contiguous_kmerset_t contiguous2 = kmers2;
+        contiguous_kmercounts_t contiguous_counts1 = counts1;
+        contiguous_kmercounts_t contiguous_counts2 = counts2;
+
+        size_t size1 = contiguous1.shape(0);
+        size_t size2 = contiguous2.shape(0);
+        if(static_cast<size_t>(contiguous_counts1.shape(0)) != size1
+                || static_cast<size_t>(contiguous_counts2.shape(0)) != size2) {
+            throw KmerizeError("k-mer and count arrays have different sizes.");
+        }
+
+        const kmer_t* data1 = contiguous1.data();
+        const kmer_t* data2 = contiguous2.data();
+        const count_t* cdata1 = contiguous_counts1.data();
+        const count_t* cdata2 = contiguous_counts2.data();
+
+        size_t common;
+        {
+            py::gil_scoped_release release;
+            common = count_common_internal(data1, size1, data2, size2);
+        }
+
+        size_t new_size = size1 + size2 - common;
+        kmerset_t new_set(new_size);
+        kmercounts_t new_counts(new_size);
+        kmer_t* new_data = new_set.mutable_data();
+        count_t* new_cdata = new_counts.mutable_data();
+
+        size_t singletons = 0;
+        {
+            // Allows k-merizing the next batch while merging in another
+            // thread
+            py::gil_scoped_release release;
+
+            size_t kcount = 0;
+            size_t i1 = 0, i2 = 0;
+            while(i1 < size1 && i2 < size2) {
+                kmer_t kmer1 = data1[i1];
+                kmer_t kmer2 = data2[i2];
+                count_t count;
+
+                if(kmer1 == kmer2) {
+                    // In both sets
+                    new_data[kcount] = kmer1;
+                    count = saturate_count(
+                        static_cast<uint64_t>(cdata1[i1]) + cdata2[i2]);
+                    ++i1;
+                    ++i2;
+                } else if (kmer1 < kmer2) {
+                    // Only in set 1
+                    new_data[kcount] = kmer1;
+                    count = cdata1[i1];
+                    ++i1;
                 } else {
-                    proxy(i, j) = 0;
+                    new_data[kcount] = kmer2;
+                    count = cdata2[i2];
+                    ++i2;
                 }
 
-                ++j;
+                new_cdata[kcount] = count;
+                singletons += (count == 1);
+                ++kcount;
+            }
+
+            // Check for leftovers
+            for(; i1 < size1; ++i1, ++kcount) {
+                new_data[kcount] = data1[i1];
+                new_cdata[kcount] = cdata1[i1];
+                singletons += (cdata1[i1] == 1);
+            }
+            for(; i2 < size2; ++i2, ++kcount) {
+                new_data[kcount] = data2[i2];
+                new_cdata[kcount] = cdata2[i2];
+                singletons += (cdata2[i2] == 1);
+            }
+        }
+
+        return std::make_tuple(new_set, new_counts, singletons);
+    }
+
+    std::tuple<kmerset_t, kmercounts_t> merge_counts(
+            const kmerset_t& kmers1,
+            const kmercounts_t& counts1,
+            const kmerset_t& kmers2,
+            const kmercounts_t& counts2) {
+        auto result = merge_counts_internal(kmers1, counts1, kmers2, counts2);
+        return std::make_tuple(std::get<0>(result), std::get<1>(result));
+    }
+
+    std::tuple<kmerset_t, kmercounts_t, size_t> merge_counts_singletons(
+            const kmerset_t& kmers1,
+            const kmercounts_t& counts1,
+            const kmerset_t& kmers2,
+            const kmercounts_t& counts2) {
+        return merge_counts_internal(kmers1, counts1, kmers2, counts2);
+    }
+
+    /**
+     * Return the sorted union of two sorted arrays of distinct k-mers.
+     */
+    static vector<kmer_t> union_sorted(const vector<kmer_t>& kmers1,
+            const vector<kmer_t>& kmers2) {
+        vector<kmer_t> result;
+        result.reserve(kmers1.size() + kmers2.size());
+        std::set_union(kmers1.begin(), kmers1.end(), kmers2.begin(),
+                kmers2.end(), std::back_inserter(result));
+
+        return result;
+    }
+
+    /**
+     * Keeps contiguous k-mer and count arrays alive while their raw data is
+     * used without holding the GIL.
+     */
+    struct CountedRunArrays {
+        vector<contiguous_kmerset_t> kmer_arrays;
+        vector<contiguous_kmercounts_t> count_arrays;
+        vector<CountedRun> runs;
+
+        void add(const py::handle& kmers, const py::handle& counts) {
+            kmer_arrays.push_back(kmers.cast<contiguous_kmerset_t>());
+            count_arrays.push_back(counts.cast<contiguous_kmercounts_t>());
+
+            if(kmer_arrays.back().shape(0) != count_arrays.back().shape(0)) {
+                throw KmerizeError("k-mer and count arrays have different sizes.");
             }
-            ++i;
+
+            runs.push_back(CountedRun{kmer_arrays.back().data(),
+                    count_arrays.back().data(),
+                    static_cast<size_t>(kmer_arrays.back().shape(0))});
+        }
+    };
+
+    static std::tuple<vector<kmer_t>, kmercounts_t> count_matrix_from_runs(
+            const vector<CountedRun>& sets, int num_threads) {
+        size_t num_sets = sets.size();
+        int threads = resolve_num_threads(num_threads);
+
+        // Compute the sorted union of all k-mer sets with a tree of pairwise
+        // merges, each level of the tree is merged in parallel.
+        vector<vector<kmer_t>> level(num_sets);
+        {
+            py::gil_scoped_release release;
+
+#pragma omp parallel for num_threads(threads) schedule(dynamic, 1)
+            for(long i = 0; i < static_cast<long>(num_sets); ++i) {
+                level[i].assign(sets[i].kmers, sets[i].kmers + sets[i].size);
+            }
+
+            while(level.size() > 1) {
+                size_t num_pairs = level.size() / 2;
+                vector<vector<kmer_t>> next((level.size() + 1) / 2);
+
+#pragma omp parallel for num_threads(threads) schedule(dynamic, 1)
+                for(long i = 0; i < static_cast<long>(num_pairs); ++i) {
+                    next[i] = union_sorted(level[2*i], level[2*i + 1]);
+                    vector<kmer_t>().swap(level[2*i]);
+                    vector<kmer_t>().swap(level[2*i + 1]);
+                }
+
+                if(level.size() % 2 == 1) {
+                    next.back().swap(level.back());
+                }
+
+                level.swap(next);
+            }
+        }
+
+        vector<kmer_t> all_kmers;
+        if(!level.empty()) {
+            all_kmers.swap(level[0]);
+        }
+
+        size_t num_kmers = all_kmers.size();
+        kmercounts_t kmer_matrix({num_kmers, num_sets});
+        count_t* matrix = kmer_matrix.mutable_data();
+
+        {
+            py::gil_scoped_release release;
+
+            // Each column is filled independently by walking the k-mer set
+            // along the sorted union of all k-mers.
+#pragma omp parallel for num_threads(threads) schedule(dynamic, 1)
+            for(long j = 0; j < static_cast<long>(num_sets); ++j) {
+                const CountedRun& set = sets[j];
+                size_t set_pos = 0;
+
+                for(size_t i = 0; i < num_kmers; ++i) {
+                    count_t count = 0;
+                    if(set_pos < set.size && set.kmers[set_pos] == all_kmers[i]) {
+                        count = set.counts[set_pos];
+                        ++set_pos;
+                    }
+
+                    matrix[i * num_sets + j] = count;
+                }
+            }
+        }
+
+        return std::make_tuple(all_kmers, kmer_matrix);
+    }
+
+    std::tuple<vector<kmer_t>, kmercounts_t> build_kmer_count_matrix(
+            const std::vector<kmers_with_counts_t>& kmersets,
+            int num_threads) {
+        CountedRunArrays arrays;
+        for(auto& elem : kmersets) {
+            arrays.add(std::get<0>(elem), std::get<1>(elem));
         }
 
-        // Create a vector of all unique k-mers.
-        // We do this instead of returning the set itself because the
-        // ordered C++ set gets converted to a unordered Python set, which means
-        // we lose the k-mer order.
-        vector<kmer_t> kmer_list(all_unique_kmers.begin(), all_unique_kmers.end());
+        return count_matrix_from_runs(arrays.runs, num_threads);
+    }
+
+    std::tuple<kmerset_t, kmercounts_t> build_kmer_count_matrix_from_kmersets(
+            const py::iterable& kmersets, int num_threads) {
+        CountedRunArrays arrays;
+        for(py::handle kmerset : kmersets) {
+            arrays.add(kmerset.attr("kmers"), kmerset.attr("counts"));
+        }
+
+        auto result = count_matrix_from_runs(arrays.runs, num_threads);
+        const vector<kmer_t>& all_kmers = std::get<0>(result);
+
+        kmerset_t kmers(all_kmers.size());
+        std::copy(all_kmers.begin(), all_kmers.end(), kmers.mutable_data());
 
-        return std::make_tuple(kmer_list, kmer_matrix);
+        return std::make_tuple(kmers, std::get<1>(result));
     }
 
 
@@ -368,6 +1078,248 @@ namespace strainge {
         return new_set;
     }
 
+    /**
+     * Shared implementation of `intersect_apply` and `exclude_apply`: copy
+     * each k-mer (and its count) that is (keep_common=true) or is not
+     * (keep_common=false) present in `other_kmers`.
+     */
+    template<bool keep_common, typename value_t>
+    static std::tuple<kmerset_t, py::array_t<value_t>> filter_apply(
+            const kmerset_t& kmers, const py::array_t<value_t>& counts,
+            const kmerset_t& other_kmers) {
+        contiguous_kmerset_t contiguous = kmers;
+        contiguous_kmerset_t contiguous_other = other_kmers;
+        py::array_t<value_t, py::array::c_style | py::array::forcecast>
+            contiguous_counts = counts;
+
+        size_t size = contiguous.shape(0);
+        size_t other_size = contiguous_other.shape(0);
+        if(static_cast<size_t>(contiguous_counts.shape(0)) != size) {
+            throw KmerizeError("k-mer and count arrays have different sizes.");
+        }
+
+        const kmer_t* data = contiguous.data();
+        const kmer_t* other_data = contiguous_other.data();
+        const value_t* counts_data = contiguous_counts.data();
+
+        size_t common;
+        {
+            py::gil_scoped_release release;
+            common = count_common_internal(data, size, other_data, other_size);
+        }
+
+        size_t new_size = keep_common ? common : size - common;
+        kmerset_t new_kmers(new_size);
+        py::array_t<value_t> new_counts(new_size);
+        kmer_t* new_kmers_data = new_kmers.mutable_data();
+        value_t* new_counts_data = new_counts.mutable_data();
+
+        {
+            py::gil_scoped_release release;
+
+            size_t pos = 0;
+            size_t j = 0;
+            for(size_t i = 0; i < size; ++i) {
+                kmer_t kmer = data[i];
+                while(j < other_size && other_data[j] < kmer) {
+                    ++j;
+                }
+
+                bool in_other = j < other_size && other_data[j] == kmer;
+                if(in_other == keep_common) {
+                    new_kmers_data[pos] = kmer;
+                    new_counts_data[pos] = counts_data[i];
+                    ++pos;
+                }
+            }
+        }
+
+        return std::make_tuple(new_kmers, new_counts);
+    }
+
+    template<typename value_t>
+    std::tuple<kmerset_t, py::array_t<value_t>> intersect_apply(
+            const kmerset_t& kmers, const py::array_t<value_t>& counts,
+            const kmerset_t& other_kmers) {
+        return filter_apply<true, value_t>(kmers, counts, other_kmers);
+    }
+
+    template<typename value_t>
+    std::tuple<kmerset_t, py::array_t<value_t>> exclude_apply(
+            const kmerset_t& kmers, const py::array_t<value_t>& counts,
+            const kmerset_t& other_kmers) {
+        return filter_apply<false, value_t>(kmers, counts, other_kmers);
+    }
+
+    template std::tuple<kmerset_t, py::array_t<uint32_t>> intersect_apply(
+            const kmerset_t&, const py::array_t<uint32_t>&, const kmerset_t&);
+    template std::tuple<kmerset_t, py::array_t<uint64_t>> intersect_apply(
+            const kmerset_t&, const py::array_t<uint64_t>&, const kmerset_t&);
+    template std::tuple<kmerset_t, py::array_t<uint32_t>> exclude_apply(
+            const kmerset_t&, const py::array_t<uint32_t>&, const kmerset_t&);
+    template std::tuple<kmerset_t, py::array_t<uint64_t>> exclude_apply(
+            const kmerset_t&, const py::array_t<uint64_t>&, const kmerset_t&);
+
+    size_t exclude_inplace(kmerset_t& kmers, vector<kmercounts_t>& counts,
+                           const kmerset_t& other_kmers) {
+        size_t size = kmers.shape(0);
+        vector<count_t*> counts_data;
+
+        auto check_array = [](const py::array& array) {
+            if(!array.writeable() || !(array.flags() & py::array::c_style)) {
+                throw KmerizeError("k-mer and count arrays should be "
+                                   "writeable and C-contiguous.");
+            }
+        };
+
+        check_array(kmers);
+        for(auto& array : counts) {
+            check_array(array);
+            if(static_cast<size_t>(array.shape(0)) != size) {
+                throw KmerizeError("k-mer and count arrays have different "
+                                   "sizes.");
+            }
+
+            counts_data.push_back(array.mutable_data());
+        }
+
+        contiguous_kmerset_t contiguous_other = other_kmers;
+
+        size_t other_size = contiguous_other.shape(0);
+        kmer_t* data = kmers.mutable_data();
+        const kmer_t* other_data = contiguous_other.data();
+
+        py::gil_scoped_release release;
+
+        if(other_size * GALLOP_RATIO < size) {
+            // Few k-mers to remove: find them by galloping search, and move
+            // the blocks of k-mers in between to the front
+            vector<size_t> removed;
+            gallop_common(other_data, other_size, data, size,
+                          [&removed](size_t, size_t i) {
+                removed.push_back(i);
+            });
+            removed.push_back(size);
+
+            size_t pos = removed[0];
+            for(size_t r = 0; r + 1 < removed.size(); ++r) {
+                size_t begin = removed[r] + 1;
+                size_t end = removed[r + 1];
+
+                std::copy(data + begin, data + end, data + pos);
+                for(count_t* values : counts_data) {
+                    std::copy(values + begin, values + end, values + pos);
+                }
+                pos += end - begin;
+            }
+
+            return pos;
+        }
+
+        size_t pos = 0;
+        size_t j = 0;
+        for(size_t i = 0; i < size; ++i) {
+            kmer_t kmer = data[i];
+            while(j < other_size && other_data[j] < kmer) {
+                ++j;
+            }
+
+            if(j < other_size && other_data[j] == kmer) {
+                continue;
+            }
+
+            data[pos] = kmer;
+            for(count_t* values : counts_data) {
+                values[pos] = values[i];
+            }
+            ++pos;
+        }
+
+        return pos;
+    }
+
+    std::tuple<kmerset_t, kmercounts_t> filter_counts(const kmerset_t& kmers,
+            const kmercounts_t& counts, uint64_t min_freq, uint64_t max_freq) {
+        contiguous_kmerset_t contiguous = kmers;
+        contiguous_kmercounts_t contiguous_counts = counts;
+
+        size_t size = contiguous.shape(0);
+        if(static_cast<size_t>(contiguous_counts.shape(0)) != size) {
+            throw KmerizeError("k-mer and count arrays have different sizes.");
+        }
+
+        const kmer_t* data = contiguous.data();
+        const count_t* counts_data = contiguous_counts.data();
+
+        // Branch free, so the compiler can vectorize the counting pass
+        auto keep = [=](count_t count) {
+            return (count >= min_freq) & (count <= max_freq);
+        };
+
+        size_t new_size = 0;
+        {
+            py::gil_scoped_release release;
+            for(size_t i = 0; i < size; ++i) {
+                new_size += keep(counts_data[i]);
+            }
+        }
+
+        kmerset_t new_kmers(new_size);
+        kmercounts_t new_counts(new_size);
+        kmer_t* new_kmers_data = new_kmers.mutable_data();
+        count_t* new_counts_data = new_counts.mutable_data();
+
+        {
+            py::gil_scoped_release release;
+
+            size_t pos = 0;
+            for(size_t i = 0; i < size && pos < new_size; ++i) {
+                // Always write, only advance when the k-mer is kept
+                new_kmers_data[pos] = data[i];
+                new_counts_data[pos] = counts_data[i];
+                pos += keep(counts_data[i]);
+            }
+        }
+
+        return std::make_tuple(new_kmers, new_counts);
+    }
+
+    std::tuple<py::array_t<int64_t>, py::array_t<int64_t>> intersect_indices(
+            const kmerset_t& kmers1, const kmerset_t& kmers2) {
+        contiguous_kmerset_t contiguous1 = kmers1;
+        contiguous_kmerset_t contiguous2 = kmers2;
+
+        size_t size1 = contiguous1.shape(0);
+        size_t size2 = contiguous2.shape(0);
+        const kmer_t* data1 = contiguous1.data();
+        const kmer_t* data2 = contiguous2.data();
+
+        size_t common;
+        {
+            py::gil_scoped_release release;
+            common = count_common_internal(data1, size1, data2, size2);
+        }
+
+        py::array_t<int64_t> ix1(common);
+        py::array_t<int64_t> ix2(common);
+        int64_t* ix1_data = ix1.mutable_data();
+        int64_t* ix2_data = ix2.mutable_data();
+
+        {
+            py::gil_scoped_release release;
+
+            size_t pos = 0;
+            for_each_common(data1, size1, data2, size2,
+                    [&](size_t i1, size_t i2) {
+                ix1_data[pos] = i1;
+                ix2_data[pos] = i2;
+                ++pos;
+            });
+        }
+
+        return std::make_tuple(ix1, ix2);
+    }
+
     uint64_t kmerset_in_product(
             const kmerset_t& kmers1,
             const kmercounts_t& counts1,
@@ -389,7 +1341,8 @@ namespace strainge {
             kmer_t kmer2 = proxy2(i2);
 
             if(kmer1 == kmer2) {
-                product += counts_proxy1(i1) * counts_proxy2(i2);
+                product += static_cast<uint64_t>(counts_proxy1(i1))
+                    * counts_proxy2(i2);
                 ++i1;
                 ++i2;
             } else if(kmer1 < kmer2) {
@@ -402,6 +1355,124 @@ namespace strainge {
         return product;
     }
 
+    // Pan-genome counts are usually small (at most the number of strains
+    // sharing a k-mer), so look up their inverse instead of dividing for
+    // each common k-mer
+    const count_t INVERSE_TABLE_SIZE = 1024;
+
+    static const vector<double>& inverse_table() {
+        static const vector<double> table = [] {
+            vector<double> inverses(INVERSE_TABLE_SIZE);
+            for(count_t i = 0; i < INVERSE_TABLE_SIZE; ++i) {
+                inverses[i] = 1.0 / i;
+            }
+
+            return inverses;
+        }();
+
+        return table;
+    }
+
+    py::tuple strain_sample_sums(const kmerset_t& sample_kmers,
+                                 const kmercounts_t& sample_counts,
+                                 const vector<strain_kmers_t>& strains,
+                                 int num_threads) {
+        contiguous_kmerset_t contiguous_sample = sample_kmers;
+        contiguous_kmercounts_t contiguous_sample_counts = sample_counts;
+
+        size_t sample_size = contiguous_sample.shape(0);
+        if(static_cast<size_t>(contiguous_sample_counts.shape(0))
+                != sample_size) {
+            throw KmerizeError("k-mer and count arrays have different sizes.");
+        }
+
+        size_t num_strains = strains.size();
+        vector<CountedRun> strain_runs(num_strains);
+        vector<const count_t*> strain_pan_counts(num_strains);
+        for(size_t s = 0; s < num_strains; ++s) {
+            const auto& kmers = std::get<0>(strains[s]);
+            const auto& counts = std::get<1>(strains[s]);
+            const auto& pan_counts = std::get<2>(strains[s]);
+
+            if(counts.shape(0) != kmers.shape(0)
+                    || pan_counts.shape(0) != kmers.shape(0)) {
+                throw KmerizeError("k-mer and count arrays have different "
+                                   "sizes.");
+            }
+
+            strain_runs[s] = {kmers.data(), counts.data(),
+                              static_cast<size_t>(kmers.shape(0))};
+            strain_pan_counts[s] = pan_counts.data();
+        }
+
+        py::array_t<uint64_t> common(num_strains);
+        py::array_t<uint64_t> strain_total(num_strains);
+        py::array_t<uint64_t> sample_total(num_strains);
+        py::array_t<double> strain_weight(num_strains);
+        py::array_t<double> sample_weight(num_strains);
+        py::array_t<uint64_t> genome_total(num_strains);
+
+        const kmer_t* sample_data = contiguous_sample.data();
+        const count_t* sample_counts_data = contiguous_sample_counts.data();
+        uint64_t* common_data = common.mutable_data();
+        uint64_t* strain_total_data = strain_total.mutable_data();
+        uint64_t* sample_total_data = sample_total.mutable_data();
+        double* strain_weight_data = strain_weight.mutable_data();
+        double* sample_weight_data = sample_weight.mutable_data();
+        uint64_t* genome_total_data = genome_total.mutable_data();
+
+        int threads = resolve_num_threads(num_threads);
+        const double* inverses = inverse_table().data();
+
+        {
+            py::gil_scoped_release release;
+
+            // Strains differ a lot in size, so hand them out one at a time
+#pragma omp parallel for num_threads(threads) schedule(dynamic, 1)
+            for(long s = 0; s < static_cast<long>(num_strains); ++s) {
+                const CountedRun& run = strain_runs[s];
+                const count_t* pan_data = strain_pan_counts[s];
+
+                uint64_t num_common = 0;
+                uint64_t strain_sum = 0;
+                uint64_t sample_sum = 0;
+                double strain_weighted = 0.0;
+                double sample_weighted = 0.0;
+
+                for_each_common(run.kmers, run.size, sample_data, sample_size,
+                        [&](size_t i1, size_t i2) {
+                    count_t pan_count = pan_data[i1];
+                    double weight = pan_count < INVERSE_TABLE_SIZE
+                        ? inverses[pan_count] : 1.0 / pan_count;
+                    count_t count = run.counts[i1];
+                    count_t sample_count = sample_counts_data[i2];
+
+                    ++num_common;
+                    strain_sum += count;
+                    sample_sum += sample_count;
+                    strain_weighted += count * weight;
+                    sample_weighted += sample_count * weight;
+                });
+
+                common_data[s] = num_common;
+                strain_total_data[s] = strain_sum;
+                sample_total_data[s] = sample_sum;
+                strain_weight_data[s] = strain_weighted;
+                sample_weight_data[s] = sample_weighted;
+
+                uint64_t genome_sum = 0;
+                for(size_t i = 0; i < run.size; ++i) {
+                    genome_sum += run.counts[i];
+                }
+
+                genome_total_data[s] = genome_sum;
+            }
+        }
+
+        return py::make_tuple(common, strain_total, sample_total,
+                              strain_weight, sample_weight, genome_total);
+    }
+
     const uint64_t FNV_PRIME = 1099511628211u;
     const uint64_t FNV_OFFSET = 14695981039346656037u;
 
@@ -432,4 +1503,73 @@ namespace strainge {
 
         return hashed;
     }
+
+    /**
+     * Lookup table mapping each byte (4 bases, 2 bits each) to its four
+     * nucleotide characters.
+     */
+    static std::array<std::array<char, 4>, 256> build_base_lut() {
+        const char bases[] = "ACGT";
+        std::array<std::array<char, 4>, 256> lut;
+
+        for(int byte = 0; byte < 256; ++byte) {
+            for(int i = 0; i < 4; ++i) {
+                lut[byte][i] = bases[(byte >> (6 - 2 * i)) & 3];
+            }
+        }
+
+        return lut;
+    }
+
+    py::array kmer_strings(int k, const kmerset_t& kmers) {
+        check_k(k);
+
+        static const auto lut = build_base_lut();
+
+        size_t size = kmers.shape(0);
+        py::array strings(py::dtype::from_args(py::str("S" + std::to_string(k))),
+                std::vector<size_t>{size});
+
+        auto proxy = kmers.unchecked<1>();
+        char* out = static_cast<char*>(strings.mutable_data());
+
+        {
+            py::gil_scoped_release release;
+            for(size_t i = 0; i < size; ++i) {
+                // Align first base to the most significant bits
+                kmer_t kmer = proxy(i) << (64 - 2 * k);
+
+                for(int b = 0; b < k; b += 4) {
+                    const auto& chars = lut[kmer >> 56];
+                    std::copy_n(chars.begin(), std::min(4, k - b), out + b);
+                    kmer <<= 8;
+                }
+
+                out += k;
+            }
+        }
+
+        return strings;
+    }
+
+    bool arrays_equal(const py::array& a, const py::array& b) {
+        if(!(a.flags() & py::array::c_style) || !(b.flags() & py::array::c_style)) {
+            throw KmerizeError("Arrays to compare should be C-contiguous.");
+        }
+
+        if(a.nbytes() != b.nbytes()) {
+            return false;
+        }
+
+        const void* data_a = a.data();
+        const void* data_b = b.data();
+        size_t nbytes = a.nbytes();
+
+        if(data_a == data_b || nbytes == 0) {
+            return true;
+        }
+
+        py::gil_scoped_release release;
+        return std::memcmp(data_a, data_b, nbytes) == 0;
+    }
 }
@@ -4,6 +4,7 @@
 
 #include <tuple>
 #include <string>
+#include <vector>
 #include <iterator>
 #include <exception>
 
@@ -35,7 +36,15 @@ namespace strainge {
 
     typedef uint64_t kmer_t;
     typedef py::array_t<kmer_t> kmerset_t;
-    typedef py::array_t<uint64_t> kmercounts_t;
+    typedef py::array_t<kmer_t, py::array::c_style | py::array::forcecast> contiguous_kmerset_t;
+    /**
+     * k-mer counts are unsigned 32-bit integers, saturating at MAX_COUNT.
+     */
+    typedef uint32_t count_t;
+    const count_t MAX_COUNT = UINT32_MAX;
+
+    typedef py::array_t<count_t> kmercounts_t;
+    typedef py::array_t<count_t, py::array::c_style | py::array::forcecast> contiguous_kmercounts_t;
     typedef std::tuple<kmerset_t, kmercounts_t> kmers_with_counts_t;
 
     /**
@@ -218,6 +227,46 @@ namespace strainge {
     size_t kmerize_into_array(int k, const std::string& sequence,
             kmerset_t& array, unsigned int offset);
 
+    /**
+     * A simple Bloom filter for k-mers, used to skip k-mers that have only
+     * been seen once (most likely sequencing errors) while k-merizing.
+     */
+    class BloomFilter {
+        public:
+            /**
+             * @param num_bits Size of the filter in bits
+             * @param num_hashes Number of hash functions to use
+             */
+            BloomFilter(size_t num_bits, int num_hashes);
+
+            /**
+             * Add a k-mer to the filter.
+             *
+             * @return True if the k-mer was (probably) already present.
+             */
+            bool add(kmer_t kmer);
+
+            bool contains(kmer_t kmer) const;
+
+            size_t num_bits() const { return bits.size() * 64; }
+            int num_hashes() const { return hashes; }
+
+        private:
+            std::vector<uint64_t> bits;
+            int hashes;
+    };
+
+    /**
+     * Like `kmerize_into_array`, but only stores k-mers that were already
+     * seen before according to the given Bloom filter. k-mers seen for the
+     * first time are only added to the Bloom filter. This means that the
+     * first occurrence of each k-mer is not stored.
+     *
+     * @return Number of k-mers stored
+     */
+    size_t kmerize_into_array_prefiltered(int k, const std::string& sequence,
+            kmerset_t& array, unsigned int offset, BloomFilter& bloom);
+
 
     /**
      * Count the number of common k-mers between two k-mer sets. The k-mer sets
@@ -231,6 +280,81 @@ namespace strainge {
     size_t count_common(const kmerset_t& kmers1,
             const kmerset_t& kmers2);
 
+    /**
+     * Compute the size of both the intersection and the union of two sorted
+     * k-mer sets, in a single pass.
+     *
+     * @param kmers1 The first set of k-mers as NumPy array
+     * @param kmers2 The second set of k-mers as NumPy array
+     *
+     * @return Tuple with the number of common k-mers and the size of the
+     *     union
+     */
+    std::tuple<size_t, size_t> intersect_sorted_u64(const kmerset_t& kmers1,
+            const kmerset_t& kmers2);
+
+    /**
+     * Count the occurrences of each distinct k-mer in a sorted array of
+     * k-mers (run-length encoding).
+     *
+     * @param kmers Sorted array of k-mers
+     *
+     * @return A tuple with a new NumPy array containing the distinct k-mers,
+     *    and a NumPy array with corresponding counts.
+     */
+    std::tuple<kmerset_t, kmercounts_t> count_sorted(const kmerset_t& kmers);
+
+    /**
+     * Count the occurrences of each distinct k-mer in an array consisting of
+     * consecutive sorted chunks of `chunk_size` k-mers (the last chunk may be
+     * smaller).
+     *
+     * The chunks are run-length encoded in parallel (with OpenMP), followed
+     * by a k-way merge of the chunks, which is split in ranges of k-mer
+     * values that are merged in parallel too. The given array is used as
+     * scratch space and its contents are overwritten.
+     *
+     * @param kmers Array of sorted chunks of k-mers
+     * @param chunk_size Number of k-mers per chunk
+     * @param num_threads Number of threads, <= 0 uses the OpenMP default.
+     *
+     * @return A tuple with a new NumPy array containing the distinct k-mers,
+     *    and a NumPy array with corresponding counts.
+     */
+    std::tuple<kmerset_t, kmercounts_t> count_sorted_chunks(
+            contiguous_kmerset_t& kmers, size_t chunk_size,
+            int num_threads = 0);
+
+    /**
+     * Similarity metrics between two k-mer sets, all based on the number of
+     * common k-mers.
+     */
+    enum class SimilarityMode : int {
+        JACCARD = 0,    ///< Intersection size / union size
+        MINSIZE = 1,    ///< Intersection size / size of the smallest set
+        MEANSIZE = 2,   ///< Intersection size / mean size of both sets
+        MAXSIZE = 3,    ///< Intersection size / size of the largest set
+        REFERENCE = 4,  ///< Intersection size / size of the second set
+        SUBSET = 5      ///< Intersection size / size of the first set
+    };
+
+    /**
+     * Compute the similarity between two sorted k-mer sets.
+     */
+    double similarity(const kmerset_t& kmers1, const kmerset_t& kmers2,
+            SimilarityMode mode);
+
+    /**
+     * Compute the similarity between all pairs of the given sorted k-mer
+     * sets, without holding the GIL.
+     *
+     * @return N x N NumPy array where element (i, j) contains the similarity
+     *     between k-mer set i and k-mer set j.
+     */
+    py::array_t<double> pairwise_similarity(
+            const std::vector<contiguous_kmerset_t>& kmersets,
+            SimilarityMode mode);
+
     /**
      * Merge two k-mer sets and their corresponding counts.
      *
@@ -244,6 +368,21 @@ namespace strainge {
             const kmercounts_t& counts2
     );
 
+    /**
+     * Merge two k-mer sets and their corresponding counts, like
+     * `merge_counts`, and count the singletons in the merged set.
+     *
+     * @return A tuple with a new NumPy array containing k-mers from both sets,
+     *    a NumPy array with corresponding updated counts, and the number of
+     *    k-mers with a count of one.
+     */
+    std::tuple<kmerset_t, kmercounts_t, size_t> merge_counts_singletons(
+            const kmerset_t& kmers1,
+            const kmercounts_t& counts1,
+            const kmerset_t& kmers2,
+            const kmercounts_t& counts2
+    );
+
     /**
      * Build a k-mer count matrix for a given list of kmersets.
      *
@@ -258,9 +397,25 @@ namespace strainge {
      *         KxL NumPy array with k-mer counts. K: number of unique k-mers
      *         in given list of k-mer sets, L: number of k-mer sets given. The
      *         k-mers will be sorted.
+     *
+     * The union of all k-mers is computed with a tree of pairwise merges, and
+     * the columns of the matrix are filled in parallel (with OpenMP).
+     * `num_threads` <= 0 uses the OpenMP default.
      */
-    std::tuple<std::vector<kmer_t>, py::array_t<uint64_t>> build_kmer_count_matrix(
-            const std::vector<kmers_with_counts_t>& kmersets);
+    std::tuple<std::vector<kmer_t>, kmercounts_t> build_kmer_count_matrix(
+            const std::vector<kmers_with_counts_t>& kmersets,
+            int num_threads = 0);
+
+    /**
+     * Build a k-mer count matrix for a given list of `KmerSet` objects, like
+     * `build_kmer_count_matrix`. The k-mers and counts are read directly
+     * from the `kmers` and `counts` attributes of each object.
+     *
+     * @return A tuple with a NumPy array of the sorted k-mers (the labels
+     *         for the rows), and the KxL NumPy array with k-mer counts.
+     */
+    std::tuple<kmerset_t, kmercounts_t> build_kmer_count_matrix_from_kmersets(
+            const py::iterable& kmersets, int num_threads = 0);
 
     /**
      * Return the intersection between two k-mer sets.
@@ -288,6 +443,58 @@ namespace strainge {
      */
     kmerset_t diff(const kmerset_t& kmers1, const kmerset_t& kmers2);
 
+    /**
+     * Keep only the k-mers with a count within [min_freq, max_freq], in two
+     * sequential passes over the counts (count, then copy).
+     *
+     * @return Tuple with the new k-mer array and the matching counts.
+     */
+    std::tuple<kmerset_t, kmercounts_t> filter_counts(const kmerset_t& kmers,
+            const kmercounts_t& counts, uint64_t min_freq,
+            uint64_t max_freq = MAX_COUNT);
+
+    /**
+     * Reduce a k-mer set and its counts to the k-mers also present in
+     * `other_kmers`, in a single pass over both sorted arrays.
+     *
+     * @return Tuple with the new k-mer array and the matching counts.
+     */
+    template<typename value_t>
+    std::tuple<kmerset_t, py::array_t<value_t>> intersect_apply(
+            const kmerset_t& kmers, const py::array_t<value_t>& counts,
+            const kmerset_t& other_kmers);
+
+    /**
+     * Remove all k-mers present in `other_kmers` from a k-mer set and its
+     * counts, in a single pass over both sorted arrays.
+     *
+     * @return Tuple with the new k-mer array and the matching counts.
+     */
+    template<typename value_t>
+    std::tuple<kmerset_t, py::array_t<value_t>> exclude_apply(
+            const kmerset_t& kmers, const py::array_t<value_t>& counts,
+            const kmerset_t& other_kmers);
+
+    /**
+     * Remove the k-mers in `other_kmers` from a k-mer set and one or more
+     * arrays of counts in place, in a single pass. The remaining k-mers and
+     * counts are moved to the front of the (writeable, C-contiguous) arrays.
+     *
+     * @return The number of remaining k-mers.
+     */
+    size_t exclude_inplace(kmerset_t& kmers,
+                           std::vector<kmercounts_t>& counts,
+                           const kmerset_t& other_kmers);
+
+    /**
+     * Find the positions of the common k-mers in both sorted k-mer sets.
+     *
+     * @return Tuple (ix1, ix2) of index arrays such that
+     *     kmers1[ix1] == kmers2[ix2].
+     */
+    std::tuple<py::array_t<int64_t>, py::array_t<int64_t>> intersect_indices(
+            const kmerset_t& kmers1, const kmerset_t& kmers2);
+
     /**
      * Calculate the in-product between two k-mer sets.
      */
@@ -298,6 +505,37 @@ namespace strainge {
             const kmercounts_t& counts2
     );
 
+    /**
+     * K-mers of a strain with their counts in the strain and in the
+     * pan-genome.
+     */
+    typedef std::tuple<contiguous_kmerset_t, contiguous_kmercounts_t,
+                       contiguous_kmercounts_t> strain_kmers_t;
+
+    /**
+     * Sums over the k-mers each strain has in common with a sample, as
+     * needed for StrainGST's scores. Each strain is compared to the sample
+     * in a single pass. For the weighted sums, each k-mer is weighted by the
+     * inverse of its pan-genome count.
+     *
+     * @param sample_kmers sorted sample k-mers
+     * @param sample_counts sample count of each k-mer
+     * @param strains list of (kmers, counts, pan_counts) tuples, one for each
+     *     strain
+     * @param num_threads number of threads to process strains in parallel
+     *     (0: OpenMP default)
+     *
+     * @return Tuple of arrays (common, strain_total, sample_total,
+     *     strain_weight, sample_weight, genome_total), with for each strain
+     *     the number of common k-mers, the unweighted and the weighted sums
+     *     of their strain and sample counts, and the sum of the counts of
+     *     all k-mers of the strain.
+     */
+    py::tuple strain_sample_sums(const kmerset_t& sample_kmers,
+                                 const kmercounts_t& sample_counts,
+                                 const std::vector<strain_kmers_t>& strains,
+                                 int num_threads=0);
+
     /**
      * Hash each k-mer in a k-mer set using Fowler-Voll-No hash function. Useful
      * when calculating min-hash of a k-mer set.
@@ -308,6 +546,28 @@ namespace strainge {
      * @return A NumPy array with each k-mer hash value
      */
     kmerset_t fnvhash_kmers(int k, const kmerset_t& kmers);
+
+    /**
+     * Convert each k-mer in a k-mer set to its nucleotide sequence.
+     *
+     * @param k k-mer size
+     * @param kmers k-mer set to convert
+     *
+     * @return A NumPy array of fixed width byte strings (dtype S<k>)
+     */
+    py::array kmer_strings(int k, const kmerset_t& kmers);
+
+    /**
+     * Compare the raw contents of two C-contiguous arrays with `memcmp`.
+     * The caller is responsible for checking that both arrays have the
+     * same dtype and shape.
+     *
+     * @param a first array
+     * @param b second array
+     *
+     * @return Whether both arrays contain exactly the same bytes
+     */
+    bool arrays_equal(const py::array& a, const py::array& b);
 }
 
 #endif
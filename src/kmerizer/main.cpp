@@ -18,16 +18,69 @@ PYBIND11_MODULE(kmerizer, m) {
     m.def("kmerize_into_array", &strainge::kmerize_into_array,
             "Kmerize a sequence and store k-mers in a pre-allocated NumPy array",
             py::arg("k"), py::arg("sequence"), py::arg("out_array"), py::arg("offset"));
+    py::class_<strainge::BloomFilter>(m, "BloomFilter")
+        .def(py::init<size_t, int>(), py::arg("num_bits"), py::arg("num_hashes") = 2)
+        .def("add", &strainge::BloomFilter::add,
+                "Add a k-mer, returns True if it was (probably) already present.",
+                py::arg("kmer"))
+        .def("__contains__", &strainge::BloomFilter::contains)
+        .def_property_readonly("num_bits", &strainge::BloomFilter::num_bits)
+        .def_property_readonly("num_hashes", &strainge::BloomFilter::num_hashes);
+
+    m.def("kmerize_into_array_prefiltered", &strainge::kmerize_into_array_prefiltered,
+            "Kmerize a sequence and store k-mers in a pre-allocated NumPy array, "
+            "but only those k-mers already present in the given Bloom filter. "
+            "Other k-mers are added to the Bloom filter.",
+            py::arg("k"), py::arg("sequence"), py::arg("out_array"), py::arg("offset"),
+            py::arg("bloom"));
+    py::enum_<strainge::SimilarityMode>(m, "SimilarityMode")
+        .value("JACCARD", strainge::SimilarityMode::JACCARD)
+        .value("MINSIZE", strainge::SimilarityMode::MINSIZE)
+        .value("MEANSIZE", strainge::SimilarityMode::MEANSIZE)
+        .value("MAXSIZE", strainge::SimilarityMode::MAXSIZE)
+        .value("REFERENCE", strainge::SimilarityMode::REFERENCE)
+        .value("SUBSET", strainge::SimilarityMode::SUBSET);
+
+    m.def("similarity", &strainge::similarity,
+            "Compute the similarity between two sorted k-mer sets.",
+            py::arg("kmers1"), py::arg("kmers2"), py::arg("mode"));
+    m.def("pairwise_similarity", &strainge::pairwise_similarity,
+            "Compute a matrix with the similarity between all pairs of the "
+            "given sorted k-mer sets.",
+            py::arg("kmersets"), py::arg("mode"));
+    m.def("count_sorted", &strainge::count_sorted,
+            "Return the distinct k-mers in a sorted array with their counts "
+            "(like numpy.unique with return_counts=True, without sorting).",
+            py::arg("kmers"));
+    m.def("count_sorted_chunks", &strainge::count_sorted_chunks,
+            "Return the distinct k-mers with their counts in an array of "
+            "consecutive sorted chunks of k-mers. The given array is "
+            "overwritten.",
+            py::arg("kmers"), py::arg("chunk_size"), py::arg("num_threads") = 0);
     m.def("merge_counts", &strainge::merge_counts,
             "Merge and sum two k-mer sets and their count arrays.",
             py::arg("kmers1"), py::arg("counts1"), py::arg("kmers2"), py::arg("counts2"));
+    m.def("merge_counts_singletons", &strainge::merge_counts_singletons,
+            "Merge and sum two k-mer sets and their count arrays. Also returns "
+            "the number of singletons in the merged set.",
+            py::arg("kmers1"), py::arg("counts1"), py::arg("kmers2"), py::arg("counts2"));
     m.def("count_common", &strainge::count_common,
             "Count the number of common k-mers between two sets.",
             py::arg("kmers1"), py::arg("kmers2"));
+    m.def("intersect_sorted_u64", &strainge::intersect_sorted_u64,
+            "Return both the size of the intersection and the size of the "
+            "union of two sorted k-mer sets.",
+            py::arg("kmers1"), py::arg("kmers2"));
     m.def("build_kmer_count_matrix", &strainge::build_kmer_count_matrix,
             "Build a matrix with all k-mer counts combined for the given list of k-mer sets. "
             "Input should be a list of (kmers, counts) tuples.",
-            py::arg("kmerset_list"));
+            py::arg("kmerset_list"), py::arg("num_threads") = 0);
+    m.def("build_kmer_count_matrix_from_kmersets",
+            &strainge::build_kmer_count_matrix_from_kmersets,
+            "Build a matrix with all k-mer counts combined for the given list of "
+            "KmerSet objects (anything with `kmers` and `counts` attributes). "
+            "Returns a tuple with an array of k-mers and the matrix.",
+            py::arg("kmersets"), py::arg("num_threads") = 0);
 
     m.def("intersect", &strainge::intersect,
             "Return the intersection of two k-mer sets.",
@@ -41,15 +94,67 @@ PYBIND11_MODULE(kmerizer, m) {
     m.def("diff", &strainge::diff,
             "Return the difference of two k-mer sets (kmers1 minus kmers2)",
             py::arg("kmers1"), py::arg("kmers2"));
+    m.def("filter_counts", &strainge::filter_counts,
+            "Keep only the k-mers with a count within [min_freq, max_freq]. "
+            "Returns a (kmers, counts) tuple.",
+            py::arg("kmers"), py::arg("counts"), py::arg("min_freq"),
+            py::arg("max_freq") = strainge::MAX_COUNT);
+
+    // The uint64 overloads come first, so that counts of another dtype are
+    // never narrowed to uint32 during implicit conversion.
+    m.def("intersect_apply", &strainge::intersect_apply<uint64_t>,
+            "Reduce a k-mer set and its counts to the k-mers also in "
+            "other_kmers. Returns a (kmers, counts) tuple.",
+            py::arg("kmers"), py::arg("counts"), py::arg("other_kmers"));
+    m.def("intersect_apply", &strainge::intersect_apply<uint32_t>,
+            "Reduce a k-mer set and its counts to the k-mers also in "
+            "other_kmers. Returns a (kmers, counts) tuple.",
+            py::arg("kmers"), py::arg("counts"), py::arg("other_kmers"));
+    m.def("exclude_apply", &strainge::exclude_apply<uint64_t>,
+            "Remove the k-mers in other_kmers from a k-mer set and its "
+            "counts. Returns a (kmers, counts) tuple.",
+            py::arg("kmers"), py::arg("counts"), py::arg("other_kmers"));
+    m.def("exclude_apply", &strainge::exclude_apply<uint32_t>,
+            "Remove the k-mers in other_kmers from a k-mer set and its "
+            "counts. Returns a (kmers, counts) tuple.",
+            py::arg("kmers"), py::arg("counts"), py::arg("other_kmers"));
+    m.def("exclude_inplace", &strainge::exclude_inplace,
+            "Remove the k-mers in other_kmers from a k-mer set and a list of "
+            "count arrays in place. Returns the number of remaining k-mers, "
+            "which are moved to the front of all arrays.",
+            py::arg("kmers").noconvert(), py::arg("counts").noconvert(),
+            py::arg("other_kmers"));
+    m.def("intersect_indices", &strainge::intersect_indices,
+            "Return index arrays (ix1, ix2) with the positions of the common "
+            "k-mers in kmers1 and kmers2.",
+            py::arg("kmers1"), py::arg("kmers2"));
 
     m.def("kmerset_in_product", &strainge::kmerset_in_product,
             "Calculate the in-product between the count vectors of two kmer-"
             "sets.",
             py::arg("kmers1"), py::arg("counts1"), py::arg("kmers2"), py::arg("counts2"));
 
+    m.def("strain_sample_sums", &strainge::strain_sample_sums,
+            "For each strain in a list of (kmers, counts, pan_counts) tuples, "
+            "compute the number of k-mers in common with the sample, the "
+            "(pan-genome weighted) sums of their strain and sample counts, "
+            "and the sum of all strain counts.",
+            py::arg("sample_kmers"), py::arg("sample_counts"),
+            py::arg("strains"), py::arg("num_threads") = 0);
+
     m.def("fnvhash_kmers", &strainge::fnvhash_kmers,
             "Hash all values in the k-mer set using FNV hash function.",
             py::arg("k"), py::arg("kmers"));
 
+    m.def("arrays_equal", &strainge::arrays_equal,
+            "Compare the raw contents of two C-contiguous arrays of the same "
+            "dtype and shape.",
+            py::arg("a"), py::arg("b"));
+
+    m.def("kmer_strings", &strainge::kmer_strings,
+            "Convert all k-mers in the k-mer set to their nucleotide sequence. "
+            "Returns a NumPy array of byte strings.",
+            py::arg("k"), py::arg("kmers"));
+
     py::register_exception<strainge::KmerizeError>(m, "KmerizeError");
 }
@@ -34,6 +34,7 @@ import argparse
 import functools
 import itertools
 import multiprocessing
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
 
 import h5py
@@ -53,6 +54,8 @@ class StatsSubcommand(Subcommand):
     Obtain statistics about a given k-mer set.
     """
 
+    WRITE_BATCH_SIZE = 2**20
+
     def register_arguments(self, subparser: argparse.ArgumentParser):
         subparser.add_argument(
             'kmerset',
@@ -90,9 +93,18 @@ class StatsSubcommand(Subcommand):
             print(file=output)
 
         if counts:
-            for kmer, count in zip(kmerset.kmers, kmerset.counts):
-                print(kmertools.kmer_string(kmerset.k, int(kmer)), count,
-                      sep='\t', file=output)
+            # Decode k-mers in batches to limit memory usage
+            for start in range(0, kmerset.kmers.size, self.WRITE_BATCH_SIZE):
+                end = start + self.WRITE_BATCH_SIZE
+                rows = numpy.char.add(
+                    kmerset.kmer_strings(kmerset.kmers[start:end]),
+                    b"\t"
+                )
+                rows = numpy.char.add(
+                    rows, kmerset.counts[start:end].astype(bytes))
+
+                output.write(b"\n".join(rows.tolist()).decode())
+                output.write("\n")
 
         if histogram:
             kmerset.write_histogram(output)
@@ -138,6 +150,23 @@ class PlotSubcommand(Subcommand):
             logger.info("Created k-mer spectrum plot in file %s", output)
 
 
+class KmerizeRunner:
+    """
+    K-merize a single sequence file in a separate process. Used by
+    `KmerizeSubcommand` to process multiple input files in parallel.
+    """
+
+    def __init__(self, k):
+        self.k = k
+
+    def __call__(self, seq_file):
+        logger.info('K-merizing file %s...', seq_file)
+        kmerset = kmertools.KmerSet(self.k)
+        kmerset.kmerize_file(seq_file)
+
+        return kmerset
+
+
 class KmerizeSubcommand(Subcommand):
     """K-merize a given reference sequence or a sample read dataset."""
 
@@ -174,23 +203,96 @@ class KmerizeSubcommand(Subcommand):
             help="Prune singletons after accumulating this (can have suffix "
                  "of M or G)"
         )
+        subparser.add_argument(
+            "-t", "--threads", type=int, default=1,
+            help="Number of processes to use when k-merizing multiple input "
+                 "files. With a single input file, or when using --limit, "
+                 "--prune or --bloom-prefilter, the number of threads used "
+                 "to sort and count k-mers. Default: %(default)s."
+        )
+        subparser.add_argument(
+            "-b", "--bloom-prefilter", metavar="N",
+            help="Use a Bloom filter sized for about N distinct k-mers (can "
+                 "have suffix of M or G) to skip k-mers seen only once "
+                 "(likely sequencing errors) without storing them. Reduces "
+                 "memory usage for large read datasets. A small fraction of "
+                 "singletons may still pass the filter."
+        )
+        subparser.add_argument(
+            "--hdf5-chunk", type=int, default=kmertools.DEFAULT_HDF5_CHUNK,
+            metavar="N",
+            help="Number of k-mers per compressed HDF5 chunk. Default: "
+                 "%(default)s."
+        )
+        subparser.add_argument(
+            "--compression", choices=kmertools.HDF5_COMPRESSIONS,
+            default=kmertools.DEFAULT_HDF5_COMPRESSION,
+            help="HDF5 compression method. 'lz4' and 'bitshuffle' require "
+                 "the hdf5plugin package. Default: %(default)s."
+        )
 
     def __call__(self, k, sequences, output, limit=None, prune=None,
                  fingerprint_fraction=kmertools.DEFAULT_FINGERPRINT_FRACTION, filter=False,
-                 **kwargs):
+                 threads=1, hdf5_chunk=kmertools.DEFAULT_HDF5_CHUNK,
+                 bloom_prefilter=None,
+                 compression=kmertools.DEFAULT_HDF5_COMPRESSION, **kwargs):
+
+        if not kmertools.compression_available(compression):
+            logger.error("%s compression requires the hdf5plugin package. "
+                         "Install it or choose another compression method.",
+                         compression)
+            return 1
 
         kmerset = kmertools.KmerSet(k)
 
         limit = utils.parse_num_suffix(limit)
         prune = utils.parse_num_suffix(prune)
+        bloom_prefilter = utils.parse_num_suffix(bloom_prefilter)
+
+        bloom = None
+        if bloom_prefilter:
+            logger.info("Prefiltering singletons with a Bloom filter sized "
+                        "for %d k-mers.", bloom_prefilter)
+            bloom = kmertools.create_bloom_filter(bloom_prefilter)
+
+            if prune:
+                logger.warning("Singletons are already skipped by the Bloom "
+                               "filter, ignoring --prune.")
+                prune = 0
+
+        if limit:
+            logger.info("Processing at most about %d k-mers.", limit)
+        if prune:
+            logger.info("Pruning singletons when there are more than %d.",
+                        prune)
 
         if not output:
             logger.error("No output filename given! Please specify the output file with `-o`.")
             return 1
 
-        for seq in sequences:
-            logger.info('K-merizing file %s...', seq)
-            kmerset.kmerize_file(seq, limit=limit, prune=prune)
+        if (threads > 1 and len(sequences) > 1 and not limit and not prune
+                and not bloom):
+            # Each file is k-merized independently, the results are merged
+            # afterwards.
+            runner = KmerizeRunner(k)
+            with multiprocessing.Pool(min(threads, len(sequences))) as pool:
+                for file_kmerset in pool.imap_unordered(runner, sequences):
+                    kmerset.update(file_kmerset)
+        else:
+            if threads > 1 and len(sequences) > 1 and (limit or prune or
+                                                       bloom):
+                logger.warning("--limit, --prune and --bloom-prefilter apply "
+                               "to all input files combined, k-merizing "
+                               "files serially (sorting with %d threads).",
+                               threads)
+
+            for seq in sequences:
+                logger.info('K-merizing file %s...', seq)
+                kmerset.kmerize_file(seq, limit=limit, prune=prune,
+                                     bloom=bloom, threads=threads)
+
+            if bloom:
+                kmerset.add_prefiltered_occurrences()
 
         if filter:
             thresholds = kmerset.spectrum_filter()
@@ -204,7 +306,7 @@ class KmerizeSubcommand(Subcommand):
             kmerset.min_hash(fingerprint_fraction)
 
         logger.info("Writing k-merset to %s", output)
-        kmerset.save(output, compress=True)
+        kmerset.save(output, compress=compression, chunk_size=hdf5_chunk)
 
 
 class KmermergeSubcommand(Subcommand):
@@ -233,13 +335,15 @@ class KmermergeSubcommand(Subcommand):
                  fingerprint_fraction=kmertools.DEFAULT_FINGERPRINT_FRACTION, filter=False,
                  **kwargs):
 
-        kmerset = None
+        merger = kmertools.KmerSetMerger()
 
         for ksfile in kmerfiles:
             logger.info('Merging KmerSet file %s...', ksfile)
             ks = kmertools.kmerset_from_hdf5(ksfile)
             assert ks.k == k, "Incompatible kmer size {}".format(ks.k)
-            kmerset = kmerset.merge_kmerset(ks) if kmerset else ks
+            merger.add(ks)
+
+        kmerset = merger.result()
 
         if fingerprint_fraction:
             kmerset.min_hash(fingerprint_fraction)
@@ -250,55 +354,94 @@ class KmermergeSubcommand(Subcommand):
 
 class KmersimRunner:
     """
-    This class helps running the comparisons using multiprocessing. We cache
-    kmersets to make sure we don't have to reload them each time. It's
-    possible, however, that different processes have to cache the same
-    kmerset. By using a large enough chunksize (see
-    `KmersimSubcommand.__call__`) we aim to prevent that from happening too
-    often.
+    This class helps running the comparisons in parallel. k-mer sets are
+    loaded lazily when first needed, and shared between worker threads. The
+    k-mer intersection is computed in C++ without holding the GIL, so
+    threads run comparisons concurrently without copying any k-mer set. The
+    tasks are only pairs of indices into the list of k-mer sets.
+
+    At most `max_loaded` k-mer sets are kept in memory (least recently used
+    are evicted), by default all of them.
     """
 
-    def __init__(self, kmersets, scoring, fingerprint):
-        logger.info("Loading k-mer sets...")
+    def __init__(self, kmersets, scoring, fingerprint, max_loaded=None):
         with h5py.File(kmersets[0], 'r') as h5:
             self.k = h5.attrs['k']
 
-        load_func = kmertools.load_fingerprint if fingerprint else kmertools.load_kmers
-        self.kmersets = {
-            kmerset: load_func(kmerset, expect_k=self.k) for kmerset in kmersets
-        }
+        self.load_func = kmertools.load_fingerprint if fingerprint else kmertools.load_kmers
+        self.paths = kmersets
+        self.names = [kmertools.name_from_path(kmerset)
+                      for kmerset in kmersets]
+        self.get_kmerset = functools.lru_cache(maxsize=max_loaded)(
+            self.load_kmerset)
 
         self.scoring = scoring
+        self.compute_metrics = set(scoring)
+        if 'subset' in scoring:
+            self.compute_metrics.add('reference')
+
+    def load_kmerset(self, i):
+        logger.debug("Loading k-mer set %s...", self.paths[i])
+        return self.load_func(self.paths[i], expect_k=self.k)
 
-    def __call__(self, kmersets):
+    def __call__(self, pair):
         try:
-            set1, set2 = kmersets
+            i, j = pair
 
-            name1 = kmertools.name_from_path(set1)
-            name2 = kmertools.name_from_path(set2)
+            name1 = self.names[i]
+            name2 = self.names[j]
 
-            data1 = self.kmersets[set1]
-            data2 = self.kmersets[set2]
+            data1 = self.get_kmerset(i)
+            data2 = self.get_kmerset(j)
 
             logger.info("Comparing %s vs %s...", name1, name2)
 
-            scores = {
-                metric: comparison.similarity_score(data1, data2, metric)
-                for metric in self.scoring if metric != 'subset'
-            }
+            # All scores are derived from a single intersection
+            all_scores = comparison.similarity_scores(data1, data2,
+                                                      self.compute_metrics)
+            scores = {metric: all_scores[metric]
+                      for metric in self.scoring if metric != 'subset'}
 
             if 'jaccard' in scores:
                 scores['ani'] = comparison.ani(self.k, scores['jaccard'])
 
-            # Subset scores are not symmetric
+            # Subset scores are not symmetric, the subset score of set 2 in
+            # set 1 equals the 'reference' score.
             if 'subset' in self.scoring:
-                scores['subset1'] = comparison.subset(data1, data2)
-                scores['subset2'] = comparison.subset(data2, data1)
+                scores['subset1'] = all_scores['subset']
+                scores['subset2'] = all_scores['reference']
 
             return [name1, name2, scores]
         except KeyboardInterrupt:
             pass
 
+    def all_vs_all(self):
+        """
+        Compare all pairs of k-mer sets with a single call per scoring
+        metric, which loops over all pairs in C++. Requires all k-mer sets
+        in memory, and only supports the metrics in
+        `kmertools.SIMILARITY_MODES`. Returns the same results as calling
+        this runner for each pair.
+        """
+
+        kmersets = [self.get_kmerset(i) for i in range(len(self.paths))]
+
+        logger.info("Comparing all %d k-mer sets...", len(kmersets))
+        matrices = {metric: kmertools.similarity_matrix(kmersets, metric)
+                    for metric in self.scoring}
+
+        results = []
+        for i, j in itertools.combinations(range(len(kmersets)), 2):
+            scores = {metric: float(matrix[i, j])
+                      for metric, matrix in matrices.items()}
+
+            if 'jaccard' in scores:
+                scores['ani'] = comparison.ani(self.k, scores['jaccard'])
+
+            results.append([self.names[i], self.names[j], scores])
+
+        return results
+
 
 class KmersimSubCommand(Subcommand):
     """
@@ -306,6 +449,9 @@ class KmersimSubCommand(Subcommand):
     supported.
     """
 
+    # Number of output rows to collect before writing them to the output
+    WRITE_BATCH_SIZE = 4096
+
     def register_arguments(self, subparser: argparse.ArgumentParser):
         compare_group = subparser.add_mutually_exclusive_group(required=True)
         compare_group.add_argument(
@@ -332,9 +478,16 @@ class KmersimSubCommand(Subcommand):
         )
         subparser.add_argument(
             '-t', '--threads', type=int, default=1, required=False,
-            help="Use multiple processes the compute the similarity scores ("
+            help="Use multiple threads to compute the similarity scores ("
                  "default 1)."
         )
+        subparser.add_argument(
+            '-m', '--max-loaded', type=int, default=None, metavar='N',
+            help="Keep at most N k-mer sets in memory. k-mer sets are loaded "
+                 "when first needed, and by default kept in memory. Setting "
+                 "this reduces memory usage for large numbers of k-mer sets, "
+                 "at the cost of reading k-mer sets from disk multiple times."
+        )
         subparser.add_argument(
             '-o', '--output', type=argparse.FileType('w'), default=sys.stdout,
             metavar='FILE',
@@ -346,7 +499,7 @@ class KmersimSubCommand(Subcommand):
         )
 
     def __call__(self, strains, output, all_vs_all=False, sample=None,
-                 full_db=False, scoring=None, threads=1,
+                 full_db=False, scoring=None, threads=1, max_loaded=None,
                  fraction=False, **kwargs):
 
         if not scoring:
@@ -358,26 +511,46 @@ class KmersimSubCommand(Subcommand):
             sample_name = kmertools.name_from_path(sample)
             logger.info("Start %s vs all comparison...", sample_name)
 
+            # The sample is loaded as the last k-mer set
+            kmersets = [*strains, sample]
+            sample_ix = len(strains)
             to_compute_iter = (
-                (sample, strain) for strain in strains
+                (sample_ix, i) for i in range(len(strains))
             )
+            num_pairs = len(strains)
+            chunks_per_thread = 4
         elif all_vs_all:
             if scoring == "reference":
                 raise ValueError("'reference' scoring metric is meaningless in"
                                  " all-vs-all mode.")
 
             logger.info("Start computing pairwise similarities...")
-            to_compute_iter = itertools.combinations(strains, 2)
+            kmersets = strains
+            to_compute_iter = itertools.combinations(range(len(strains)), 2)
+            num_pairs = len(strains) * (len(strains) - 1) // 2
+            chunks_per_thread = 16
         else:
             logger.error("Either --sample or --all-vs-all required.")
             return 1
 
-        runner = KmersimRunner(strains, scoring, fingerprint)
-        if threads > 1:
-            pool = multiprocessing.Pool(threads)
-
-            scores = list(pool.imap_unordered(runner, to_compute_iter,
-                                              chunksize=2**16))
+        if max_loaded is not None and max_loaded < 2 * threads:
+            logger.warning("Keeping at least two k-mer sets per thread in "
+                           "memory.")
+            max_loaded = 2 * threads
+
+        runner = KmersimRunner(kmersets, scoring, fingerprint, max_loaded)
+        if (all_vs_all and threads == 1 and max_loaded is None and
+                all(m in kmertools.SIMILARITY_MODES for m in scoring)):
+            # No need to limit memory usage or spread pairs over threads, so
+            # compute all scores in one go.
+            scores = runner.all_vs_all()
+        elif threads > 1:
+            # Multiple chunks per thread to balance the load, comparisons
+            # of larger k-mer sets take longer.
+            chunksize = max(1, num_pairs // (threads * chunks_per_thread))
+            with ThreadPool(threads) as pool:
+                scores = list(pool.imap_unordered(runner, to_compute_iter,
+                                                  chunksize=chunksize))
         else:
             scores = list(map(runner, to_compute_iter))
 
@@ -386,22 +559,29 @@ class KmersimSubCommand(Subcommand):
         # Sort results
         # We use the first given scoring metric for sorting
         first_metric = scoring[0]
-        scores = sorted(scores, key=lambda e: e[2][first_metric], reverse=True)
+        sort_values = numpy.fromiter((e[2][first_metric] for e in scores),
+                                     dtype=numpy.float64, count=len(scores))
+        order = numpy.argsort(-sort_values, kind='stable')
+        scores = [scores[i] for i in order]
 
         # Write results
         logger.info("Writing results...")
-        scoring_keys = scores[0][2].keys()
+        scoring_keys = list(scores[0][2].keys())
         fieldnames = ["kmerset1", "kmerset2", *scoring_keys]
-        writer = csv.DictWriter(output, fieldnames, delimiter="\t",
-                                lineterminator="\n")
-        writer.writeheader()
+        output.write("\t".join(fieldnames) + "\n")
+
+        row_fmt = "%s\t%s" + "\t%.5f" * len(scoring_keys) + "\n"
+        rows = []
         for name1, name2, pair_score in scores:
-            data = {metric: f"{value:.5f}"
-                    for metric, value in pair_score.items()}
-            data['kmerset1'] = name1
-            data['kmerset2'] = name2
+            rows.append(row_fmt % (name1, name2, *(pair_score[metric]
+                                                   for metric in scoring_keys)))
 
-            writer.writerow(data)
+            # Write in batches instead of a write call per row
+            if len(rows) >= self.WRITE_BATCH_SIZE:
+                output.writelines(rows)
+                rows = []
+
+        output.writelines(rows)
 
         logger.info("Done.")
 
@@ -558,13 +738,32 @@ class CreateDBSubcommand(Subcommand):
                  "a given file (use '-' to denote standard input). This is in "
                  "addition to any k-merset given as positional argument."
         )
+        subparser.add_argument(
+            "--hdf5-chunk", type=int, default=kmertools.DEFAULT_HDF5_CHUNK,
+            metavar="N",
+            help="Number of k-mers per compressed HDF5 chunk. Default: "
+                 "%(default)s."
+        )
+        subparser.add_argument(
+            "--compression", choices=kmertools.HDF5_COMPRESSIONS,
+            default=kmertools.DEFAULT_HDF5_COMPRESSION,
+            help="HDF5 compression method. 'lz4' and 'bitshuffle' require "
+                 "the hdf5plugin package. Default: %(default)s."
+        )
         subparser.add_argument(
             'kmersets', metavar='kmerset', nargs='*',
             help="The HDF5 filenames of the kmerized reference strains."
         )
 
     def __call__(self, kmersets, from_file, output,
-                 **kwargs):
+                 hdf5_chunk=kmertools.DEFAULT_HDF5_CHUNK,
+                 compression=kmertools.DEFAULT_HDF5_COMPRESSION, **kwargs):
+        if not kmertools.compression_available(compression):
+            logger.error("%s compression requires the hdf5plugin package. "
+                         "Install it or choose another compression method.",
+                         compression)
+            return 1
+
         if from_file:
             for line in from_file:
                 kmersets.append(line.strip())
@@ -574,37 +773,40 @@ class CreateDBSubcommand(Subcommand):
                          "file, stopping.")
             return 1
 
-        pankmerset = None
+        pan_merger = kmertools.KmerSetMerger()
         fingerprint = True
-        panfingerprint = None
+        fingerprint_merger = kmertools.KmerSetMerger()
         fpf = None
 
         with h5py.File(output, 'w') as h5:
             for fname in kmersets:
                 name = kmertools.name_from_path(fname)
-                kset = kmertools.kmerset_from_hdf5(fname)
                 logger.info("Adding k-merset %s", name)
 
+                # Load the k-mer set and copy compressed chunks from the
+                # input file where possible
                 strain_group = h5.create_group(name)
-                kset.save_hdf5(strain_group, compress="gzip")
+                with h5py.File(kmertools.hdf5_path(fname), 'r',
+                               **kmertools.HDF5_READ_CACHE) as source:
+                    kset = kmertools.kmerset_from_h5(source)
+                    kset.save_hdf5(strain_group, compress=compression,
+                                   chunk_size=hdf5_chunk, source=source)
 
-                if not pankmerset:
-                    pankmerset = kset
-                else:
-                    pankmerset = pankmerset.merge_kmerset(kset)
+                pan_merger.add(kset)
 
                 if fingerprint:
                     if kset.fingerprint is not None:
                         fp = kset.fingerprint_as_kmerset()
-                        if not panfingerprint:
-                            panfingerprint = fp
+                        if fpf is None:
                             fpf = fp.fingerprint_fraction
-                        else:
-                            panfingerprint = panfingerprint.merge_kmerset(fp)
+                        fingerprint_merger.add(fp)
                     else:
                         logger.warning("Not all input kmersets have fingerprints, so no pan genome fingerprint will be generated")
                         fingerprint = False
 
+            pankmerset = pan_merger.result()
+            panfingerprint = fingerprint_merger.result() if fingerprint else None
+
             if fingerprint and panfingerprint is not None:
                 logger.info("Adding pan-genome fingerprint (%d distinct kmers)", panfingerprint.kmers.size)
                 pankmerset.fingerprint = panfingerprint.kmers
@@ -612,5 +814,6 @@ class CreateDBSubcommand(Subcommand):
                 pankmerset.fingerprint_fraction = fpf
 
             logger.info("Saving pan-genome database")
-            pankmerset.save_hdf5(h5, compress="gzip")
+            pankmerset.save_hdf5(h5, compress=compression,
+                                 chunk_size=hdf5_chunk)
             logger.info("Done.")
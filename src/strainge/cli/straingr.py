@@ -49,10 +49,12 @@ from strainge.variant_caller import (VariantCaller, Reference,
 from strainge.sample_compare import SampleComparison
 from strainge.io.variants import (call_data_from_hdf5, call_data_to_hdf5,
                                   boolean_array_to_bedfile,  write_vcf,
+                                  read_bed_regions,
                                   generate_call_summary_tsv, array_to_wig)
 from strainge.io.comparisons import (generate_compare_summary_tsv,
                                      generate_compare_details_tsv)
-from strainge.io.utils import open_compressed, parse_straingst
+from strainge.io.utils import (open_compressed, parse_straingst,
+                               htslib_has_libdeflate)
 from strainge.cli.registry import Subcommand
 from strainge import cluster
 
@@ -149,7 +151,7 @@ class PrepareRefSubcommand(Subcommand):
 
             for fpath in straingst_files:
                 logger.debug("Reading %s", fpath)
-                with open(fpath) as f:
+                with open_compressed(fpath) as f:
                     straingst_counter.update(strain['strain'] for strain in
                                              parse_straingst(f))
 
@@ -364,6 +366,28 @@ class CallSubcommand(Subcommand):
                  "reference"
         )
 
+        subparser.add_argument(
+            '-T', '--threads', type=int, default=1,
+            help="Number of threads used to analyze scaffolds concurrently. "
+                 "Pileups are processed in this many worker processes. "
+                 "(default: %(default)d)"
+        )
+
+        subparser.add_argument(
+            '--reference-cache', default=None, metavar='DIR',
+            help="Cache the parsed reference sequences in this directory, "
+                 "which speeds up later runs with the same reference. The "
+                 "cache is only used if the reference is unchanged."
+        )
+
+        subparser.add_argument(
+            '-R', '--regions-bed', default=None, metavar='BED',
+            help="Only call variants in the regions listed in the given BED "
+                 "file. Coverage statistics and gaps are computed within "
+                 "these regions only. Reads outside these regions are still "
+                 "used for read QC and abundance estimation."
+        )
+
         call_qc_group = subparser.add_argument_group(
             'Quality control',
             'Options which determine which reads to consider, when base or '
@@ -453,19 +477,30 @@ class CallSubcommand(Subcommand):
                  min_mapping_qual, min_gap, max_mismatches,
                  summary=None, hdf5_out=None,
                  vcf=None, verbose_vcf=False,
-                 tracks=None, track_min_size=1, **kwargs):
+                 tracks=None, track_min_size=1, threads=1,
+                 regions_bed=None, reference_cache=None, **kwargs):
         """Call variants in a mixed-strain sample."""
 
         logger.info("Loading reference %s...", reference)
-        reference = Reference(reference)
+        reference = Reference(reference, reference_cache)
         logger.info("Reference length: %d", reference.length)
-        sample_bam = pysam.AlignmentFile(sample)
+        sample_bam = pysam.AlignmentFile(sample, threads=threads)
+        if htslib_has_libdeflate() is False:
+            logger.info("pysam's htslib was built without libdeflate, BAM "
+                        "decompression will use the slower zlib.")
+
+        regions = None
+        if regions_bed:
+            logger.info("Restricting variant calling to regions in %s",
+                        regions_bed)
+            regions = read_bed_regions(regions_bed)
 
         logger.info("Start analyzing aligned reads...")
         caller = VariantCaller(min_qual, min_pileup_qual, min_qual_frac,
-                               min_mapping_qual, min_gap, max_mismatches)
+                               min_mapping_qual, min_gap, max_mismatches,
+                               threads)
 
-        call_data = caller.process(reference, sample_bam)
+        call_data = caller.process(reference, sample_bam, regions)
 
         # Output call datasets to HDF5
         logger.info("Writing data to HDF5 file %s...", hdf5_out)
@@ -28,12 +28,11 @@
 #
 
 from __future__ import annotations
-import csv
 import sys
 import logging
 import argparse
+import operator
 from pathlib import Path
-from dataclasses import asdict
 
 from strainge.search_tool import StrainGST, PanGenome, Sample
 from strainge.cli.registry import Subcommand
@@ -67,6 +66,15 @@ strain_tsv_columns = dict([
     ("score", "%.3f"),
 ])
 
+# Pre-built row templates, each row is formatted with a single `%` operation
+SAMPLE_STATS_KEYS = tuple(sample_stats_tsv_columns.keys())
+SAMPLE_STATS_FMT = "\t".join(sample_stats_tsv_columns.values()) + "\n"
+
+STRAIN_KEYS = tuple(strain_tsv_columns.keys())
+STRAIN_FMT = "\t".join(strain_tsv_columns.values()) + "\n"
+# All columns except the position 'i' are attributes of `Strain`
+STRAIN_GETTER = operator.attrgetter(*STRAIN_KEYS[1:])
+
 
 class StrainGSTSubCommand(Subcommand):
     """
@@ -124,6 +132,10 @@ class StrainGSTSubCommand(Subcommand):
             help="Exclude Kmers occurring more often in the sample than this times the mean pangenome kmer frequency "
                  "(default: %(default).d)"
         )
+        subparser.add_argument(
+            "-T", "--threads", type=int, default=1,
+            help="Number of threads used to score strains (default: %(default)d)"
+        )
         subparser.add_argument(
             "-S", "--score-strains", action='append',
             help="Only score these strains (primarily for debugging)"
@@ -139,7 +151,7 @@ class StrainGSTSubCommand(Subcommand):
 
     def __call__(self, pan, sample, output, separate_output, debug_out, iterations, top,
                  fulldb, minfrac, score, evenness, minacct, universal, score_strains,
-                 *args, **kwargs):
+                 threads=1, *args, **kwargs):
 
         logger.info("Running StrainGST on sample %s with database %s",
                     sample, pan)
@@ -155,7 +167,8 @@ class StrainGSTSubCommand(Subcommand):
             return 1
 
         straingst = StrainGST(pandb, fulldb, iterations, top, score,
-                              evenness, universal, minfrac, minacct, debug_out)
+                              evenness, universal, minfrac, minacct, debug_out,
+                              threads)
 
         results = straingst.find_close_references(sample_kmerset,
                                                   score_strains=score_strains)
@@ -188,9 +201,7 @@ class StrainGSTSubCommand(Subcommand):
                     self.write_strains(f, results)
 
     def write_sample_stats(self, output, sample_kmerset, results):
-
-        writer = csv.writer(output, delimiter='\t', lineterminator='\n')
-        writer.writerow(list(sample_stats_tsv_columns.keys()))
+        output.write("\t".join(SAMPLE_STATS_KEYS) + "\n")
 
         # First output some sample stats
         values = {
@@ -203,21 +214,13 @@ class StrainGSTSubCommand(Subcommand):
         }
 
         # Format to string according to format
-        v = [sample_stats_tsv_columns[col] % values[col]
-             for col in sample_stats_tsv_columns.keys()]
-        writer.writerow(v)
+        output.write(SAMPLE_STATS_FMT % tuple(values[col]
+                                              for col in SAMPLE_STATS_KEYS))
 
     def write_strains(self, output, results):
-        writer = csv.writer(output, delimiter='\t', lineterminator='\n')
-
         # Output found strains
-        writer.writerow(list(strain_tsv_columns.keys()))
+        output.write("\t".join(STRAIN_KEYS) + "\n")
         for pos, strain in results.strains:
-            values = asdict(strain)
-            values['i'] = pos
-
-            v = [strain_tsv_columns[col] % values[col]
-                 for col in strain_tsv_columns]
-            writer.writerow(v)
+            output.write(STRAIN_FMT % ((pos, ) + STRAIN_GETTER(strain)))
 
         logger.info("Done.")
@@ -33,6 +33,8 @@ from collections import defaultdict
 
 import numpy
 import pandas
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 
 logger = logging.getLogger(__name__)
 
@@ -61,47 +63,46 @@ def similarities_to_matrix(similarities, labels, metric='jaccard'):
 
 
 def cluster_genomes(similarities, labels, threshold, metric='jaccard'):
-    label_to_cluster = {
-        label: i for i, label in enumerate(labels)
-    }
-
-    # Start with a situation where each genome is its own cluster
-    clusters = {
-        i: [label] for i, label in enumerate(labels)
-    }
-
-    # Assumes `similarities` is sorted
-    for label1, label2 in similarities.index:
-        similarity = similarities.loc[(label1, label2), metric]
-
-        logger.info("Checking %s vs %s, similarity: %g", label1, label2,
-                    similarity)
-
-        if similarity < threshold:
-            logger.info("Similarity dropped below threshold %g, stopping",
-                        threshold)
-            break
-
-        if label1 not in label_to_cluster or label2 not in label_to_cluster:
-            # Excluded by subset step
+    """Group genomes in single-linkage clusters: two genomes end up in the
+    same cluster if they are connected through a chain of pairs with
+    similarity of at least `threshold`.
+
+    Clusters are the connected components of the graph with an edge for each
+    such pair. Pairs with labels not in `labels` (e.g., excluded by the
+    subset step) are ignored.
+
+    Returns a dictionary mapping a cluster ID (the index of the first label
+    in the cluster) to the list of labels in that cluster.
+    """
+    label_index = pandas.Index(labels)
+    ix1 = label_index.get_indexer(similarities.index.get_level_values(0))
+    ix2 = label_index.get_indexer(similarities.index.get_level_values(1))
+    values = similarities[metric].to_numpy()
+
+    edges = (values >= threshold) & (ix1 >= 0) & (ix2 >= 0)
+    logger.info("%d pairs with similarity >= %g", numpy.count_nonzero(edges),
+                threshold)
+
+    num_labels = len(labels)
+    graph = csr_matrix(
+        (numpy.ones(numpy.count_nonzero(edges), dtype=numpy.int8),
+         (ix1[edges], ix2[edges])),
+        shape=(num_labels, num_labels)
+    )
+    _, components = connected_components(graph, directed=False)
+
+    # Group label indices by component, within a component ordered by index
+    order = numpy.argsort(components, kind='stable')
+    boundaries = numpy.flatnonzero(numpy.diff(components[order])) + 1
+
+    clusters = {}
+    for members in numpy.split(order, boundaries):
+        if members.size == 0:
             continue
 
-        cluster1 = label_to_cluster[label1]
-        cluster2 = label_to_cluster[label2]
-
-        if cluster1 == cluster2:
-            # Already in same cluster, skipping
-            continue
-
-        clusters[cluster1].extend(clusters[cluster2])
-
-        # Make sure we remember in which cluster each entry lives
-        for entry in clusters[cluster2]:
-            label_to_cluster[entry] = cluster1
-
-        del clusters[cluster2]
+        clusters[int(members[0])] = [labels[i] for i in members]
 
-    return clusters
+    return dict(sorted(clusters.items()))
 
 
 def pick_representative(clusters, similarities, priorities=None,
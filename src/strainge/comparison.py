@@ -35,35 +35,35 @@ from strainge import kmerizer
 def jaccard(kmers1, kmers2):
     """Computes jaccard similarity. Returns numerator and denominator
     separately."""
-    intersection = kmerizer.count_common(kmers1, kmers2)
-    return intersection / (kmers1.size + kmers2.size - intersection)
+    intersection, union = kmerizer.intersect_sorted_u64(kmers1, kmers2)
+    return intersection / union
 
 
 def minsize(kmers1, kmers2):
-    intersection = kmerizer.count_common(kmers1, kmers2)
+    intersection, _ = kmerizer.intersect_sorted_u64(kmers1, kmers2)
     return intersection / min(kmers1.size, kmers2.size)
 
 
 def meansize(kmers1, kmers2):
-    intersection = kmerizer.count_common(kmers1, kmers2)
+    intersection, _ = kmerizer.intersect_sorted_u64(kmers1, kmers2)
     return intersection / ((kmers1.size + kmers2.size) / 2)
 
 
 def maxsize(kmers1, kmers2):
-    intersection = kmerizer.count_common(kmers1, kmers2)
+    intersection, _ = kmerizer.intersect_sorted_u64(kmers1, kmers2)
     return intersection / max(kmers1.size, kmers2.size)
 
 
 def subset(kmers1, kmers2):
     """Calculate the fraction of k-mers in k-merset 1 that are also in k-merset
     2, useful to check whether k-merset 1 is a subset of another."""
-    intersection = kmerizer.count_common(kmers1, kmers2)
+    intersection, _ = kmerizer.intersect_sorted_u64(kmers1, kmers2)
     return intersection / kmers1.size
 
 
 def reference(kmers1, kmers2):
     """Assume k-merset 2 is the k-merset of a reference genome."""
-    intersection = kmerizer.count_common(kmers1, kmers2)
+    intersection, _ = kmerizer.intersect_sorted_u64(kmers1, kmers2)
     return intersection / kmers2.size
 
 
@@ -77,6 +77,37 @@ def similarity_score(kmers1, kmers2, scoring="jaccard"):
     return SCORING_METHODS[scoring](kmers1, kmers2)
 
 
+# Scoring methods expressed in terms of the number of common k-mers and the
+# sizes of both k-mer sets, to compute multiple scores from one intersection.
+SCORES_FROM_COUNTS = {
+    'jaccard': lambda common, size1, size2: common / (size1 + size2 - common),
+    'minsize': lambda common, size1, size2: common / min(size1, size2),
+    'meansize': lambda common, size1, size2: common / ((size1 + size2) / 2),
+    'maxsize': lambda common, size1, size2: common / max(size1, size2),
+    'subset': lambda common, size1, size2: common / size1,
+    'reference': lambda common, size1, size2: common / size2,
+}
+
+
+def similarity_scores(kmers1, kmers2, scoring):
+    """Compute multiple similarity scores between two k-mer sets, while
+    counting the common k-mers only once.
+
+    Returns a dictionary with the score for each given scoring method."""
+    for method in scoring:
+        if method not in SCORES_FROM_COUNTS:
+            raise ValueError("Invalid scoring method '{}'".format(method))
+
+    common, _ = kmerizer.intersect_sorted_u64(kmers1, kmers2)
+    size1 = kmers1.size
+    size2 = kmers2.size
+
+    return {
+        method: SCORES_FROM_COUNTS[method](common, size1, size2)
+        for method in scoring
+    }
+
+
 def ani(k, j):
     """Estimate average nucleotide identity from Jaccard distance between
     two k-mer sets. Also known as mash [1] distance.
@@ -27,30 +27,118 @@
 #  POSSIBILITY OF SUCH DAMAGE.
 #
 
+import io
 import csv
+import ctypes
 import bz2
 import gzip
+import shutil
+import subprocess
 from typing import List, Iterable  # noqa
 from pathlib import Path
 from contextlib import contextmanager
-from itertools import chain
+from operator import methodcaller
+from itertools import chain, filterfalse
+
+# Buffer size for reading (decompressed) sequence files
+READ_BUFFER_SIZE = 128 * 1024
+
+# External (multi-threaded) decompression tools, in order of preference.
+# Each is called as `<tool> -dc <file>`.
+DECOMPRESS_TOOLS = {
+    ".gz": ("pigz", ),
+    ".bz2": ("lbzip2", "pbzip2"),
+}
+
+
+# htslib's `hts_features()` bit for libdeflate support
+HTS_FEATURE_LIBDEFLATE = 1 << 20
+
+
+def htslib_has_libdeflate():
+    """
+    Check whether the htslib bundled with pysam was built with libdeflate,
+    which decompresses BAM files considerably faster than zlib.
+
+    Returns None if this can't be determined.
+    """
+    try:
+        import pysam.libchtslib
+        lib = ctypes.CDLL(pysam.libchtslib.__file__)
+        lib.hts_features.restype = ctypes.c_uint
+        return bool(lib.hts_features() & HTS_FEATURE_LIBDEFLATE)
+    except (ImportError, OSError, AttributeError):
+        return None
+
+
+def _buffered(raw, binary=False):
+    """Wrap a binary (decompressing) file object in a large read buffer, and
+    decode it as text unless `binary` is True. Decompressors otherwise get
+    many small read requests."""
+    buffered = io.BufferedReader(raw, buffer_size=READ_BUFFER_SIZE)
+    return buffered if binary else io.TextIOWrapper(buffered)
+
+
+def _open_gz(filename):
+    """Open a gzip compressed file in binary mode, using python-isal when
+    available (much faster than zlib), falling back to the gzip module."""
+    try:
+        from isal import igzip
+    except ImportError:
+        return gzip.open(filename, "rb")
+    else:
+        return igzip.open(filename, "rb")
+
+
+def _decompress_command(filename):
+    """Return the command to decompress the given file with an external
+    tool, or None if no suitable tool is installed."""
+    for tool in DECOMPRESS_TOOLS.get(filename.suffix, ()):
+        executable = shutil.which(tool)
+        if executable:
+            return [executable, "-dc", str(filename)]
+
+    return None
 
 
 @contextmanager
-def open_compressed(filename):
+def open_compressed(filename, stream=False, binary=False):
+    """Open a possibly compressed file in text mode, or in binary mode if
+    `binary` is True.
+
+    If `stream` is True, the caller only reads the file sequentially, and
+    compressed files may be decompressed by an external tool (pigz, lbzip2,
+    pbzip2) through a pipe. The returned file object is not seekable in
+    that case.
+    """
     if not isinstance(filename, Path):
         filename = Path(filename)
 
-    if filename.suffix == ".gz":
-        f = gzip.open(filename, "rt")
+    proc = None
+    command = _decompress_command(filename) if stream else None
+    if command:
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                bufsize=READ_BUFFER_SIZE)
+        f = proc.stdout if binary else io.TextIOWrapper(proc.stdout)
+    elif filename.suffix == ".gz":
+        f = _buffered(_open_gz(filename), binary)
     elif filename.suffix == ".bz2":
-        f = bz2.open(filename, "rt")
+        f = _buffered(bz2.open(filename, "rb"), binary)
     else:
-        f = open(filename)
+        f = open(filename, "rb" if binary else "r",
+                 buffering=READ_BUFFER_SIZE)
 
-    yield f
+    try:
+        yield f
+    finally:
+        # Only check the exit status of the decompression tool if all
+        # output was read, otherwise it was terminated by closing the pipe.
+        at_eof = proc is not None and not f.closed and not f.read(1)
+        f.close()
 
-    f.close()
+        if proc is not None and proc.wait() != 0 and at_eof:
+            raise IOError("Error decompressing {} with {}".format(
+                filename, command[0]))
 
 
 def read_fastq(fp):
@@ -102,7 +190,7 @@ def parse_straingst(result_file, return_sample_stats=False):
     """
 
     # Ignore comments
-    result_file = (line for line in result_file if not line.startswith('#'))
+    result_file = filterfalse(methodcaller('startswith', '#'), result_file)
     first_line = next(result_file)
 
     old_style_straingst = False
@@ -119,7 +207,8 @@ def parse_straingst(result_file, return_sample_stats=False):
         sample_stats = []
 
     if sample_stats and return_sample_stats:
-        sample_stats = next(csv.DictReader(sample_stats, delimiter='\t'))
+        header, values = csv.reader(sample_stats, delimiter='\t')
+        sample_stats = dict(zip(header, values))
 
         # Return sample statistics
         yield sample_stats
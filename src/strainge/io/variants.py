@@ -37,7 +37,9 @@ import numpy
 import pysam
 
 from strainge.utils import find_consecutive_groups
-from strainge.variant_caller import Allele, VariantCallData
+from strainge.io.utils import open_compressed
+from strainge.variant_caller import (Allele, ALLELE_INDEX_FWD, INDEX_ALLELES,
+                                     INVALID_ALLELE_INDEX, VariantCallData)
 
 logger = logging.getLogger(__name__)
 
@@ -112,8 +114,12 @@ def call_data_to_hdf5(call_data, output_file):
 
             scaffold_grp.create_dataset(
                 "refmask", data=scaffold.refmask, compression=9)
+            # Counts and quality sums are stored together in a single
+            # dataset with shape (length, 2, num_alleles)
+            alleles = numpy.stack(
+                [scaffold.allele_counts, scaffold.allele_quals], axis=1)
             scaffold_grp.create_dataset(
-                "alleles", data=scaffold.alleles, compression=9)
+                "alleles", data=alleles, compression=9)
             scaffold_grp.create_dataset(
                 "bad", data=scaffold.bad, compression=9)
             scaffold_grp.create_dataset(
@@ -128,6 +134,9 @@ def call_data_to_hdf5(call_data, output_file):
                 "coverage", data=scaffold.coverage, compression=9)
             scaffold_grp.create_dataset(
                 "high_coverage", data=scaffold.high_coverage, compression=9)
+            if scaffold.region_mask is not None:
+                scaffold_grp.create_dataset(
+                    "region_mask", data=scaffold.region_mask, compression=9)
 
             scaffold_grp.attrs["mean_coverage"] = scaffold.mean_coverage
             scaffold_grp.attrs["median_coverage"] = scaffold.median_coverage
@@ -164,10 +173,11 @@ def call_data_from_hdf5(hdf5_file, new_min_gap=None) -> VariantCallData:
     VariantCallData
     """
     datasets = {"refmask", "alleles", "bad", "lowmq_count",
-                "mq_sum", "strong", "weak", "coverage", "high_coverage"}
+                "mq_sum", "strong", "weak", "coverage", "high_coverage",
+                "region_mask"}
 
     # These datasets have pre-allocated numpy arrays in `VariantCallData`
-    read_direct = {"alleles", "bad", "lowmq_count", "mq_sum"}
+    read_direct = {"bad", "lowmq_count", "mq_sum"}
 
     with h5py.File(hdf5_file, 'r') as hdf5:
         if 'type' not in hdf5.attrs:
@@ -197,7 +207,11 @@ def call_data_from_hdf5(hdf5_file, new_min_gap=None) -> VariantCallData:
                 logger.info("Loading dataset '%s' for scaffold '%s' from "
                             "HDF5...", dataset_name, scaffold_name)
 
-                if dataset_name in read_direct:
+                if dataset_name == "alleles":
+                    arr = hdf5[scaffold_name][dataset_name][()]
+                    scaffold.allele_counts[:] = arr[:, 0]
+                    scaffold.allele_quals[:] = arr[:, 1]
+                elif dataset_name in read_direct:
                     target = getattr(scaffold, dataset_name)
                     hdf5[scaffold_name][dataset_name].read_direct(target)
                 else:
@@ -293,6 +307,43 @@ def boolean_array_to_bedfile(array, output_file, scaffold_name,
         writer.writerow((scaffold_name, start, end))
 
 
+def read_bed_regions(bed_file):
+    """
+    Read the regions from a BED file.
+
+    Regions are sorted, and overlapping or adjacent regions on the same
+    scaffold are merged, so each position is included at most once.
+
+    Parameters
+    ----------
+    bed_file : str or Path
+        Path to a BED file, can be compressed.
+
+    Returns
+    -------
+    list
+        Tuples of (scaffold, start, end), with 0-based half-open coordinates.
+    """
+
+    regions = []
+    with open_compressed(bed_file) as f:
+        for row in csv.reader(f, delimiter='\t'):
+            if not row or row[0].startswith(("#", "track", "browser")):
+                continue
+
+            regions.append((row[0], int(row[1]), int(row[2])))
+
+    merged = []
+    for scaffold, start, end in sorted(regions):
+        if merged and merged[-1][0] == scaffold and start <= merged[-1][2]:
+            prev_scaffold, prev_start, prev_end = merged[-1]
+            merged[-1] = (scaffold, prev_start, max(prev_end, end))
+        else:
+            merged.append((scaffold, start, end))
+
+    return merged
+
+
 def array_to_bedgraph(array, output_file, scaffold_name):
     """
     Export a numpy array to BedGraph format, which can be visualized in
@@ -351,53 +402,55 @@ def vcf_records_for_scaffold(writer, scaffold, verboseness=0):
     """
 
     logger.info("Generate VCF records for scaffold %s", scaffold.name)
-    positions = numpy.arange(scaffold.length)
 
     # Find positions with something else than the reference base
     # Remove bit corresponding to reference base
-    if verboseness == 0:
-        alt_mask = scaffold.strong & ~scaffold.refmask
-    else:
-        alt_mask = scaffold.weak & ~scaffold.refmask
+    called = scaffold.strong if verboseness == 0 else scaffold.weak
+    alt_mask = called & ~scaffold.refmask
 
     # Only keep those with something else than the reference
-    ix = alt_mask > 0
-    positions = positions[ix]
+    positions = numpy.flatnonzero(alt_mask)
 
-    for pos in positions:
-        alts = []
-        alts_bit = []
-        strong = set()
+    # Per position statistics for all selected positions at once
+    counts = scaffold.allele_counts[positions]
+    quals = scaffold.allele_quals[positions]
+    depths = counts.sum(axis=-1)
+    qual_totals = quals.sum(axis=-1)
 
-        # Check for alternative alleles (i.e. not the reference base)
-        for allele in Allele:
-            called_alleles = (scaffold.strong[pos] if verboseness == 0 else
-                              scaffold.weak[pos])
-            if (allele & called_alleles and
-                    not allele & scaffold.refmask[pos]):
-                alts_bit.append(allele)
-
-                if allele & (Allele.INS | Allele.DEL):
-                    alts.append(str(allele))
-                else:
-                    alts.append(str(allele))
+    refs = scaffold.refmask[positions]
+    ref_ix = numpy.array(ALLELE_INDEX_FWD, dtype=numpy.uint8)[refs]
+    ref_quals = quals[numpy.arange(len(positions)),
+                      numpy.where(refs > 0, ref_ix, 0)]
 
-            # We don't check if this is the refbase or not because we also want
-            # to include information whether the reference is strongly
-            # confirmed or not.
-            if allele & scaffold.strong[pos]:
-                strong.add(allele)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        ref_fractions = ref_quals / qual_totals
+        mean_mqs = numpy.where(depths > 0,
+                               scaffold.mq_sum[positions] / depths, 0)
+
+    # Alleles with their bit value as plain int, bitwise operations on the
+    # `Allele` flags themselves are much slower
+    allele_bits = [(allele, int(allele)) for allele in INDEX_ALLELES]
+
+    for i, pos in enumerate(positions.tolist()):
+        called_alleles = int(called[pos])
+        strong_alleles = int(scaffold.strong[pos])
+        ref = int(refs[i])
+
+        # Check for alternative alleles (i.e. not the reference base)
+        alt_alleles = called_alleles & ~ref
+        alts_bit = [allele for allele, bit in allele_bits
+                    if bit & alt_alleles]
 
-        ref = scaffold.refmask[pos]
         ref_plus_alts = [Allele(ref)] + alts_bit
+        indices = [ALLELE_INDEX_FWD[allele] for allele in ref_plus_alts]
 
         allele_counts = [
-            int(scaffold.allele_count(pos, allele)) if allele else 0
-            for allele in ref_plus_alts
+            int(counts[i, ix]) if ix != INVALID_ALLELE_INDEX else 0
+            for ix in indices
         ]
         allele_quals = [
-            int(scaffold.allele_qual(pos, allele)) if allele else 0
-            for allele in ref_plus_alts
+            int(quals[i, ix]) if ix != INVALID_ALLELE_INDEX else 0
+            for ix in indices
         ]
 
         sum_quals = sum(allele_quals)
@@ -406,18 +459,21 @@ def vcf_records_for_scaffold(writer, scaffold, verboseness=0):
         else:
             weighted_base_freqs = [0] * len(ref_plus_alts)
 
-        ref_qual = scaffold.ref_qual(pos) if ref else 0
-        ref_fraction = round(scaffold.ref_fraction(pos), 3) if ref else 0.0
+        ref_qual = ref_quals[i] if ref else 0
+        ref_fraction = round(ref_fractions[i], 3) if ref else 0.0
 
         info_dict = {
-            'DP': int(scaffold.depth(pos)),
+            'DP': int(depths[i]),
             'RQ': int(ref_qual),
-            'MQ': int(round(scaffold.mean_mq(pos))),
+            'MQ': int(round(mean_mqs[i])),
             'RF': ref_fraction,
             'AD': allele_counts,
             'QS': allele_quals,
             'BF': weighted_base_freqs,
-            'ST': [int(b in strong) for b in ref_plus_alts]
+            # We don't check if this is the refbase or not because we also
+            # want to include information whether the reference is strongly
+            # confirmed or not.
+            'ST': [int(bool(int(b) & strong_alleles)) for b in ref_plus_alts]
         }
         record = writer.new_record(
             scaffold.name,
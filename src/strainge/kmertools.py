@@ -28,16 +28,24 @@
 #
 
 import os
+import mmap
 import logging
+import weakref
+from multiprocessing.pool import ThreadPool
 
 import h5py
 import pysam
-import skbio
 import numpy as np
 import matplotlib.pyplot as plt
 
+try:
+    # Registers additional HDF5 compression filters (e.g. LZ4) with h5py
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
 from strainge import kmerizer
-from strainge.io.utils import open_compressed, read_fastq
+from strainge.io.utils import open_compressed
 
 logger = logging.getLogger(__name__)
 
@@ -45,6 +53,54 @@ DEFAULT_K = 23
 DEFAULT_FINGERPRINT_FRACTION = 0.01
 OLD_FINGERPRINT_FRACTION = 0.002
 
+# Number of elements per HDF5 chunk for k-mer and count datasets (1 MB of
+# 64-bit k-mers, which matches the default HDF5 chunk cache size)
+DEFAULT_HDF5_CHUNK = 2**17
+
+# Compression for k-mer set HDF5 files. gzip level 1 compresses shuffled,
+# sorted k-mers almost as well as the default level 4, but is a lot faster.
+# 'lzf' is faster still. 'lz4' and 'bitshuffle' (bit-level shuffle followed
+# by LZ4, which suits the small high-order bits of sorted k-mers and counts
+# well) require the hdf5plugin package.
+DEFAULT_HDF5_COMPRESSION = "gzip"
+HDF5_COMPRESSIONS = ("gzip", "lzf", "lz4", "bitshuffle")
+HDF5PLUGIN_COMPRESSIONS = ("lz4", "bitshuffle")
+GZIP_LEVEL = 1
+
+# Fastest available compression, for files where write speed matters more
+# than size
+FAST_HDF5_COMPRESSION = "bitshuffle" if hdf5plugin is not None else "lzf"
+
+# HDF5 raw data chunk cache settings when reading whole k-mer sets, large
+# enough to keep all chunks of a typical k-mer set in memory (the default
+# is 1 MB). The number of slots should be a prime number about 100 times
+# the number of chunks that fit in the cache.
+HDF5_READ_CACHE = {
+    'rdcc_nbytes': 64 * 2**20,
+    'rdcc_nslots': 10007,
+}
+
+# k-mer counts are unsigned 32-bit integers, both in memory and on disk (the
+# C++ extension uses the same type). Counts above the maximum are saturated,
+# which is far above any realistic k-mer count and halves the size of the
+# counts compared to 64-bit integers.
+COUNT_DTYPE = np.uint32
+MAX_COUNT = np.iinfo(COUNT_DTYPE).max
+
+# Sorting a batch of k-mers in parallel needs an extra k-way merge of the
+# sorted chunks, which only pays off with enough threads, and enough k-mers
+# per thread.
+PARALLEL_SORT_MIN_THREADS = 4
+PARALLEL_SORT_MIN_CHUNK = 2**20
+
+# Largest k-mer count for which the count spectrum is computed with a
+# histogram (np.bincount) instead of sorting all counts
+SPECTRUM_BINCOUNT_MAX = 2**24
+
+# Bloom filter parameters for prefiltering singletons during k-merization
+BLOOM_BITS_PER_KMER = 8
+BLOOM_NUM_HASHES = 4
+
 A = 0
 C = 1
 G = 2
@@ -52,10 +108,38 @@ T = 3
 
 BASES = "ACGT"
 
+# Characters to remove from FASTA sequence data
+FASTA_WHITESPACE = b"\r\n\t "
+# Number of bytes to read at once when parsing (compressed) FASTA files
+FASTA_BLOCK_SIZE = 2**20
+
+
+# The four bases encoded by each possible byte of a k-mer
+BYTE_BASES = [
+    BASES[(i >> 6) & 3] + BASES[(i >> 4) & 3] + BASES[(i >> 2) & 3]
+    + BASES[i & 3] for i in range(256)
+]
+
 
 def kmer_string(k, kmer):
-    seq = ''.join([BASES[(kmer >> (2 * k)) & 3] for k in range(k - 1, -1, -1)])
-    return seq
+    # Align the first base to the most significant bits, and decode four
+    # bases per byte
+    kmer_bytes = (int(kmer) << (64 - 2 * k)).to_bytes(8, 'big')
+    seq = ''.join([BYTE_BASES[b] for b in kmer_bytes[:(k + 3) // 4]])
+    return seq[:k]
+
+
+def decode_kmers(kmers, k):
+    """Convert an array of k-mers to their nucleotide sequences using NumPy
+    operations only. Returns an array of byte strings (dtype S<k>)."""
+    kmers = np.asarray(kmers, dtype=np.uint64)
+    shifts = np.arange(2 * (k - 1), -1, -2, dtype=np.uint64)
+
+    # Each row contains the 2-bit codes of a single k-mer
+    codes = ((kmers[:, np.newaxis] >> shifts) & 3).astype(np.uint8)
+    chars = np.frombuffer(BASES.encode(), dtype=np.uint8)[codes]
+
+    return np.ascontiguousarray(chars).view(f"S{k}").ravel()
 
 
 def iter_sequences_bam(bamfile):
@@ -72,16 +156,133 @@ def iter_sequences_bam(bamfile):
     bam.close()
 
 
-def iter_sequences_fasta(f):
-    """Use scikit-bio to iterate over FASTA sequences."""
+def iter_sequences_fasta(f, block_size=FASTA_BLOCK_SIZE):
+    """Iterate over sequences in a FASTA file opened in binary mode.
+
+    The file is read in large blocks, which are split on record boundaries,
+    so there is no per-line Python work. Yields each sequence as bytes, with
+    line breaks removed.
+    """
+
+    # Parts of the current record (without the leading '>'), joined once the
+    # record ends. Only the new block is searched for record boundaries, so
+    # long records aren't copied and rescanned for every block.
+    parts = []
+    # Whether the current data belongs to a record, or is located before
+    # the first header. Unknown until the first block is read.
+    in_record = None
+    first_record = True
+    last_byte = b""
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+
+        start = 0
+        if in_record is None:
+            in_record = block.startswith(b">")
+            start = int(in_record)
+        elif last_byte == b"\n" and block.startswith(b">"):
+            # Record boundary right between the previous block and this one
+            if in_record:
+                yield _fasta_record_sequence(b"".join(parts))
+
+            in_record = True
+            first_record = False
+            parts = []
+            start = 1
+
+        end = block.find(b"\n>", start)
+        while end != -1:
+            if in_record:
+                parts.append(block[start:end])
+                yield _fasta_record_sequence(b"".join(parts))
+
+            in_record = True
+            first_record = False
+            parts = []
+            start = end + 2
+            end = block.find(b"\n>", start)
+
+        if in_record:
+            parts.append(block[start:] if start else block)
+
+        last_byte = block[-1:]
+
+    # An empty remainder after the last record separator is not a record
+    record = b"".join(parts)
+    if in_record and (record or first_record):
+        yield _fasta_record_sequence(record)
+
+
+def _fasta_record_sequence(record):
+    """Extract the sequence of a FASTA record (header line included, without
+    the leading '>')."""
+    header_end = record.find(b"\n")
+    if header_end == -1:
+        return b""
+
+    return record[header_end + 1:].translate(None, FASTA_WHITESPACE)
+
+
+def iter_sequences_fasta_mmap(file_name):
+    """Iterate over sequences in an uncompressed FASTA file.
+
+    The file is memory mapped, and record boundaries are found with
+    `mmap.find` (memchr), so sequences are extracted without any per-line
+    Python work. Yields each sequence as bytes, with line breaks removed.
+    """
+
+    with open(file_name, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+
+            size = len(mm)
+            if mm[:1] == b">":
+                header_start = 0
+            else:
+                header_start = mm.find(b"\n>")
+                if header_start != -1:
+                    header_start += 1
+
+            while header_start != -1:
+                seq_start = mm.find(b"\n", header_start) + 1
+                if seq_start == 0:
+                    # Header without sequence at the end of the file
+                    yield b""
+                    break
+
+                next_record = mm.find(b"\n>", seq_start - 1)
+                seq_end = size if next_record == -1 else next_record
 
-    yield from (str(seq) for seq in skbio.io.read(f, "fasta"))
+                yield mm[seq_start:seq_end].translate(None, FASTA_WHITESPACE)
+
+                header_start = -1 if next_record == -1 else next_record + 1
 
 
 def iter_sequences_fastq(f):
-    """Use Heng Li's fast FASTQ reader to iterate over reads"""
+    """Iterate over reads in a FASTQ file opened in binary mode. Assumes
+    each record spans exactly four lines. Yields each sequence as bytes."""
+
+    readline = f.readline
+    while True:
+        header = readline()
+        seq = readline()
+        readline()
+        readline()
+
+        if not seq:
+            break
 
-    yield from (r[1] for r in read_fastq(f))
+        if header[:1] != b"@":
+            raise ValueError("Invalid FASTQ record (expected '@' header line "
+                             "followed by three lines): {!r}".format(header))
+
+        yield seq.rstrip()
 
 
 def open_seq_file(file_name):
@@ -98,7 +299,7 @@ def open_seq_file(file_name):
 
     Yields
     ------
-    str
+    str or bytes
         Each sequence present in the given file
     """
 
@@ -106,16 +307,53 @@ def open_seq_file(file_name):
 
     if "bam" in components:
         yield from iter_sequences_bam(file_name)
+    elif ("fastq" not in components and "fq" not in components
+            and components[-1] not in ("gz", "bz2")):
+        # Uncompressed FASTA, memory map instead of parsing line by line
+        yield from iter_sequences_fasta_mmap(file_name)
     else:
-        with open_compressed(file_name) as f:
+        with open_compressed(file_name, stream=True, binary=True) as f:
             if "fastq" in components or "fq" in components:
                 yield from iter_sequences_fastq(f)
             else:
                 yield from iter_sequences_fasta(f)
 
 
+def read_dataset(dataset):
+    """Read a complete HDF5 dataset directly into a new NumPy array, without
+    the intermediate copy `np.array(dataset)` makes."""
+    out = np.empty(dataset.shape, dtype=dataset.dtype)
+    if out.size:
+        dataset.read_direct(out)
+
+    return out
+
+
+def arrays_equal(a, b):
+    """Like `np.array_equal`, but compares the raw memory of contiguous
+    integer arrays of the same dtype instead of creating an element-wise
+    boolean array."""
+    if a is b:
+        return True
+
+    if a is None or b is None:
+        return False
+
+    if np.shape(a) != np.shape(b):
+        return False
+
+    # Extensions built from older sources lack `arrays_equal`
+    if (hasattr(kmerizer, "arrays_equal")
+            and isinstance(a, np.ndarray) and isinstance(b, np.ndarray)
+            and a.dtype == b.dtype and a.dtype.kind in "iub"
+            and a.flags.c_contiguous and b.flags.c_contiguous):
+        return kmerizer.arrays_equal(a, b)
+
+    return np.array_equal(a, b)
+
+
 def load_hdf5(file_path, thing, expect_k=None):
-    with h5py.File(file_path, 'r') as h5:
+    with h5py.File(file_path, 'r', **HDF5_READ_CACHE) as h5:
         hdf5_type = h5.attrs['type']
 
         if isinstance(hdf5_type, bytes):
@@ -129,7 +367,7 @@ def load_hdf5(file_path, thing, expect_k=None):
         if expect_k is not None and expect_k != k:
             raise ValueError(f"The loaded kmerset has not the expected k-mer size! Expected: {expect_k}, actual: {k}")
 
-        return np.array(h5[thing])
+        return read_dataset(h5[thing])
 
 
 def load_kmers(file_name, expect_k=None):
@@ -148,32 +386,27 @@ def name_from_path(file_path):
     return os.path.splitext(os.path.basename(file_path))[0]
 
 
-def kmerset_from_hdf5(file_path):
+def hdf5_path(file_path):
+    """Add the .hdf5 extension to a k-mer set file path if not present."""
     if not file_path.endswith(".hdf5"):
         file_path += ".hdf5"
 
-    with h5py.File(file_path, 'r') as h5:
-        hdf5_type = h5.attrs['type']
+    return file_path
 
-        if isinstance(hdf5_type, bytes):
-            hdf5_type = hdf5_type.decode()
 
-        assert hdf5_type == "KmerSet", "Not a KmerSet file!"
-        kset = KmerSet(h5.attrs['k'])
+def kmerset_from_hdf5(file_path, **h5_kwargs):
+    """Load a KmerSet from a HDF5 file. Additional keyword arguments are
+    passed to `h5py.File`, by default the file is opened with the chunk
+    cache settings in `HDF5_READ_CACHE`."""
+    h5_kwargs = {**HDF5_READ_CACHE, **h5_kwargs}
+    with h5py.File(hdf5_path(file_path), 'r', **h5_kwargs) as h5:
+        return kmerset_from_h5(h5)
 
-        if "fingerprint_fraction" in h5.attrs:
-            kset.fingerprint_fraction = h5.attrs["fingerprint_fraction"]
-        if "fingerprint" in h5:
-            kset.fingerprint = np.array(h5["fingerprint"])
-            if not kset.fingerprint_fraction:
-                kset.fingerprint_fraction = OLD_FINGERPRINT_FRACTION
-        if "fingerprint_counts" in h5:
-            kset.fingerprint_counts = np.array(h5["fingerprint_counts"])
 
-        if "kmers" in h5:
-            kset.kmers = np.array(h5["kmers"])
-        if "counts" in h5:
-            kset.counts = np.array(h5["counts"])
+def kmerset_from_h5(h5):
+    """Load a KmerSet from an already opened HDF5 file or group."""
+    kset = KmerSet()
+    kset.load_hdf5(h5)
 
     return kset
 
@@ -182,31 +415,37 @@ def kmerset_from_file(file_path, k=DEFAULT_K):
     return kmerset_from_hdf5(file_path)
 
 
+# Scoring methods supported by `similarity_score`:
+#   jaccard: Jaccard similarity index
+#   minsize: intersection / min_size (proper subset scores 1.0)
+#   meansize: mean size in denominator (used in Mash)
+#   maxsize: intersection / max_size (proper subset scores min/max)
+#   reference: intersection / size of reference (useful for comparing reads
+#              to assembled references)
+SIMILARITY_MODES = {
+    "jaccard": kmerizer.SimilarityMode.JACCARD,
+    "minsize": kmerizer.SimilarityMode.MINSIZE,
+    "meansize": kmerizer.SimilarityMode.MEANSIZE,
+    "maxsize": kmerizer.SimilarityMode.MAXSIZE,
+    "reference": kmerizer.SimilarityMode.REFERENCE,
+}
+
+
 def similarity_score(kmers1, kmers2, scoring="jaccard"):
-    """Compute Jaccard similarity index"""
-    # count of kmers in common
-    intersection = float(kmerizer.count_common(kmers1, kmers2))
-    if scoring == "jaccard":
-        # Use Jaccard similarity index
-        score = intersection / (kmers1.size + kmers2.size - intersection)
-    elif scoring == "minsize":
-        # Use intersection / min_size (proper subset scores 1.0)
-        score = intersection / min(kmers1.size, kmers2.size)
-    elif scoring == "meansize":
-        # Use mean size in denominator (used in Mash)
-        score = intersection / ((kmers1.size + kmers2.size) / 2)
-    elif scoring == "maxsize":
-        # Use intersection / max_size (proper subset scores min/max)
-        score = intersection / max(kmers1.size, kmers2.size)
-    elif scoring == "reference":
-        # Use intersection / size of reference (useful for comparing reads to
-        # assembled references)
-        score = intersection / kmers2.size
-    else:
-        assert scoring in (
-            "jaccard", "minsize", "maxsize", "meansize", "reference"), \
-            "unknown scoring method"
-    return score
+    """Compute the similarity between two sorted k-mer arrays with the given
+    scoring method (see `SIMILARITY_MODES`). Returns NaN if the denominator
+    of the score is zero, e.g. when comparing empty k-mer sets."""
+    assert scoring in SIMILARITY_MODES, "unknown scoring method"
+    return kmerizer.similarity(kmers1, kmers2, SIMILARITY_MODES[scoring])
+
+
+def similarity_matrix(kmersets, scoring="jaccard"):
+    """Compute the similarity between all pairs of the given (sorted) k-mer
+    arrays. Returns a N x N matrix, element (i, j) contains the score
+    between k-mer set i and j, NaN where `similarity_score` would return
+    NaN."""
+    assert scoring in SIMILARITY_MODES, "unknown scoring method"
+    return kmerizer.pairwise_similarity(kmersets, SIMILARITY_MODES[scoring])
 
 
 def similarity_numerator_denominator(kmers1, kmers2, scoring="jaccard"):
@@ -232,7 +471,151 @@ def similarity_numerator_denominator(kmers1, kmers2, scoring="jaccard"):
     return intersection, denom
 
 
-def build_kmer_count_matrix(kmersets):
+def sort_count(kmers, threads=1):
+    """Sort the given k-mer array *in place* and return the distinct k-mers
+    with their counts.
+
+    Equivalent to `np.unique(kmers, return_counts=True)`, but without the
+    copy and temporary arrays `np.unique` creates: NumPy's (SIMD) in-place
+    sort followed by a single run-length encoding pass in C++.
+
+    With enough threads (see `PARALLEL_SORT_MIN_THREADS`), chunks of the
+    array are sorted in parallel (NumPy releases the GIL while sorting), and
+    counted and merged in C++. The contents of `kmers` are overwritten in
+    that case.
+    """
+    if (threads >= PARALLEL_SORT_MIN_THREADS
+            and kmers.size >= threads * PARALLEL_SORT_MIN_CHUNK):
+        chunk_size = -(-kmers.size // threads)
+        chunks = [kmers[i:i+chunk_size]
+                  for i in range(0, kmers.size, chunk_size)]
+        with ThreadPool(threads) as pool:
+            pool.map(np.ndarray.sort, chunks)
+
+        return kmerizer.count_sorted_chunks(kmers, chunk_size, threads)
+
+    kmers.sort()
+    return kmerizer.count_sorted(kmers)
+
+
+def count_spectrum(counts):
+    """Return the distinct values in `counts`, and how often each occurs.
+
+    Equivalent to `np.unique(counts, return_counts=True)`, but k-mer counts
+    are mostly small integers, so a histogram (one pass, no sorting) is used
+    unless the maximum count exceeds `SPECTRUM_BINCOUNT_MAX`.
+    """
+    if counts.size == 0 or counts.max() > SPECTRUM_BINCOUNT_MAX:
+        return np.unique(counts, return_counts=True)
+
+    # np.bincount refuses unsigned 64-bit integers, all counts are small
+    # enough to reinterpret them as signed.
+    if counts.dtype == np.uint64:
+        hist = np.bincount(counts.view(np.int64))
+    else:
+        hist = np.bincount(counts)
+
+    freq = np.flatnonzero(hist)
+    return freq.astype(counts.dtype), hist[freq]
+
+
+def saturate_counts(counts):
+    """Convert k-mer counts to `COUNT_DTYPE`, saturating at `MAX_COUNT`."""
+    if counts.dtype == COUNT_DTYPE:
+        return counts
+
+    return np.minimum(counts, MAX_COUNT).astype(COUNT_DTYPE)
+
+
+def compression_available(compress):
+    """Whether the given HDF5 compression method can be used, i.e. the
+    hdf5plugin package is installed if the method requires it."""
+    return compress not in HDF5PLUGIN_COMPRESSIONS or hdf5plugin is not None
+
+
+def _compression_options(compress):
+    """Return the h5py `create_dataset` keyword arguments for the given
+    compression method."""
+    if not compression_available(compress):
+        raise ValueError(f"{compress} compression requires the hdf5plugin "
+                         f"package.")
+
+    if compress == "gzip":
+        return {'compression': "gzip", 'compression_opts': GZIP_LEVEL,
+                'shuffle': True}
+    elif compress == "lz4":
+        return dict(hdf5plugin.LZ4(), shuffle=True)
+    elif compress == "bitshuffle":
+        # Shuffles bits itself, so no byte shuffle
+        return dict(hdf5plugin.Bitshuffle(), shuffle=False)
+    else:
+        return {'compression': compress, 'shuffle': True}
+
+
+def create_kmer_dataset(h5, name, data, compress=None,
+                        chunk_size=DEFAULT_HDF5_CHUNK):
+    """Create a 1D dataset, chunked and shuffled if compression is
+    requested (see `_compression_options`)."""
+    if not compress:
+        return h5.create_dataset(name, data=data)
+
+    # h5py rejects explicit chunks larger than an empty dataset
+    chunks = ((min(data.size, chunk_size), )
+              if chunk_size and data.size else True)
+    return h5.create_dataset(name, data=data, chunks=chunks,
+                             **_compression_options(compress))
+
+
+def _copy_dataset(h5, name, source, data, compress=None,
+                  chunk_size=DEFAULT_HDF5_CHUNK):
+    """Create a dataset with the same contents as `source`.
+
+    If `source` is already stored the way `create_kmer_dataset` would store
+    `data`, the compressed chunks are copied as-is, without decompressing
+    and compressing them again. Otherwise, falls back to `create_kmer_dataset`.
+    """
+    expected_chunks = None
+    if compress:
+        expected_chunks = ((max(1, min(data.size, chunk_size)), )
+                           if chunk_size else source.chunks)
+
+    if (not compress or source.compression != compress
+            or not source.shuffle or source.chunks != expected_chunks
+            or source.fletcher32 or source.scaleoffset is not None
+            or source.dtype != data.dtype or source.shape != data.shape):
+        return create_kmer_dataset(h5, name, data, compress, chunk_size)
+
+    dest = h5.create_dataset(name, shape=source.shape, dtype=source.dtype,
+                             compression=compress,
+                             compression_opts=source.compression_opts,
+                             shuffle=True, chunks=source.chunks)
+    for i in range(source.id.get_num_chunks()):
+        chunk_offset = source.id.get_chunk_info(i).chunk_offset
+        filter_mask, chunk = source.id.read_direct_chunk(chunk_offset)
+        dest.id.write_direct_chunk(chunk_offset, chunk, filter_mask)
+
+    return dest
+
+
+def create_bloom_filter(expected_kmers, bits_per_kmer=BLOOM_BITS_PER_KMER,
+                        num_hashes=BLOOM_NUM_HASHES):
+    """Create a Bloom filter to prefilter singleton k-mers while k-merizing.
+
+    Parameters
+    ----------
+    expected_kmers : int
+        Expected number of distinct k-mers in the input
+    bits_per_kmer : int
+        Size of the filter in bits per expected k-mer. With the defaults,
+        about 2.5% of singletons will pass the filter.
+    num_hashes : int
+        Number of hash functions
+    """
+    return kmerizer.BloomFilter(max(1, int(expected_kmers * bits_per_kmer)),
+                                num_hashes)
+
+
+def build_kmer_count_matrix(kmersets, threads=0):
     """Build a big matrix with kmer counts from a list of kmersets.
 
     Each column will represent a single k-mer set and each row a k-mer. This
@@ -242,19 +625,60 @@ def build_kmer_count_matrix(kmersets):
     ----------
     kmersets : List[KmerSet]
         List of `KmerSet` objects to build the matrix from.
+    threads : int
+        Number of threads to use, 0 uses all available cores.
 
     Returns
     -------
-    Tuple[List[kmer_t], array]
+    Tuple[array, array]
         This function returns a tuple with two elements: the first element is
-        a list of k-mers, i.e. the labels for the rows of the matrix, and the
-        second element is the matrix itself.
+        an array of k-mers, i.e. the labels for the rows of the matrix, and
+        the second element is the matrix itself.
+    """
+
+    # Defer to our C++ extension, which reads the k-mers and counts from the
+    # KmerSet objects directly
+    return kmerizer.build_kmer_count_matrix_from_kmersets(kmersets, threads)
+
+
+class KmerSetMerger:
+    """
+    Merge many k-mer sets into a single KmerSet.
+
+    Repeatedly merging each new k-mer set into one growing KmerSet copies the
+    accumulated k-mers again for every added set. Instead, we merge sets of
+    similar size, like carrying in a binary counter: a k-mer gets copied
+    O(log N) times for N sets, and only O(log N) partially merged sets are
+    kept in memory.
     """
 
-    # Defer to our C++ extension
-    return kmerizer.build_kmer_count_matrix([
-        (kmerset.kmers, kmerset.counts) for kmerset in kmersets
-    ])
+    def __init__(self):
+        # Stack of (level, kmerset) tuples, a set at level i is the result of
+        # merging 2^i input sets. Levels are strictly decreasing.
+        self.stack = []
+
+    def add(self, kmerset):
+        level = 0
+        while self.stack and self.stack[-1][0] == level:
+            _, other = self.stack.pop()
+            kmerset = other.merge_kmerset(kmerset)
+            level += 1
+
+        self.stack.append((level, kmerset))
+
+    def result(self):
+        """Merge all remaining partial results and return the final KmerSet,
+        or None if no k-mer sets were added."""
+        if not self.stack:
+            return None
+
+        _, merged = self.stack.pop()
+        while self.stack:
+            _, other = self.stack.pop()
+            merged = other.merge_kmerset(merged)
+
+        self.stack.append((0, merged))
+        return merged
 
 
 class KmerSet(object):
@@ -273,79 +697,190 @@ class KmerSet(object):
 
         self.singletons = None
 
+        # (weak reference to counts, spectrum of those counts)
+        self._spectrum = None
+
         # stats from kmerizing, if appropriate
         self.n_seqs = 0
         self.n_bases = 0
         self.n_kmers = 0
 
+    def __getstate__(self):
+        # The cached spectrum holds a weak reference, which can't be pickled
+        state = self.__dict__.copy()
+        state['_spectrum'] = None
+        return state
+
     def __eq__(self, other):
-        return (self.k == other.k
-                and np.array_equal(self.fingerprint, other.fingerprint)
-                and np.array_equal(self.kmers, other.kmers)
-                and np.array_equal(self.counts, other.counts))
+        if self.k != other.k:
+            return False
+
+        pairs = [
+            (self.kmers, other.kmers),
+            (self.counts, other.counts),
+            (self.fingerprint, other.fingerprint),
+        ]
+
+        # Check all sizes before comparing any contents, most unequal k-mer
+        # sets already differ in size
+        if any(np.shape(a) != np.shape(b) for a, b in pairs):
+            return False
+
+        return all(arrays_equal(a, b) for a, b in pairs)
+
+    def kmer_strings(self, kmers=None):
+        """Return the nucleotide sequences of the k-mers in this set (or of
+        the given k-mers) as NumPy array of byte strings."""
+        if kmers is None:
+            kmers = self.kmers
+
+        # Extensions built from older sources lack `kmer_strings`
+        if hasattr(kmerizer, "kmer_strings"):
+            return kmerizer.kmer_strings(self.k, kmers)
+        else:
+            return decode_kmers(kmers, self.k)
 
     def kmerize_file(self, file_name, batch_size=100000000, verbose=True,
-                     limit=0, prune=0):
+                     limit=0, prune=0, bloom=None, threads=1):
+        """K-merize all sequences in a file and add them to this k-mer set.
+
+        If a Bloom filter (see `create_bloom_filter`) is given, the first
+        occurrence of each k-mer is only recorded in the filter, so k-mers
+        seen once are never stored. Call `add_prefiltered_occurrences` after
+        k-merizing all files to correct the counts.
+
+        `threads` is the number of threads used to sort and count each batch.
+        With multiple threads, a full batch is sorted and merged in a
+        background thread while the next batch is k-merized into a second
+        buffer (which doubles the memory used for batches).
+        """
         seq_file = open_seq_file(file_name)
-        batch = np.empty(batch_size, dtype=np.uint64)
+        num_buffers = 2 if threads > 1 else 1
+        batches = [np.empty(batch_size, dtype=np.uint64)
+                   for _ in range(num_buffers)]
+        batch_ix = 0
+        batch = batches[batch_ix]
 
         n_seqs = 0
         n_bases = 0
         n_kmers = 0
+        # Number of k-mers including batches still being processed
+        n_total = self.n_kmers
         pruned = False
 
-        for seq in seq_file:
-            n_seqs += 1
-            seq_length = len(seq)
-            n_bases += seq_length
-            if n_kmers + seq_length > batch_size:
-                self.process_batch(batch, n_seqs, n_bases, n_kmers, verbose)
-                if limit and self.n_kmers > limit:
+        pool = ThreadPool(1) if num_buffers > 1 else None
+        pending = None
+
+        def process(batch, n_seqs, n_bases, n_kmers, prune):
+            nonlocal pending, pruned
+            args = (batch, n_seqs, n_bases, n_kmers, verbose, prune, threads)
+
+            if pool is None:
+                pruned |= self._process_batch_and_prune(*args)
+            else:
+                # Wait for the previous batch, so the buffer it used can be
+                # filled again.
+                if pending is not None:
+                    pruned |= pending.get()
+                pending = pool.apply_async(self._process_batch_and_prune, args)
+
+        try:
+            for seq in seq_file:
+                n_seqs += 1
+                seq_length = len(seq)
+                n_bases += seq_length
+                if n_kmers + seq_length > batch_size:
+                    n_total += n_kmers
+                    limit_reached = limit and n_total > limit
+                    process(batch, n_seqs, n_bases, n_kmers,
+                            0 if limit_reached else prune)
+                    if limit_reached:
+                        break
+
+                    batch_ix = (batch_ix + 1) % num_buffers
+                    batch = batches[batch_ix]
+                    n_seqs = 0
+                    n_bases = 0
+                    n_kmers = 0
+
+                if bloom is not None:
+                    n_kmers += kmerizer.kmerize_into_array_prefiltered(
+                        self.k, seq, batch, n_kmers, bloom)
+                else:
+                    n_kmers += kmerizer.kmerize_into_array(
+                        self.k, seq, batch, n_kmers)
+                if limit and n_total + n_kmers >= limit:
                     break
-                if prune and self.singletons > prune:
-                    self.prune_singletons(verbose)
-                    pruned = True
-                n_seqs = 0
-                n_bases = 0
-                n_kmers = 0
-
-            n_kmers += kmerizer.kmerize_into_array(self.k, seq, batch, n_kmers)
-            if limit and self.n_kmers + n_kmers >= limit:
-                break
 
-        self.process_batch(batch, n_seqs, n_bases, n_kmers, verbose)
+            process(batch, n_seqs, n_bases, n_kmers, 0)
+            if pending is not None:
+                pruned |= pending.get()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
         if pruned:
             self.prune_singletons(verbose)
 
+    def _process_batch_and_prune(self, batch, nseqs, nbases, nkmers, verbose,
+                                 prune, threads):
+        """Process a full batch, and prune singletons if there are more than
+        `prune`. Returns whether singletons were pruned."""
+        self.process_batch(batch, nseqs, nbases, nkmers, verbose, threads)
+        if prune and self.singletons > prune:
+            self.prune_singletons(verbose)
+            return True
+
+        return False
+
+    def add_prefiltered_occurrences(self):
+        """Correct counts after k-merizing with a Bloom filter prefilter.
+
+        Each stored k-mer was seen once before it passed the filter, so we
+        add that occurrence back. Singletons were never stored, apart from
+        the occasional false positive of the filter.
+        """
+        if self.kmers is None:
+            return
+
+        np.add(self.counts, 1, out=self.counts,
+               where=self.counts < MAX_COUNT)
+        self._spectrum = None
+        self.n_kmers += self.kmers.size
+        self.singletons = np.count_nonzero(self.counts == 1)
+
     def kmerize_seq(self, seq):
         kmers = kmerizer.kmerize(self.k, seq)
         self.n_seqs += 1
         self.n_bases += len(seq)
         self.n_kmers = kmers.size
-        self.kmers, self.counts = np.unique(kmers, return_counts=True)
+        self.kmers, self.counts = sort_count(kmers)
 
-    def process_batch(self, batch, nseqs, nbases, nkmers, verbose):
+    def process_batch(self, batch, nseqs, nbases, nkmers, verbose,
+                      threads=1):
         self.n_seqs += nseqs
         self.n_bases += nbases
         self.n_kmers += nkmers
 
-        new_kmers, new_counts = np.unique(batch[:nkmers], return_counts=True)
+        # Sorts the batch in place, which is fine as it's scratch space
+        new_kmers, new_counts = sort_count(batch[:nkmers], threads)
 
         if self.kmers is None:
             self.kmers = new_kmers
             self.counts = new_counts
+            self.singletons = np.count_nonzero(self.counts == 1)
         else:
-            self.kmers, self.counts = kmerizer.merge_counts(
-                self.kmers, self.counts, new_kmers, new_counts)
+            self.kmers, self.counts, self.singletons = (
+                kmerizer.merge_counts_singletons(
+                    self.kmers, self.counts, new_kmers, new_counts))
 
-        self.singletons = np.count_nonzero(self.counts == 1)
         if verbose:
             self.print_stats()
 
     def prune_singletons(self, verbose=False):
-        keepers = self.counts > 1
-        self.kmers = self.kmers[keepers]
-        self.counts = self.counts[keepers]
+        self.kmers, self.counts = kmerizer.filter_counts(
+            self.kmers, self.counts, 2)
         logger.debug("Pruned singletons: %d distinct k-mers remain",
                      self.kmers.size)
 
@@ -356,6 +891,24 @@ class KmerSet(object):
             self.kmers, self.counts, other.kmers, other.counts)
         return new_set
 
+    def update(self, other):
+        """Merge the k-mers, counts and k-merizing statistics of another
+        KmerSet into this one (in place)."""
+        if self.kmers is None:
+            self.kmers = other.kmers
+            self.counts = other.counts
+            self.singletons = np.count_nonzero(self.counts == 1)
+        else:
+            self.kmers, self.counts, self.singletons = (
+                kmerizer.merge_counts_singletons(
+                    self.kmers, self.counts, other.kmers, other.counts))
+
+        self.n_seqs += other.n_seqs
+        self.n_bases += other.n_bases
+        self.n_kmers += other.n_kmers
+
+        return self
+
     def intersect(self, kmers):
         """
         Compute intersection with given kmers
@@ -363,9 +916,8 @@ class KmerSet(object):
         :return: reduced version of self
         """
 
-        ix = kmerizer.intersect_ix(self.kmers, kmers)
-        self.counts = self.counts[ix]
-        self.kmers = self.kmers[ix]
+        self.kmers, self.counts = kmerizer.intersect_apply(
+            self.kmers, self.counts, kmers)
 
         return self
 
@@ -375,11 +927,8 @@ class KmerSet(object):
         :param kmers: kmers to exclude
         :return: reduced version of self
         """
-        new_kmers = kmerizer.diff(self.kmers, kmers)
-
-        ix = kmerizer.intersect_ix(self.kmers, new_kmers)
-        self.counts = self.counts[ix]
-        self.kmers = new_kmers
+        self.kmers, self.counts = kmerizer.exclude_apply(
+            self.kmers, self.counts, kmers)
 
         return self
 
@@ -391,13 +940,11 @@ class KmerSet(object):
         :param other: other KmerSet
         :return: reduced self
         """
-        ix = kmerizer.intersect_ix(self.kmers, other.kmers)
-        self.kmers = self.kmers[ix]
-        self.counts = self.counts[ix]
-
-        ix = kmerizer.intersect_ix(other.kmers, self.kmers)
-        other.kmers = other.kmers[ix]
-        other.counts = other.counts[ix]
+        ix1, ix2 = kmerizer.intersect_indices(self.kmers, other.kmers)
+        self.kmers = self.kmers[ix1]
+        self.counts = self.counts[ix1]
+        other.kmers = other.kmers[ix2]
+        other.counts = other.counts[ix2]
 
         return self
 
@@ -408,12 +955,20 @@ class KmerSet(object):
 
     def min_hash(self, frac=DEFAULT_FINGERPRINT_FRACTION):
         nkmers = int(round(self.kmers.size * frac))
-        order = kmerizer.fnvhash_kmers(self.k, self.kmers).argsort()[:nkmers]
-        self.fingerprint = self.kmers[order]
-        self.fingerprint.sort()
+        hashes = kmerizer.fnvhash_kmers(self.k, self.kmers)
 
-        ix = kmerizer.intersect_ix(self.kmers, self.fingerprint)
-        self.fingerprint_counts = self.counts[ix]
+        # We only need the k-mers with the `nkmers` smallest hashes, not a
+        # complete ordering of all hashes.
+        if nkmers < hashes.size:
+            selected = np.argpartition(hashes, nkmers)[:nkmers]
+        else:
+            selected = np.arange(hashes.size)
+
+        # k-mers are sorted, so sorting the indices keeps the fingerprint
+        # sorted, and gives the corresponding counts directly.
+        selected.sort()
+        self.fingerprint = self.kmers[selected]
+        self.fingerprint_counts = self.counts[selected]
 
         self.fingerprint_fraction = frac
 
@@ -437,19 +992,29 @@ class KmerSet(object):
         if self.fingerprint_counts is not None:
             kset.counts = self.fingerprint_counts
         else:
-            kset.counts = np.ones_like(kset.kmers, dtype=np.uint64)
+            kset.counts = np.ones_like(kset.kmers, dtype=COUNT_DTYPE)
 
         return kset
 
     def freq_filter(self, min_freq=1, max_freq=None):
-        condition = (self.counts >= min_freq)
-        if max_freq:
-            condition &= (self.counts <= max_freq)
-        self.kmers = self.kmers[condition]
-        self.counts = self.counts[condition]
+        max_freq = int(max_freq) if max_freq else MAX_COUNT
+        self.kmers, self.counts = kmerizer.filter_counts(
+            self.kmers, self.counts, int(min_freq), max_freq)
 
     def spectrum(self):
-        return np.unique(self.counts, return_counts=True)
+        """Return the distinct k-mer counts, and the number of k-mers with
+        each count.
+
+        The result is cached until `counts` is replaced (or modified in place
+        through `add_prefiltered_occurrences`).
+        """
+        if self._spectrum is not None and self._spectrum[0]() is self.counts:
+            return self._spectrum[1]
+
+        spectrum = count_spectrum(self.counts)
+        self._spectrum = (weakref.ref(self.counts), spectrum)
+
+        return spectrum
 
     def spectrum_min_max(self, delta=.5, max_copy_number=20):
         freq, counts = self.spectrum()
@@ -511,42 +1076,76 @@ class KmerSet(object):
 
     def entropy(self):
         """Calculate Shannon entropy in bases"""
-        if self.counts is None:
+        if self.counts is None or self.counts.size == 0:
             return 0.0
-        total = float(self.counts.sum())
-        probs = self.counts / total
-        return (-(probs * np.log2(probs)).sum()) / 2
 
-    def save_hdf5(self, h5, compress=None):
+        # With p_i = c_i / total, the entropy -sum(p_i * log2(p_i)) equals
+        # log2(total) - sum(c_i * log2(c_i)) / total. k-mers with the same
+        # count contribute equally, so we only need the count spectrum.
+        freq, num_kmers = self.spectrum()
+        freq = freq.astype(np.float64)
+        weights = num_kmers * freq
+        total = weights.sum()
+        return (np.log2(total) - (weights * np.log2(freq)).sum() / total) / 2
+
+    def save_hdf5(self, h5, compress=None, chunk_size=DEFAULT_HDF5_CHUNK,
+                  source=None):
+        """Store this KmerSet in the given HDF5 file or group.
+
+        k-mers are stored as unsigned 64-bit integers, counts as
+        `COUNT_DTYPE` (saturated at `MAX_COUNT`).
+
+        When compressing, datasets are stored in chunks of at most
+        `chunk_size` elements, with the byte (or bit) shuffle filter enabled
+        (which greatly improves compression of sorted k-mers and small
+        counts).
+
+        If `source` is given, it should be the HDF5 file or group this
+        KmerSet was loaded from, unmodified. Datasets already compressed
+        with the same settings are then copied chunk by chunk without
+        recompressing.
+        """
         h5.attrs["type"] = "KmerSet"
         h5.attrs["k"] = self.k
         h5.attrs["nSeqs"] = self.n_seqs
 
+        def store(name, data):
+            if source is not None and name in source:
+                _copy_dataset(h5, name, source[name], data, compress,
+                              chunk_size)
+            else:
+                create_kmer_dataset(h5, name, data, compress, chunk_size)
+
         if self.fingerprint is not None:
-            h5.create_dataset("fingerprint", data=self.fingerprint,
-                              compression=compress)
+            store("fingerprint", self.fingerprint.astype(np.uint64,
+                                                         copy=False))
         if self.fingerprint_counts is not None:
-            h5.create_dataset("fingerprint_counts",
-                              data=self.fingerprint_counts,
-                              compression=compress)
+            store("fingerprint_counts",
+                  saturate_counts(self.fingerprint_counts))
         if self.fingerprint_fraction is not None:
             h5.attrs["fingerprint_fraction"] = self.fingerprint_fraction
 
         if self.kmers is not None:
-            h5.create_dataset("kmers", data=self.kmers, compression=compress)
+            store("kmers", self.kmers.astype(np.uint64, copy=False))
         if self.counts is not None:
-            h5.create_dataset("counts", data=self.counts, compression=compress)
+            store("counts", saturate_counts(self.counts))
 
-    def save(self, file_name, compress=None):
+    def save(self, file_name, compress=None, chunk_size=DEFAULT_HDF5_CHUNK):
         """Save in HDF5 file format"""
         if compress is True:
-            compress = "gzip"
+            compress = DEFAULT_HDF5_COMPRESSION
         if not file_name.endswith(".hdf5"):
             file_name += ".hdf5"
         with h5py.File(file_name, 'w') as h5:
-            self.save_hdf5(h5, compress)
+            self.save_hdf5(h5, compress, chunk_size)
+
+    def load_hdf5(self, h5, fingerprint_only=False):
+        """Load this KmerSet from the given HDF5 file or group.
 
-    def load_hdf5(self, h5):
+        With `fingerprint_only`, the full k-mer set isn't read if the file
+        contains a fingerprint, and `kmers` and `counts` are set to the
+        fingerprint instead (see `fingerprint_override`).
+        """
         h5_type = h5.attrs['type']
 
         # Support for HDF5 files generated in previous versions under Python 2
@@ -564,19 +1163,25 @@ class KmerSet(object):
         if "fingerprint_fraction" in h5.attrs:
             self.fingerprint_fraction = h5.attrs["fingerprint_fraction"]
         if "fingerprint" in h5:
-            self.fingerprint = np.array(h5["fingerprint"])
+            self.fingerprint = read_dataset(h5["fingerprint"])
             if not self.fingerprint_fraction:
                 self.fingerprint_fraction = OLD_FINGERPRINT_FRACTION
         if "fingerprint_counts" in h5:
-            self.fingerprint_counts = np.array(h5["fingerprint_counts"])
+            self.fingerprint_counts = saturate_counts(
+                read_dataset(h5["fingerprint_counts"]))
+
+        if fingerprint_only and self.fingerprint is not None:
+            self.fingerprint_override()
+            return
 
         if "kmers" in h5:
-            self.kmers = np.array(h5["kmers"])
+            self.kmers = read_dataset(h5["kmers"])
         if "counts" in h5:
-            self.counts = np.array(h5["counts"])
+            # Files written by older versions store 64-bit counts
+            self.counts = saturate_counts(read_dataset(h5["counts"]))
 
     def load(self, file_name):
-        with h5py.File(file_name, 'r') as h5:
+        with h5py.File(file_name, 'r', **HDF5_READ_CACHE) as h5:
             self.load_hdf5(h5)
 
     def copy(self):
@@ -32,7 +32,8 @@ import logging
 import numpy
 from intervaltree import IntervalTree
 
-from strainge.variant_caller import count_ts_tv, scale_min_gap_size
+from strainge.variant_caller import (count_alleles, count_ts_tv,
+                                     scale_min_gap_size)
 from strainge.utils import pct
 
 logger = logging.getLogger(__name__)
@@ -93,8 +94,8 @@ class SampleComparison:
             numpy.ones_like(a.refmask), numpy.logical_and(a.strong, b.strong))
 
         # locations where both have only a single allele called
-        single_a = (a.strong & (a.strong - 1)) == 0
-        single_b = (b.strong & (b.strong - 1)) == 0
+        single_a = count_alleles(a.strong) <= 1
+        single_b = count_alleles(b.strong) <= 1
         singles, single_cnt, single_pct = self.compare_thing(
             common, single_a & single_b)
 
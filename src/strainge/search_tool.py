@@ -29,7 +29,6 @@
 
 from __future__ import annotations
 
-import math
 import logging
 from collections import namedtuple
 from dataclasses import dataclass
@@ -44,6 +43,23 @@ from strainge import kmertools, kmerizer
 logger = logging.getLogger(__name__)
 
 
+def top_indices(scores, n):
+    """
+    Indices of the `n` highest scores, from high to low. Equal scores keep
+    their original order, as with a stable sort, but only the candidates for
+    the top `n` are sorted.
+    """
+    if n >= scores.size:
+        return np.argsort(-scores, kind='stable')
+
+    # n-th highest score
+    threshold = -np.partition(-scores, n - 1)[n - 1]
+    candidates = np.flatnonzero(scores >= threshold)
+    order = np.argsort(-scores[candidates], kind='stable')
+
+    return candidates[order[:n]]
+
+
 class Sample(kmertools.KmerSet):
     """
     Sample Kmerset
@@ -57,7 +73,7 @@ class Sample(kmertools.KmerSet):
 
         logger.info("Loading sample %s", hdf5file)
         self.hdf5file = hdf5file
-        with h5py.File(hdf5file, 'r') as h5:
+        with h5py.File(hdf5file, 'r', **kmertools.HDF5_READ_CACHE) as h5:
             self.load_hdf5(h5)
 
         # keep track of original totalKmers and distinctKmers
@@ -67,6 +83,18 @@ class Sample(kmertools.KmerSet):
         logger.info("%d distinct k-mers, %d total k-mers",
                     self.distinct_kmers, self.total_kmers)
 
+    def exclude(self, kmers):
+        """
+        Remove the given kmers. Unlike `KmerSet.exclude`, the kmers and
+        counts arrays are compacted in place instead of copied, so they
+        should not be shared with other objects.
+        """
+        size = kmerizer.exclude_inplace(self.kmers, [self.counts], kmers)
+        self.kmers = self.kmers[:size]
+        self.counts = self.counts[:size]
+
+        return self
+
 
 class PanGenome(kmertools.KmerSet):
     def __init__(self, hdf5file, fulldb=False):
@@ -82,10 +110,12 @@ class PanGenome(kmertools.KmerSet):
         self.hdf5file = hdf5file
 
         logger.info("Loading pan genome %s", hdf5file)
-        self.h5 = h5py.File(hdf5file, 'r')
-        self.load_hdf5(self.h5)
+        self.h5 = h5py.File(hdf5file, 'r', **kmertools.HDF5_READ_CACHE)
 
+        # Only read the full k-mer sets if they are actually used
         self.use_fingerprint = not fulldb
+        self.load_hdf5(self.h5, fingerprint_only=self.use_fingerprint)
+
         if self.use_fingerprint:
             self.fingerprint_override()
             logger.info("Using fingerprint kmer database")
@@ -137,13 +167,51 @@ class StrainKmerSet(kmertools.KmerSet):
         super().__init__()
         self.name = name
         self.pan = pan
-        self.load_hdf5(pan.h5[name])
+        self.load_hdf5(pan.h5[name], fingerprint_only=pan.use_fingerprint)
 
         if self.pan.use_fingerprint:
             self.fingerprint_override()
         self.distinct_kmers = self.kmers.size
         self.total_kmers = self.counts.sum()
 
+        # How often each strain k-mer occurs in the pan genome. Computed once
+        # by StrainGST and kept in sync with `kmers` when excluding k-mers.
+        self.pan_counts = None
+
+        # Set by StrainGST when this strain can't be scored in any later
+        # iteration, see `StrainGST.score_strain`
+        self.exhausted = False
+
+        # Loaded arrays may be shared with `fingerprint`, the first exclusion
+        # creates new arrays which later exclusions can modify in place
+        self._owns_arrays = False
+
+    def exclude(self, kmers):
+        if not self._owns_arrays:
+            if self.pan_counts is None:
+                super().exclude(kmers)
+            else:
+                keep = ~kmerizer.intersect_ix(self.kmers, kmers)
+                self.kmers = self.kmers[keep]
+                self.counts = self.counts[keep]
+                self.pan_counts = self.pan_counts[keep]
+
+            self._owns_arrays = True
+            return self
+
+        # Compact the arrays in place, without allocating new ones
+        if self.pan_counts is None:
+            size = kmerizer.exclude_inplace(self.kmers, [self.counts], kmers)
+        else:
+            size = kmerizer.exclude_inplace(
+                self.kmers, [self.counts, self.pan_counts], kmers)
+            self.pan_counts = self.pan_counts[:size]
+
+        self.kmers = self.kmers[:size]
+        self.counts = self.counts[:size]
+
+        return self
+
 
 @dataclass
 class Strain:
@@ -174,7 +242,8 @@ class StrainGSTResult:
 
 class StrainGST:
     def __init__(self, pangenome, fulldb, iterations, top,
-                 min_score, min_evenness, universal, min_frac, min_acct, debug_hdf5=None):
+                 min_score, min_evenness, universal, min_frac, min_acct, debug_hdf5=None,
+                 threads=1):
         self.use_fingerprint = not fulldb
         self.iterations = iterations
         self.top = top
@@ -190,6 +259,9 @@ class StrainGST:
         self.pangenome = pangenome
         self.debug_hdf5 = debug_hdf5
 
+        # Number of threads used to score strains
+        self.threads = threads
+
     def find_close_references(self, sample, score_strains=None):
         """
         Find the strains in a sample
@@ -215,8 +287,14 @@ class StrainGST:
         # kmer frequency.
         universal_limit = int(np.mean(sample.counts) * self.universal)
         logger.info(f"Sample kmer frequency cutoff: {universal_limit}")
-        excludes = sample.kmers[sample.counts > universal_limit]
-        sample.exclude(excludes)
+        universal_kmers = sample.counts > universal_limit
+        excludes = sample.kmers[universal_kmers]
+
+        # The excluded k-mers are selected by count, so filter the sample
+        # directly instead of merging it with `excludes`
+        keep = ~universal_kmers
+        sample.kmers = sample.kmers[keep]
+        sample.counts = sample.counts[keep]
 
         # Copy sample k-mers and counts for relative abundance estimation later, because the iterative StrainGST
         # algorithm below removes k-mers at each iteration.
@@ -246,27 +324,34 @@ class StrainGST:
             # purposes if requested.
             if h5 is not None:
                 group = h5.create_group(f"iteration{i}")
-                group.create_dataset("kmers", data=sample.kmers,
-                                     compression="gzip")
-                group.create_dataset("counts", data=sample.counts,
-                                     compression="gzip")
-
-            iter = map(
-                lambda strain: self.score_strain(strain, sample, excludes),
-                strains
-            )
-
-            strain_scores = list(
-                s for s in iter if s is not None
-                and s.even >= self.min_evenness
-            )
-
-            strain_scores.sort(key=lambda e: e.wscore if self.alt_score else e.score, reverse=True)
+                kmertools.create_kmer_dataset(
+                    group, "kmers", sample.kmers,
+                    kmertools.FAST_HDF5_COMPRESSION)
+                kmertools.create_kmer_dataset(
+                    group, "counts", sample.counts,
+                    kmertools.FAST_HDF5_COMPRESSION)
+
+            min_evenness = self.min_evenness
+            strain_scores = [
+                s for s in self.score_strains(strains, sample, excludes)
+                if s is not None and s.even >= min_evenness
+            ]
+
+            # Don't score strains again that can't score anymore
+            load_strain = self.pangenome.load_strain
+            strains = [strain for strain in strains
+                       if not load_strain(strain).exhausted]
 
             if not strain_scores:
                 logger.info("No good strains found, quiting.")
                 break
 
+            # Only the top strains are reported, no need to sort the rest
+            scores = np.array([s.wscore if self.alt_score else s.score
+                               for s in strain_scores])
+            strain_scores = [strain_scores[ix]
+                             for ix in top_indices(scores, self.top)]
+
             winner = strain_scores[0]
             winner_score = winner.wscore if self.alt_score else winner.score
             # if best score isn't good enough, we're done
@@ -307,12 +392,14 @@ class StrainGST:
         if not result.strains:
             return
 
-        # Reset cache because the StrainGST algorithm may have removed k-mers from the reference k-mer sets
+        # Reset cache because the StrainGST algorithm may have removed k-mers from the reference k-mer sets.
+        # The reference k-mer sets are loaded fresh without caching them, so they don't need to be copied
+        # before reducing them below.
         self.pangenome.reset_cache()
         if self.top == 1:
-            ref_kmersets = [self.pangenome.load_strain(s.strain).copy() for pos, s in result.strains]
+            ref_kmersets = [StrainKmerSet(self.pangenome, s.strain) for pos, s in result.strains]
         else:
-            ref_kmersets = [self.pangenome.load_strain(s.strain).copy()
+            ref_kmersets = [StrainKmerSet(self.pangenome, s.strain)
                             for pos, s in result.strains if pos.split('.')[-1] == "0"]
 
         for ref_kmerset in ref_kmersets:
@@ -354,114 +441,149 @@ class StrainGST:
             result.strains[ix][1].rapct = abun
 
     def score_strain(self, strain_name, sample, excludes=None):
+        return self.score_strains([strain_name], sample, excludes)[0]
+
+    def load_scorable_strain(self, strain_name, excludes=None):
+        """
+        Load the strain KmerSet with the excluded k-mers removed, or None if
+        it has too few k-mers left to be scored.
+        """
+
         # This loads a cached version with possibly already several k-mers
         # removed from earlier found strains
         strain_kmerset = self.pangenome.load_strain(strain_name)
 
+        # K-mers are only ever removed from both the strain and the sample,
+        # so a strain with too few k-mers left, or without any k-mers in
+        # common with the sample, won't score in later iterations either.
+        if strain_kmerset.exhausted:
+            return None
+
         if excludes is not None:
             strain_kmerset.exclude(excludes)
 
         if (strain_kmerset.kmers.size < self.min_frac *
                 strain_kmerset.distinct_kmers):
             # Too few k-mers
+            strain_kmerset.exhausted = True
             return None
 
-        # how often each strain kmer occurs in PanGenome
-        ix = kmerizer.intersect_ix(self.pangenome.kmers, strain_kmerset.kmers)
-        strain_pan_counts = self.pangenome.counts[ix]
-
-        # distinct kmers from sample in this strain
-        kmers = kmerizer.intersect(strain_kmerset.kmers, sample.kmers)
-
-        # if none, quit now
-        if kmers.size == 0:
-            return None
-
-        # how many times each occurred in this strain
-        ix = kmerizer.intersect_ix(strain_kmerset.kmers, kmers)
-        counts = strain_kmerset.counts[ix]
-
-        # how many times each strain kmer occurred in pan genome (for
-        # weighting)
-        pan_counts = strain_pan_counts[ix]
-
-        # how many times did each kmers occur in sample?
-        ix = kmerizer.intersect_ix(sample.kmers, kmers)
-        sample_counts = sample.counts[ix]
-        sample_count = sample_counts.sum()
-
-        # converse of covered: what fraction of pan genome sample kmers are
-        # accounted for by this sample?
-        accounted = sample_count / sample.counts.sum()
-
-        if accounted < self.min_acct:
-            return None
-
-        # Compute metrics
-        # what fraction of the distinct strain kmers are in the sample?
-        covered = kmers.size / strain_kmerset.kmers.size
+        # how often each strain kmer occurs in PanGenome, this doesn't change
+        # between iterations so only look it up once per strain
+        if strain_kmerset.pan_counts is None:
+            pan_ix, _ = kmerizer.intersect_indices(self.pangenome.kmers,
+                                                   strain_kmerset.kmers)
+            strain_kmerset.pan_counts = self.pangenome.counts[pan_ix]
 
-        # for each distinct kmer, how many times did it occur in the sample
-        # relative to the strain?
-        kmer_coverage = sample_count / sample_counts.size
+        return strain_kmerset
 
-        # mean genome coverage from all my kmers
-        genome_coverage = sample_count / strain_kmerset.counts.sum()
-
-        # Lander-Waterman estimate of percentage covered if randomly
-        # distributed across genome
-        est_covered = 1.0 - math.exp(-genome_coverage)
-
-        # measure of evenness of coverage
-        evenness = covered / est_covered if covered < est_covered else est_covered / covered
-
-        # original panstrain simple scoring metric
-        score = covered * accounted * evenness * evenness
-
-        # Weight each of my kmers by inverse of times it occurs in pan genome
-        # relative to this genome
-        # strain_weights = strain_kmerset.counts * (1.0 / strain_pan_counts)
-        weights = 1.0 / pan_counts
-        strain_total_weight = (counts * weights).sum()
-
-        # Weight of each sample kmer
-        sample_total_weight = (sample_counts * weights).sum()
-
-        # Specificity is a measure of how specific the sample kmers are to
-        # this strain. If they are randomly sampled, this should be close
-        # to 1. A low number indicates that the sample kmers that hit this
-        # strain also tend to be found in other strains. A high number
-        # indicates that more kmers specific to this strain are found that
-        # would be exected from random sampling, e.g., maybe the sample only
-        # contains a chunk of this genome.
-        strain_mean_weight = strain_total_weight / counts.sum()
-        sample_mean_weight = sample_total_weight / sample_count
-        specificity = sample_mean_weight / strain_mean_weight
+    def score_strains(self, strain_names, sample, excludes=None):
+        """
+        Score multiple strains against the sample at once.
 
-        # add in specificity component (best match should be close to 1.0,
-        # higher or lower is worse)
-        weighted_score = score * min(specificity, 1.0 / specificity)
+        :return: List with for each strain a Strain object, or None if the
+                 strain doesn't pass the minimum k-mer fraction or minimum
+                 accounted thresholds.
+        """
 
-        # Estimated relative abundance of this strain, only use ref k-mers actually seen in the sample
-        relative_abundance = 100.0 * kmer_coverage * kmers.size / sample.total_kmers
+        strain_kmersets = [self.load_scorable_strain(name, excludes)
+                           for name in strain_names]
+        scorable_ix = [i for i, kmerset in enumerate(strain_kmersets)
+                       if kmerset is not None]
+        scorable = [strain_kmersets[i] for i in scorable_ix]
+
+        # For each strain, the number of distinct kmers from the sample in
+        # this strain, how many times these occurred in the strain and in the
+        # sample, the same counts weighted by the inverse of times each kmer
+        # occurs in pan genome, and the total count of all strain kmers. Each
+        # strain is compared to the sample in a single pass.
+        sums = kmerizer.strain_sample_sums(
+            sample.kmers, sample.counts,
+            [(kmerset.kmers, kmerset.counts, kmerset.pan_counts)
+             for kmerset in scorable],
+            num_threads=self.threads
+        )
+        (common, strain_counts, sample_counts, strain_total_weights,
+         sample_total_weights, strain_total_counts) = sums
+
+        strain_kmers = np.array([kmerset.kmers.size for kmerset in scorable])
+        sample_total_count = sample.counts.sum()
+
+        # Compute metrics for all strains. Strains without any k-mers in
+        # common with the sample result in NaN's here, but are skipped
+        # below.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # converse of covered: what fraction of pan genome sample kmers
+            # are accounted for by this sample?
+            accounted = sample_counts / sample_total_count
+
+            # what fraction of the distinct strain kmers are in the sample?
+            covered = common / strain_kmers
+
+            # for each distinct kmer, how many times did it occur in the
+            # sample relative to the strain?
+            kmer_coverage = sample_counts / common
+
+            # mean genome coverage from all my kmers
+            genome_coverage = sample_counts / strain_total_counts
+
+            # Lander-Waterman estimate of percentage covered if randomly
+            # distributed across genome (expm1 is accurate for low coverage)
+            est_covered = -np.expm1(-genome_coverage)
+
+            # measure of evenness of coverage
+            evenness = np.minimum(covered / est_covered, est_covered / covered)
+
+            # original panstrain simple scoring metric
+            score = covered * accounted * evenness * evenness
+
+            # Specificity is a measure of how specific the sample kmers are
+            # to this strain. If they are randomly sampled, this should be
+            # close to 1. A low number indicates that the sample kmers that
+            # hit this strain also tend to be found in other strains. A high
+            # number indicates that more kmers specific to this strain are
+            # found that would be exected from random sampling, e.g., maybe
+            # the sample only contains a chunk of this genome.
+            strain_mean_weight = strain_total_weights / strain_counts
+            sample_mean_weight = sample_total_weights / sample_counts
+            specificity = sample_mean_weight / strain_mean_weight
+
+            # add in specificity component (best match should be close to
+            # 1.0, higher or lower is worse)
+            weighted_score = score * np.minimum(specificity, 1.0 / specificity)
+
+            # Estimated relative abundance of this strain, only use ref
+            # k-mers actually seen in the sample
+            relative_abundance = (100.0 * kmer_coverage * common
+                                  / sample.total_kmers)
 
         if self.use_fingerprint:
             # really minHash fraction
             relative_abundance /= self.pangenome.fingerprint_fraction
 
-        return Strain(
-            strain=strain_name,
-            gkmers=strain_kmerset.distinct_kmers,
-            ikmers=strain_kmerset.kmers.size,
-            skmers=sample.kmers.size,
-            cov=covered,
-            kcov=kmer_coverage,
-            gcov=genome_coverage,
-            acct=accounted,
-            even=evenness,
-            spec=specificity,
-            rapct=0,  ## Will be calculated later
-            old_rapct=relative_abundance,
-            wscore=weighted_score,
-            score=score
-        )
+        for i in np.flatnonzero(common == 0):
+            scorable[i].exhausted = True
+
+        # Only create Strain objects for the strains passing the thresholds
+        scores = [None] * len(strain_names)
+        passed = np.flatnonzero((common > 0) & (accounted >= self.min_acct))
+        for i in passed:
+            strain_kmerset = scorable[i]
+            scores[scorable_ix[i]] = Strain(
+                strain=strain_kmerset.name,
+                gkmers=strain_kmerset.distinct_kmers,
+                ikmers=strain_kmerset.kmers.size,
+                skmers=sample.kmers.size,
+                cov=covered[i],
+                kcov=kmer_coverage[i],
+                gcov=genome_coverage[i],
+                acct=accounted[i],
+                even=evenness[i],
+                spec=specificity[i],
+                rapct=0,  ## Will be calculated later
+                old_rapct=relative_abundance[i],
+                wscore=weighted_score[i],
+                score=score[i]
+            )
+
+        return scores
@@ -28,19 +28,26 @@
 #
 
 import io
-import csv
+import re
+import array
 import json
 import math
+import hashlib
 import logging
 import tempfile
 import itertools
 import functools
 import subprocess
+import multiprocessing
 from pathlib import Path
+from operator import itemgetter
+from multiprocessing.pool import ThreadPool
 from enum import Enum, IntFlag, auto
 from typing import Dict, Tuple, Iterable  # noqa
 
 import numpy
+import pandas
+import pysam
 import skbio
 from scipy.stats import poisson, norm
 
@@ -74,27 +81,17 @@ class Allele(IntFlag):
     def from_str(cls, base):
         """Create a new `Allele` object from a single character string."""
 
-        if base not in cls.__members__:
-            return Allele.N
-
-        return cls.__members__[base]
+        return _STR_TO_ALLELE.get(base, Allele.N)
 
     def rc(self):
         """Return reverse-complement allele; only valid for single-allele
         values"""
-        if self.value == Allele.A:
-            return Allele.T
-        if self.value == Allele.C:
-            return Allele.G
-        if self.value == Allele.G:
-            return Allele.C
-        if self.value == Allele.T:
-            return Allele.A
-        return self
+        return _ALLELE_RC.get(self, self)
 
     def __iter__(self):
-        for allele in Allele:
-            if self.value & allele:
+        value = int(self)
+        for allele in INDEX_ALLELES:
+            if value & int(allele):
                 yield allele
 
     def __str__(self):
@@ -105,6 +102,18 @@ class Allele(IntFlag):
             return ",".join(str(v) for v in self)
 
 
+# Allele for each member name, used by `Allele.from_str`
+_STR_TO_ALLELE = dict(Allele.__members__)
+
+# Reverse complement of each single base allele
+_ALLELE_RC = {
+    Allele.A: Allele.T,
+    Allele.C: Allele.G,
+    Allele.G: Allele.C,
+    Allele.T: Allele.A,
+}
+
+
 @functools.lru_cache(maxsize=8)
 def _allele_to_str(value):
     rev_mapping = {v: k for k, v in Allele.__members__.items()}
@@ -112,12 +121,159 @@ def _allele_to_str(value):
     return rev_mapping[value]
 
 
-ALLELE_MASKS = numpy.array([v for v in Allele if v != Allele.N])
+ALLELE_MASKS = numpy.array([v for v in Allele if v != Allele.N],
+                           dtype=numpy.uint8)
 
 ALLELE_INDEX = {
     a: i for i, a in enumerate(v for v in Allele if v != Allele.N)
 }
 
+# Lookup tables from `Allele` value to index in ALLELE_INDEX, for the allele
+# itself and for its reverse complement. Only valid for single alleles,
+# any other value maps to 255.
+_ALLELE_TABLE_SIZE = 1 << len(ALLELE_INDEX)
+ALLELE_INDEX_FWD = tuple(
+    ALLELE_INDEX.get(Allele(v) if v else Allele.N, 255)
+    for v in range(_ALLELE_TABLE_SIZE)
+)
+ALLELE_INDEX_RC = tuple(
+    ALLELE_INDEX.get(Allele(v).rc() if v else Allele.N, 255)
+    for v in range(_ALLELE_TABLE_SIZE)
+)
+
+# Lookup table from ASCII base to `Allele` value, anything other than an
+# uppercase A, C, G or T maps to Allele.N
+BASE_TO_ALLELE = numpy.zeros(256, dtype=numpy.uint8)
+BASE_TO_ALLELE[[ord(base) for base in "ACGT"]] = [
+    Allele.A, Allele.C, Allele.G, Allele.T]
+
+# Allele for the first character of an entry in a pysam pileup column's
+# `get_query_sequences()`. Bases on the reverse strand are lowercase, and
+# deletions and reference skips are marked with '*', '>' or '<'.
+PILEUP_ALLELES = {
+    **{base: Allele.from_str(base) for base in "ACGTN"},
+    **{base.lower(): Allele.from_str(base) for base in "ACGTN"},
+    '*': Allele.DEL,
+    '>': Allele.DEL,
+    '<': Allele.DEL,
+}
+
+# Allele index (see `ALLELE_INDEX`) for each pysam pileup column entry
+# consisting of a single base or deletion marker, or INVALID_ALLELE_INDEX if
+# it's not a real base (e.g. N). Entries followed by an indel are parsed with
+# `parse_pileup_entry`.
+INVALID_ALLELE_INDEX = 255
+PILEUP_ALLELE_INDEX = {
+    entry: ALLELE_INDEX_FWD[allele] for entry, allele in PILEUP_ALLELES.items()
+}
+
+# Alleles by their index in ALLELE_INDEX
+INDEX_ALLELES = tuple(ALLELE_INDEX)
+
+# A single alternative alignment in a BWA XA tag: scaffold,[+-]pos,CIGAR,NM;
+XA_ALIGNMENT_RE = re.compile(r'([^,;]+),([-+]?\d+),([^,;]+),(\d+)')
+
+# CIGAR operations of clipped or gapped alternative alignments
+XA_IGNORED_CIGAR_OPS = frozenset('SHDI')
+
+# Number of alleles present in each possible combination of `Allele` flags
+ALLELE_POPCOUNT = numpy.array([bin(i).count("1")
+                               for i in range(_ALLELE_TABLE_SIZE)],
+                              dtype=numpy.uint8)
+
+# Suffix of the files in a reference cache directory with the cached
+# sequences of a FASTA file, see `Reference`
+REFERENCE_CACHE_SUFFIX = ".seqcache.npz"
+
+# Number of buffered pileup observations per scaffold after which they're
+# added to the scaffold's count arrays
+PILEUP_BUFFER_SIZE = 1 << 20
+
+# Arrays of `ScaffoldCallData` filled while processing pileups, which pileup
+# worker processes send back to be merged
+PILEUP_ARRAYS = ("allele_counts", "allele_quals", "mq_sum", "bad")
+
+# SAM flag bits checked during read QC
+BAM_FPAIRED = 0x1
+BAM_FPROPER_PAIR = 0x2
+BAM_FMUNMAP = 0x8
+BAM_FREVERSE = 0x10
+BAM_FSUPPLEMENTARY = 0x800
+
+
+def count_alleles(values):
+    """Count the number of alleles (i.e. bits set) in an array of `Allele`
+    combinations."""
+
+    if hasattr(numpy, 'bitwise_count'):
+        return numpy.bitwise_count(values)
+
+    return ALLELE_POPCOUNT[values]
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_xa_tag(xa):
+    """
+    Parse the alternative alignments in a BWA XA tag.
+
+    The result is cached, because a read's alternative alignments are
+    checked again in every pileup column the read covers.
+
+    Returns
+    -------
+    tuple
+        Tuples of (scaffold, pos, cigar, nm) for each alternative alignment.
+        `pos` is 1-based and negative for alignments on the reverse strand.
+    """
+
+    return tuple(
+        (scaffold, int(pos), cigar, int(nm))
+        for scaffold, pos, cigar, nm in XA_ALIGNMENT_RE.findall(xa)
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def ungapped_xa_alignments(xa, nm):
+    """
+    Alternative alignments in a BWA XA tag without clipping or indels, and
+    with at most `nm` mismatches. Cached like `parse_xa_tag`.
+
+    Returns
+    -------
+    tuple
+        Tuples of (scaffold, pos, rc), with `pos` 0-based.
+    """
+
+    alignments = []
+    for scaffold, pos, cigar, alt_nm in parse_xa_tag(xa):
+        if not XA_IGNORED_CIGAR_OPS.isdisjoint(cigar):
+            # Clipped alignment, ignore. Also ignore alt alignments
+            # with indels to keep things in sync.
+            logger.debug("Ignoring clipped alternative alignment")
+            continue
+
+        if alt_nm <= nm:
+            # Turn into a 0-based coordinate system
+            alignments.append((scaffold, abs(pos) - 1, pos < 0))
+
+    return tuple(alignments)
+
+
+def parse_pileup_entry(entry):
+    """
+    Allele index (see `ALLELE_INDEX`) of a pysam pileup column entry which
+    includes an indel, e.g. 'A+2AT' or 'A-1N'. A base followed by an
+    insertion is counted as insertion. Returns INVALID_ALLELE_INDEX if the
+    entry doesn't start with a real base.
+    """
+
+    base = PILEUP_ALLELES.get(entry[:1], Allele.N)
+    if base != Allele.DEL and entry[1:2] == '+':
+        # base followed by an insertion
+        base = Allele.INS
+
+    return ALLELE_INDEX_FWD[base]
+
 
 def poisson_coverage_cutoff(mean, cutoff=0.9999999):
     """
@@ -154,26 +310,27 @@ def jukes_cantor_distance(snp_rate):
 
 
 def count_ts_tv(array1, array2):
-    """Count number of transitions and transversions in an Allele array."""
+    """Count number of transitions and transversions in an Allele array.
 
-    assert len(array1) == len(array2)
+    Both arguments should be numpy arrays of `Allele` values of equal length,
+    e.g. `scaffold.refmask[snps]` and `scaffold.strong[snps]`. Positions
+    where both arrays hold the same allele are counted as neither.
+    """
+
+    array1 = numpy.asarray(array1)
+    array2 = numpy.asarray(array2)
 
-    transition_pairs = frozenset([
-        (Allele.A, Allele.G),
-        (Allele.G, Allele.A),
-        (Allele.C, Allele.T),
-        (Allele.T, Allele.C)
-    ])
+    assert len(array1) == len(array2)
 
-    transitions = 0
-    transversions = 0
-    for pair in zip(array1, array2):
-        if pair in transition_pairs:
-            transitions += 1
-        elif pair[0] != pair[1]:
-            transversions += 1
+    transitions = numpy.count_nonzero(
+        ((array1 == Allele.A) & (array2 == Allele.G)) |
+        ((array1 == Allele.G) & (array2 == Allele.A)) |
+        ((array1 == Allele.C) & (array2 == Allele.T)) |
+        ((array1 == Allele.T) & (array2 == Allele.C))
+    )
+    transversions = numpy.count_nonzero(array1 != array2) - transitions
 
-    return transitions, transversions
+    return int(transitions), int(transversions)
 
 
 def kimura_distance(transitions, transversions):
@@ -209,10 +366,10 @@ class CIGAROperation(Enum):
 
     @classmethod
     def from_str(cls, op):
-        if op in cls.value_map():
+        try:
             return cls.value_map()[op]
-
-        raise ValueError(f"Invalid CIGAR operation '{op}'")
+        except KeyError:
+            raise ValueError(f"Invalid CIGAR operation '{op}'") from None
 
 
 CIGAROpWithLength = Tuple[int, CIGAROperation]
@@ -279,21 +436,44 @@ def get_aligned_pairs_cigar(cigar, scaffold_pos):
             scaffold_pos += op_len
 
 
+@functools.lru_cache(maxsize=1024)
+def cigar_reference_length(cigar):
+    """
+    Number of reference positions covered by an alignment with the given
+    CIGAR string, consistent with `get_aligned_pairs_cigar`. Cached, as most
+    alternative alignments share a few CIGAR strings (e.g. '150M').
+    """
+
+    return sum(
+        op_len for op_len, cigar_op in parse_cigar_string(cigar)
+        if cigar_op in {CIGAROperation.MATCH, CIGAROperation.SEQ_MISMATCH,
+                        CIGAROperation.SEQ_MATCH, CIGAROperation.DELETION}
+    )
+
+
 class Reference:
     """
     Some helper function to manage coordinates on a concatenated reference.
+
+    If `cache_dir` is given, the parsed sequences are cached in that
+    directory, and loaded from there on later runs if the FASTA file hasn't
+    changed.
     """
-    def __init__(self, fasta):
+    def __init__(self, fasta, cache_dir=None):
         self.fasta = fasta
-
-        with open_compressed(fasta) as f:
-            self.scaffolds = {
-                r.metadata['id']: r for r in skbio.io.read(f, 'fasta')
-            }
+        self.scaffolds = self._load_scaffolds(fasta, cache_dir)
 
         self.lengths = [len(s) for s in self.scaffolds.values()]
         self.length = sum(self.lengths)
 
+        # Genome-wide start coordinate of each scaffold, used to translate
+        # coordinates without scanning all scaffolds
+        self._scaffold_names = list(self.scaffolds.keys())
+        self._offsets = numpy.concatenate(
+            ([0], numpy.cumsum(self.lengths, dtype=numpy.int64)))
+        self._scaffold_offsets = dict(zip(self._scaffold_names,
+                                          self._offsets[:-1].tolist()))
+
         logger.info("Reference %s has %d scaffolds with a total of %d bases.",
                     fasta, len(self.scaffolds), self.length)
 
@@ -318,6 +498,78 @@ class Reference:
                            "repetitiveness of the concatenated reference. "
                            "Abundance metrics may be skewed.")
 
+    @staticmethod
+    def _load_scaffolds(fasta, cache_dir=None):
+        """
+        Read all scaffolds from the FASTA file, or from the cache in
+        `cache_dir`. The cache stores the size and checksum of the FASTA file
+        it was created from, and is only used if both still match.
+        """
+
+        if cache_dir is None:
+            return Reference._parse_scaffolds(fasta)
+
+        fasta_path = Path(fasta).resolve()
+        # Cache files are named after the FASTA file, with a hash of its full
+        # path, so FASTA files with the same name don't share a cache
+        path_hash = hashlib.sha1(str(fasta_path).encode()).hexdigest()[:16]
+        cache = (Path(cache_dir) /
+                 f"{fasta_path.name}.{path_hash}{REFERENCE_CACHE_SUFFIX}")
+
+        fasta_size = fasta_path.stat().st_size
+        fasta_digest = _file_digest(fasta_path)
+
+        try:
+            with numpy.load(cache) as data:
+                if (int(data['fasta_size']) == fasta_size and
+                        str(data['fasta_digest']) == fasta_digest):
+                    names = data['names'].tolist()
+                    offsets = data['offsets']
+                    seqs = data['seqs']
+
+                    logger.info("Loading reference sequences from cache %s",
+                                cache)
+                    return {
+                        name: skbio.Sequence(seqs[start:end],
+                                             metadata={'id': name})
+                        for name, start, end in zip(names, offsets[:-1],
+                                                    offsets[1:])
+                    }
+
+                logger.info("Reference %s changed, updating cache %s",
+                            fasta, cache)
+        except (OSError, KeyError, ValueError):
+            # No (valid) cache available, parse the FASTA file
+            pass
+
+        scaffolds = Reference._parse_scaffolds(fasta)
+
+        lengths = [len(s) for s in scaffolds.values()]
+        seqs = (numpy.concatenate([s.values.view(numpy.uint8)
+                                   for s in scaffolds.values()])
+                if scaffolds else numpy.zeros(0, dtype=numpy.uint8))
+        try:
+            Path(cache_dir).mkdir(parents=True, exist_ok=True)
+            with cache.open('wb') as f:
+                numpy.savez(
+                    f, names=numpy.array(list(scaffolds.keys()), dtype=str),
+                    offsets=numpy.concatenate(([0], numpy.cumsum(lengths))),
+                    seqs=seqs, fasta_size=fasta_size,
+                    fasta_digest=fasta_digest
+                )
+        except OSError as e:
+            logger.warning("Could not write reference cache %s: %s", cache,
+                           e)
+
+        return scaffolds
+
+    @staticmethod
+    def _parse_scaffolds(fasta):
+        with open_compressed(fasta) as f:
+            return {
+                r.metadata['id']: r for r in skbio.io.read(f, 'fasta')
+            }
+
     def scaffold_coord(self, coord):
         """
         Turn a zero-based genome-wide coordinate into a scaffold & coordinate
@@ -326,11 +578,11 @@ class Reference:
         :param coord: zero-based genome-wide coordinate
         :return: (scaffold, scaffoldCoord)
         """
-        offset = 0
-        for scaffold, length in zip(self.scaffolds.values(), self.lengths):
-            if coord < offset + length:
-                return scaffold.metadata['id'], coord + 1 - offset
-            offset += length
+        if not 0 <= coord < self.length:
+            return None
+
+        i = int(numpy.searchsorted(self._offsets, coord, side='right')) - 1
+        return self._scaffold_names[i], coord + 1 - int(self._offsets[i])
 
     def scaffold_to_genome_coord(self, scaffold_name, coord):
         """
@@ -341,16 +593,27 @@ class Reference:
         :param coord: 1-based scaffold coordinate
         :return: genomeCoord
         """
-        offset = 0
-        for scaffold, length in zip(self.scaffolds, self.lengths):
-            if scaffold.name == scaffold_name:
-                return offset + coord - 1
-            offset += length
+        offset = self._scaffold_offsets.get(scaffold_name)
+        if offset is None:
+            return None
+
+        return offset + coord - 1
 
     def get_sequence(self, name, coord, length=1):
         return self.scaffolds[name].seq[coord-1:coord+length-1]
 
 
+def _file_digest(path, block_size=1 << 20):
+    """SHA-256 hex digest of a file's contents."""
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
 def analyze_repetitiveness(fpath, minmatch=300):
     """
     For StrainGR variant calling we often concatenate multiple reference
@@ -368,10 +631,7 @@ def analyze_repetitiveness(fpath, minmatch=300):
         raise ValueError("Can't analyze gzipped FASTA files.")
 
     ref = Reference(fpath)
-    repeat_masks = {
-        contig: numpy.zeros((length,))
-        for contig, length in zip(ref.scaffolds.keys(), ref.lengths)
-    }
+    contig_lengths = dict(zip(ref.scaffolds.keys(), ref.lengths))
 
     with tempfile.TemporaryDirectory() as tmpdir:
         prefix = f"{tmpdir}/nucmer"
@@ -393,30 +653,56 @@ def analyze_repetitiveness(fpath, minmatch=300):
 
     fieldnames = ['start1', 'end1', 'start2', 'end2', 'len1', 'len2',
                   'identity', 'contig1', 'contig2']
-    in_iter = itertools.islice(io.StringIO(delta), 4, None)
-    reader = csv.DictReader(in_iter, fieldnames, delimiter='\t')
-
-    for alignment in reader:
-        if alignment['contig1'] == alignment['contig2']:
-            if alignment['start1'] == alignment['start2']:
-                # Same element
-                continue
-
-        start1 = int(alignment['start1']) - 1
-        end1 = int(alignment['end1'])
+    coord_dtypes = {'start1': numpy.int64, 'end1': numpy.int64,
+                    'start2': numpy.int64, 'end2': numpy.int64,
+                    'contig1': str, 'contig2': str}
+    try:
+        coords = pandas.read_csv(
+            io.StringIO(delta), sep='\t', skiprows=4, header=None,
+            names=fieldnames, usecols=list(coord_dtypes), dtype=coord_dtypes)
+    except pandas.errors.EmptyDataError:
+        coords = pandas.DataFrame(
+            {col: pandas.Series(dtype=dtype)
+             for col, dtype in coord_dtypes.items()})
+
+    # Skip alignments of an element with itself
+    same = ((coords['contig1'] == coords['contig2']) &
+            (coords['start1'] == coords['start2']))
+    coords = coords[~same]
+
+    # Alignments to the reverse strand have start2 > end2
+    start2 = numpy.minimum(coords['start2'], coords['end2'])
+    end2 = numpy.maximum(coords['start2'], coords['end2'])
+
+    # Convert to zero-based half-open intervals, for both sides of each
+    # alignment
+    intervals = pandas.DataFrame({
+        'contig': numpy.concatenate([coords['contig1'], coords['contig2']]),
+        'start': numpy.concatenate([coords['start1'] - 1, start2 - 1]),
+        'end': numpy.concatenate([coords['end1'], end2]),
+    })
+    intervals_per_contig = {
+        contig: group for contig, group in intervals.groupby('contig')
+    }
 
-        start2 = int(alignment['start2'])
-        end2 = int(alignment['end2'])
+    # Mark all intervals using a difference array: +1 at each interval start
+    # and -1 at each end, a position is repetitive if it's covered by at
+    # least one interval.
+    repeat_masks = {}
+    for contig, length in contig_lengths.items():
+        group = intervals_per_contig.get(contig)
+        if group is None:
+            repeat_masks[contig] = numpy.zeros(length, dtype=bool)
+            continue
 
-        if start2 > end2:
-            start2, end2 = end2, start2
+        starts = numpy.clip(group['start'].to_numpy(), 0, length)
+        ends = numpy.clip(group['end'].to_numpy(), 0, length)
 
-        start2 -= 1
+        diff = numpy.zeros(length + 1, dtype=numpy.int64)
+        numpy.add.at(diff, starts, 1)
+        numpy.add.at(diff, ends, -1)
 
-        contig1 = alignment['contig1']
-        contig2 = alignment['contig2']
-        repeat_masks[contig1][start1:end1] = True
-        repeat_masks[contig2][start2:end2] = True
+        repeat_masks[contig] = numpy.cumsum(diff[:-1]) > 0
 
     return repeat_masks
 
@@ -455,16 +741,31 @@ class VariantCallData:
         self.passing_reads = 0
         self.lowmq_reads = 0
 
+    def set_regions(self, regions):
+        """
+        Restrict coverage statistics, calls and gaps to the given list of
+        (scaffold, start, end) regions. Scaffolds without any region aren't
+        called at all.
+        """
+
+        for scaffold in self.scaffolds_data.values():
+            scaffold.region_mask = numpy.zeros(scaffold.length, dtype=bool)
+
+        for name, start, end in regions:
+            self.scaffolds_data[name].region_mask[start:end] = True
+
+    @property
+    def called_length(self):
+        """Number of positions within the processed regions."""
+
+        return sum(s.called_length for s in self.scaffolds_data.values())
+
     def load_reference(self, reference):
         for name, scaffold in reference.scaffolds.items():
             logger.info("Building refmask for scaffold %s", name)
 
-            bases = [b'A', b'C', b'G', b'T']
-            alleles = [Allele.A, Allele.C, Allele.G, Allele.T]
-
-            for base, allele in zip(bases, alleles):
-                ix = scaffold.values == base
-                self.scaffolds_data[name].refmask[ix] = allele
+            self.scaffolds_data[name].refmask[:] = BASE_TO_ALLELE[
+                scaffold.values.view(numpy.uint8)]
 
         for scaffold, repetitiveness in reference.repetitiveness.items():
             self.scaffolds_data[scaffold].repetitiveness = repetitiveness
@@ -480,10 +781,14 @@ class VariantCallData:
         position where it aligns.
         """
 
-        scaffold = alignment.reference_name
-        for querypos, refpos in alignment.get_aligned_pairs():
-            if refpos is not None:
-                self.scaffolds_data[scaffold].bad[refpos] += 1
+        if alignment.reference_end is None:
+            # No aligned bases
+            return
+
+        # The aligned reference positions of a read form a single contiguous
+        # range, which is buffered and counted in bulk later.
+        self.scaffolds_data[alignment.reference_name].add_bad_range(
+            alignment.reference_start, alignment.reference_end)
 
     def lowmq_read(self, alignment):
         """
@@ -496,77 +801,108 @@ class VariantCallData:
 
         self.lowmq_reads += 1
 
-        scaffold = alignment.reference_name
-        for querypos, refpos in alignment.get_aligned_pairs():
-            if refpos is not None:
-                self.scaffolds_data[scaffold].lowmq_count[refpos] += 1
+        if alignment.reference_end is not None:
+            self.scaffolds_data[alignment.reference_name].add_lowmq_range(
+                alignment.reference_start, alignment.reference_end)
 
         # Check alternative alignments and mark as lowmq too
         for alt_aln in self._alternative_alignments(alignment):
             scaffold, pos, cigar, *_ = alt_aln
+            end = pos + cigar_reference_length(cigar)
 
-            for querypos, refpos in get_aligned_pairs_cigar(cigar, pos):
-                if refpos is not None:
-                    self.scaffolds_data[scaffold].lowmq_count[refpos] += 1
+            self.scaffolds_data[scaffold].add_lowmq_range(pos, end)
 
     def _alternative_alignments(self, alignment):
-        if alignment.has_tag("XA"):
+        try:
             xa = alignment.get_tag("XA")
-            nm = int(alignment.get_tag("NM"))
+        except KeyError:
+            return
 
-            for aln in xa.split(';'):
-                if not aln:
-                    continue
+        nm = int(alignment.get_tag("NM"))
 
-                scaffold, pos, cigar, alt_nm = aln.split(',')
-                pos = int(pos)
-                alt_nm = int(alt_nm)
-                alt_rc = pos < 0
+        for scaffold, pos, cigar, alt_nm in parse_xa_tag(xa):
+            alt_rc = pos < 0
 
-                if alt_nm <= nm:
-                    yield scaffold, abs(pos) - 1, cigar, alt_nm, alt_rc
+            if alt_nm <= nm:
+                yield scaffold, abs(pos) - 1, cigar, alt_nm, alt_rc
 
-    def passing_read(self, scaffold):
-        self.passing_reads += 1
-        self.scaffolds_data[scaffold].read_count += 1
+    def passing_read(self, scaffold, count=1):
+        self.passing_reads += count
+        self.scaffolds_data[scaffold].read_count += count
 
     def bad_allele(self, scaffold, pos):
         self.scaffolds_data[scaffold].bad[pos] += 1
 
     def good_read(self, scaffold, pos, allele, base_quality, mapping_quality,
                   rc):
-        base = allele.rc() if rc else allele
-        ix = ALLELE_INDEX[base]
+        ix = ALLELE_INDEX_RC[allele] if rc else ALLELE_INDEX_FWD[allele]
+
+        self.scaffolds_data[scaffold].add_observation(
+            pos, ix, base_quality, mapping_quality)
 
-        scaffold_data = self.scaffolds_data[scaffold]
-        scaffold_data.alleles[pos, 0, ix] += 1
-        scaffold_data.alleles[pos, 1, ix] += base_quality
-        scaffold_data.mq_sum[pos] += mapping_quality
+    def flush_read_ranges(self):
+        """Add the buffered ranges of discarded and low mapping quality reads
+        to the `bad` and `lowmq_count` arrays."""
 
-    def analyze_coverage(self):
         for scaffold in self.scaffolds_data.values():
-            scaffold.calculate_coverage()
+            scaffold.flush_read_ranges()
 
-        all_coverage = numpy.concatenate([s.coverage for s in
-                                          self.scaffolds_data.values()])
-        all_high_cov = numpy.concatenate([s.high_coverage for s in
-                                          self.scaffolds_data.values()])
-        all_normal_cov = all_coverage[~all_high_cov]
+    def flush_observations(self):
+        """Add all buffered pileup observations to the count arrays."""
+
+        for scaffold in self.scaffolds_data.values():
+            scaffold.flush_observations()
+
+    def _for_each_scaffold(self, func, threads=1):
+        """Call `func` for each scaffold's data. Scaffolds are independent,
+        so with multiple threads they're processed concurrently (numpy
+        releases the GIL for most of the work)."""
 
-        self.mean_coverage = numpy.sum(all_normal_cov) / len(all_normal_cov)
-        self.median_coverage = numpy.median(all_coverage)
+        scaffolds = list(self.scaffolds_data.values())
+        if threads > 1 and len(scaffolds) > 1:
+            with ThreadPool(min(threads, len(scaffolds))) as pool:
+                pool.map(func, scaffolds, chunksize=1)
+        else:
+            for scaffold in scaffolds:
+                func(scaffold)
+
+    def analyze_coverage(self, threads=1):
+        self._for_each_scaffold(ScaffoldCallData.calculate_coverage, threads)
+
+        # Mean coverage excluding too high coverage regions, computed from
+        # per scaffold totals to avoid concatenating and masking all arrays
+        normal_cov_sum = 0
+        normal_cov_count = 0
+        for s in self.scaffolds_data.values():
+            normal = s.normal_coverage_mask()
+            normal_cov_sum += int(numpy.sum(s.coverage, where=normal))
+            normal_cov_count += int(numpy.count_nonzero(normal))
+
+        self.mean_coverage = (normal_cov_sum / normal_cov_count
+                              if normal_cov_count else float('nan'))
+
+        # The concatenated array is a temporary copy, so the median can
+        # partition it in place
+        all_coverage = numpy.concatenate([s.in_regions(s.coverage) for s in
+                                          self.scaffolds_data.values()])
+        self.median_coverage = (numpy.median(all_coverage,
+                                             overwrite_input=True)
+                                if len(all_coverage) else 0)
 
         return self
 
-    def call_alleles(self, min_pileup_qual, min_qual_frac):
-        for scaffold in self.scaffolds_data.values():
-            scaffold.call_alleles(min_pileup_qual, min_qual_frac)
+    def call_alleles(self, min_pileup_qual, min_qual_frac, threads=1):
+        self._for_each_scaffold(
+            lambda scaffold: scaffold.call_alleles(min_pileup_qual,
+                                                   min_qual_frac),
+            threads
+        )
 
         return self
 
-    def find_gaps(self):
-        for scaffold in self.scaffolds_data.values():
-            scaffold.find_gaps(self.min_gap_size)
+    def find_gaps(self, threads=1):
+        self._for_each_scaffold(
+            lambda scaffold: scaffold.find_gaps(self.min_gap_size), threads)
 
         return self
 
@@ -615,31 +951,34 @@ class VariantCallData:
             for scaffold, abundance in abun.items()
         }
 
+        called_length = self.called_length
         for scaffold in self.scaffolds_data.values():
             # Locations with strong evidence for the reference base
             confirmed = (scaffold.strong & scaffold.refmask)
 
+            # Number of alleles with strong evidence at each position
+            num_alleles = count_alleles(scaffold.strong)
+
             # Positions with only a single allele (whether it's the reference
             # or not)
-            # (x & (x - 1)) turns of highest bit in x, this will result in a
-            # non-zero value if we have multiple alleles (that is, multiple
-            # bits set)
-            singles = (scaffold.strong & (scaffold.strong - 1)) == 0
-            singles &= scaffold.strong > 0
+            singles = num_alleles == 1
             num_singles = numpy.count_nonzero(singles)
             total_singles += num_singles
 
             # Locations where we have strong evidence something else than the
-            # reference
-            snps = ((scaffold.strong & ~scaffold.refmask) > 0) & singles
+            # reference. The reference mask holds at most one allele, so at
+            # single allele positions this is a plain inequality.
+            snps = singles & (scaffold.strong != scaffold.refmask)
 
             # Locations where we have strong evidence for multiple bases (could
             # be both reference or not)
-            multi = (scaffold.strong & (scaffold.strong - 1)) > 0
+            multi = num_alleles > 1
+            num_multi = numpy.count_nonzero(multi)
 
-            # Consider a locus callable if we have a strong call
-            num_callable = numpy.count_nonzero(scaffold.strong)
-            callable_pct = pct(num_callable, scaffold.length)
+            # Consider a locus callable if we have a strong call, i.e. it's
+            # either a single or a multi-allelic location
+            num_callable = num_singles + num_multi
+            callable_pct = pct(num_callable, scaffold.called_length)
             total_callable += num_callable
 
             num_confirmed = numpy.count_nonzero(confirmed)
@@ -650,16 +989,15 @@ class VariantCallData:
             snp_pct = pct(num_snps, num_singles)
             total_snps += num_snps
 
-            num_multi = numpy.count_nonzero(multi)
             multi_pct = pct(num_multi, num_callable)
             total_multi += num_multi
 
             num_lowmq = numpy.count_nonzero(scaffold.lowmq)
-            lowmq_pct = pct(num_lowmq, scaffold.length)
+            lowmq_pct = pct(num_lowmq, scaffold.called_length)
             total_lowmq += num_lowmq
 
             num_high_cov = numpy.count_nonzero(scaffold.high_coverage)
-            high_pct = pct(num_high_cov, scaffold.length)
+            high_pct = pct(num_high_cov, scaffold.called_length)
             total_high_cov += num_high_cov
 
             num_gaps = len(scaffold.gaps)
@@ -692,7 +1030,7 @@ class VariantCallData:
                 "confirmed": num_confirmed,
                 "confirmedPct": confirmed_pct,
                 "single": num_singles,
-                "singlePct": pct(num_singles, scaffold.length),
+                "singlePct": pct(num_singles, scaffold.called_length),
                 "snps": num_snps,
                 "snpPct": snp_pct,
                 "multi": num_multi,
@@ -724,19 +1062,19 @@ class VariantCallData:
             "uReads": self.passing_reads,
             "abundance": rel_abun_all * 100,
             "callable": total_callable,
-            "callablePct": pct(total_callable, self.reference_length),
+            "callablePct": pct(total_callable, called_length),
             "confirmed": total_confirmed,
             "confirmedPct": pct(total_confirmed, total_callable),
             "single": total_singles,
-            "singlePct": pct(total_singles, self.reference_length),
+            "singlePct": pct(total_singles, called_length),
             "snps": total_snps,
             "snpPct": pct(total_snps, total_singles),
             "multi": total_multi,
             "multiPct": pct(total_multi, total_callable),
             "lowmq": total_lowmq,
-            "lowmqPct": pct(total_lowmq, self.reference_length),
+            "lowmqPct": pct(total_lowmq, called_length),
             "high": total_high_cov,
-            "highPct": pct(total_high_cov, self.reference_length),
+            "highPct": pct(total_high_cov, called_length),
             "gapCount": total_gaps,
             "gapLength": total_gap_length,
             "transitions": total_ts,
@@ -757,13 +1095,20 @@ class ScaffoldCallData:
         self.length = length
         self.read_count = 0
 
+        # Note: the arrays below are allocated with `numpy.zeros`, which for
+        # large arrays maps zero pages lazily. Memory is only committed for
+        # pages that are written to, so sparsely covered scaffolds cost
+        # little. Don't replace these with `numpy.empty` + `fill`, which
+        # touches every page.
         self.refmask = numpy.zeros((self.length,), dtype=numpy.uint8)
 
         # Store for each position and per possible allele the counts and sum
-        # of base qualities. We use len(Allele)-1 because we store nothing
-        # for Allele.N.
-        self.alleles = numpy.zeros((self.length, 2, len(Allele)-1),
-                                   dtype=numpy.uint32)
+        # of base qualities, in separate arrays. Alleles are indexed
+        # according to ALLELE_INDEX (nothing is stored for Allele.N).
+        self.allele_counts = numpy.zeros((self.length, len(ALLELE_INDEX)),
+                                         dtype=numpy.uint32)
+        self.allele_quals = numpy.zeros((self.length, len(ALLELE_INDEX)),
+                                        dtype=numpy.uint32)
 
         # Number of reads rejected for some reason
         self.bad = numpy.zeros((self.length,), dtype=numpy.uint32)
@@ -800,6 +1145,143 @@ class ScaffoldCallData:
 
         self.gaps = []
 
+        # Positions within the regions processed by `VariantCaller`, or None
+        # if the whole scaffold was processed. Coverage statistics, calls
+        # and gaps only consider these positions.
+        self.region_mask = None
+
+        # Buffers with pileup observations not yet added to the arrays
+        # above: position, allele index, base quality and mapping quality.
+        # Base and mapping qualities are stored in a single byte in BAM
+        # files, so they're buffered as uint8 too.
+        self._observations = self._new_observation_buffers()
+
+        # Buffers with the aligned ranges of discarded and low mapping
+        # quality reads not yet added to `bad` and `lowmq_count`, as
+        # consecutive start and end positions.
+        self._bad_ranges = array.array('q')
+        self._lowmq_ranges = array.array('q')
+
+        # Depth of good reads per position, see `_read_depths`
+        self._depths = None
+
+        # Number of pileup observations added to the count arrays
+        self.num_observations = 0
+
+    @staticmethod
+    def _new_observation_buffers():
+        return (array.array('q'), array.array('B'), array.array('B'),
+                array.array('B'))
+
+    def add_observation(self, pos, allele_ix, base_quality, mapping_quality):
+        """
+        Record a good quality base at the given position. Observations are
+        buffered and added to the count arrays in bulk, call
+        `flush_observations` before using the arrays.
+        """
+
+        positions, indices, quals, mqs = self._observations
+        positions.append(pos)
+        indices.append(allele_ix)
+        quals.append(base_quality)
+        mqs.append(mapping_quality)
+
+        if len(positions) >= PILEUP_BUFFER_SIZE:
+            self.flush_observations()
+
+    def add_observation_arrays(self, positions, allele_indices,
+                               base_qualities, mapping_qualities):
+        """
+        Add many good quality bases, given as numpy arrays, to the count
+        arrays directly.
+        """
+
+        numpy.add.at(self.allele_counts, (positions, allele_indices), 1)
+        numpy.add.at(self.allele_quals, (positions, allele_indices),
+                     base_qualities)
+        numpy.add.at(self.mq_sum, positions, mapping_qualities)
+
+        self.num_observations += len(positions)
+        self._depths = None
+
+    def add_bad_range(self, start, end):
+        """Count a discarded read at positions `start` to `end`. Buffered
+        like `add_observation`, call `flush_read_ranges` before using
+        `bad`."""
+
+        self._bad_ranges.extend((start, end))
+        if len(self._bad_ranges) >= PILEUP_BUFFER_SIZE:
+            self.flush_read_ranges()
+
+    def add_lowmq_range(self, start, end):
+        """Count a low mapping quality read at positions `start` to `end`.
+        Buffered like `add_bad_range`."""
+
+        self._lowmq_ranges.extend((start, end))
+        if len(self._lowmq_ranges) >= PILEUP_BUFFER_SIZE:
+            self.flush_read_ranges()
+
+    def flush_read_ranges(self):
+        if self._bad_ranges:
+            self.bad += self._range_counts(self._bad_ranges)
+            self._bad_ranges = array.array('q')
+
+        if self._lowmq_ranges:
+            self.lowmq_count += self._range_counts(self._lowmq_ranges)
+            self._lowmq_ranges = array.array('q')
+
+    def _range_counts(self, ranges):
+        """Number of ranges covering each position, from the cumulative sum
+        of +1 at each range start and -1 at each range end."""
+
+        bounds = numpy.frombuffer(ranges, dtype=numpy.int64).reshape(-1, 2)
+        bounds = bounds.clip(0, self.length)
+        bounds = bounds[bounds[:, 0] < bounds[:, 1]]
+
+        size = self.length + 1
+        delta = (numpy.bincount(bounds[:, 0], minlength=size) -
+                 numpy.bincount(bounds[:, 1], minlength=size))
+
+        return delta[:-1].cumsum().astype(numpy.uint32)
+
+    def flush_observations(self):
+        positions, indices, quals, mqs = self._observations
+        if not positions:
+            return
+
+        self.add_observation_arrays(
+            numpy.frombuffer(positions, dtype=numpy.int64),
+            numpy.frombuffer(indices, dtype=numpy.uint8),
+            numpy.frombuffer(quals, dtype=numpy.uint8),
+            numpy.frombuffer(mqs, dtype=numpy.uint8)
+        )
+
+        self._observations = self._new_observation_buffers()
+
+    def pileup_arrays(self):
+        """The arrays filled while processing pileups, see
+        `add_pileup_arrays`."""
+
+        return {name: getattr(self, name) for name in PILEUP_ARRAYS}
+
+    def add_pileup_arrays(self, arrays):
+        """Add pileup arrays from another `ScaffoldCallData` instance for
+        the same scaffold, e.g. one filled by a pileup worker process."""
+
+        for name, values in arrays.items():
+            getattr(self, name)[:] += values
+
+        self._depths = None
+
+    def _read_depths(self):
+        """Depth of good reads at each position. Computed once, and shared
+        by `calculate_coverage` and `find_gaps`."""
+
+        if self._depths is None:
+            self._depths = self.allele_counts.sum(axis=-1)
+
+        return self._depths
+
     def calculate_coverage(self):
         """
         Calculate coverage for each position, which is calculated from
@@ -814,9 +1296,14 @@ class ScaffoldCallData:
         Here, we use the median coverage rather than the mean since our
         coverage might be dominated by conserved regions.
         """
-        self.coverage = self.alleles[:, 0].sum(axis=-1) + self.lowmq_count
-        self.mean_coverage = numpy.sum(self.coverage) / self.length
-        self.median_coverage = numpy.median(self.coverage)
+        self.coverage = self._read_depths() + self.lowmq_count
+        coverage = self.in_regions(self.coverage)
+        if len(coverage):
+            self.mean_coverage = numpy.sum(coverage) / len(coverage)
+            self.median_coverage = numpy.median(coverage)
+        else:
+            self.mean_coverage = 0.0
+            self.median_coverage = 0
 
         self.coverage_cutoff = poisson_coverage_cutoff(
             max(0.5, self.median_coverage))
@@ -826,34 +1313,46 @@ class ScaffoldCallData:
                     self.median_coverage, self.coverage_cutoff)
 
         self.high_coverage = self.coverage > self.coverage_cutoff
+        if self.region_mask is not None:
+            self.high_coverage &= self.region_mask
 
         # Recalculate mean coverage without too high coverage regions
-        normal_coverage = self.coverage[~self.high_coverage]
-        self.mean_coverage = normal_coverage.sum() / len(normal_coverage)
+        normal_coverage = self.coverage[self.normal_coverage_mask()]
+        if len(normal_coverage):
+            self.mean_coverage = normal_coverage.sum() / len(normal_coverage)
 
         logger.info("Recalculated mean coverage (excluding too high coverage "
                     "regions: %.2f", self.mean_coverage)
 
     def call_alleles(self, min_pileup_qual, min_qual_frac):
-        quals = self.alleles[:, 1]
+        quals = self.allele_quals
         qual_sums = quals.sum(axis=-1)
-        qual_fraction = numpy.divide(quals, qual_sums[:, numpy.newaxis],
-                                     where=qual_sums[:, numpy.newaxis] > 0)
+
+        # Minimum quality sum for an allele to exceed `min_qual_frac` of all
+        # quality evidence at a position. Comparing against this avoids
+        # computing the fraction for each allele.
+        min_quals = (min_qual_frac * qual_sums)[:, numpy.newaxis]
 
         evidence = quals > 0
         # ALLELE_MASKS is an array with per allele its bit value.
         # By multiplying it with the above boolean array and summing the
         # result, we set each bit for each allele for which we have observed
-        # evidence.
-        self.weak = (evidence * ALLELE_MASKS[numpy.newaxis, :]).sum(axis=-1)
+        # evidence. All allele combinations fit in a single byte.
+        self.weak = (evidence * ALLELE_MASKS[numpy.newaxis, :]).sum(
+            axis=-1, dtype=numpy.uint8)
 
-        confirmed = ((quals > min_pileup_qual) &
-                     (qual_fraction > min_qual_frac))
-        self.strong = (confirmed * ALLELE_MASKS[numpy.newaxis, :]).sum(axis=-1)
+        confirmed = ((quals > min_pileup_qual) & (quals > min_quals))
+        self.strong = (confirmed * ALLELE_MASKS[numpy.newaxis, :]).sum(
+            axis=-1, dtype=numpy.uint8)
 
-        # Remove any calls in too high coverage regions
-        self.weak[self.high_coverage] = 0
-        self.strong[self.high_coverage] = 0
+        # Remove any calls in too high coverage regions, and outside the
+        # processed regions
+        uncalled = self.high_coverage
+        if self.region_mask is not None:
+            uncalled = uncalled | ~self.region_mask
+
+        self.weak[uncalled] = 0
+        self.strong[uncalled] = 0
 
     def find_gaps(self, min_size):
         """
@@ -872,33 +1371,73 @@ class ScaffoldCallData:
 
         # Determine regions where the majority of reads map with low mapping
         # quality, and thus are likely repetitive regions
-        depth = self.alleles[:, 0].sum(axis=-1)
+        depth = self._read_depths()
         self.lowmq = ((self.lowmq_count > 1) & (self.lowmq_count > depth))
+        if self.region_mask is not None:
+            self.lowmq &= self.region_mask
 
         # Covered is either: 1) we can make a weak call 2) we have low
-        # mapping quality reads there (potentially from repetitive regions)
+        # mapping quality reads there (potentially from repetitive regions).
+        # Positions outside the processed regions are never gaps.
         covered_array = ((self.weak > 0) | self.lowmq)
-
+        if self.region_mask is not None:
+            covered_array |= ~self.region_mask
+
+        # Gaps are runs of uncovered positions. Pad with covered positions
+        # on both sides, so each run starts where the derivative is -1 and
+        # ends where it's 1.
+        padded = numpy.concatenate(([True], covered_array, [True]))
+        edges = numpy.diff(padded.view(numpy.int8))
+        starts = numpy.flatnonzero(edges == -1)
+        ends = numpy.flatnonzero(edges == 1)
+
+        large_enough = (ends - starts) >= min_size
         self.gaps = [
-            group for group in utils.find_consecutive_groups(covered_array,
-                                                             min_size)
-            # group with all zeros is a region with no coverage
-            if not numpy.any(group.data)
+            utils.Group(covered_array[start:end], start, end, end - start)
+            for start, end in zip(starts[large_enough].tolist(),
+                                  ends[large_enough].tolist())
         ]
 
+    @property
+    def called_length(self):
+        """Number of positions within the processed regions."""
+
+        if self.region_mask is None:
+            return self.length
+
+        return int(numpy.count_nonzero(self.region_mask))
+
+    def in_regions(self, values):
+        """The elements of a per position array within the processed
+        regions."""
+
+        if self.region_mask is None:
+            return values
+
+        return values[self.region_mask]
+
+    def normal_coverage_mask(self):
+        """Positions within the processed regions without too high
+        coverage."""
+
+        if self.region_mask is None:
+            return ~self.high_coverage
+
+        return self.region_mask & ~self.high_coverage
+
     def depth(self, loc):
         """
         :return: Count of all good reads
         :rtype: int
         """
-        return self.alleles[loc, 0].sum()
+        return self.allele_counts[loc].sum()
 
     def qual_total(self, loc):
         """
         :return: Sum of all quality evidence
         :rtype: int
         """
-        return self.alleles[loc, 1].sum()
+        return self.allele_quals[loc].sum()
 
     def total_depth(self, loc):
         """
@@ -915,7 +1454,7 @@ class ScaffoldCallData:
         :return: sum of quality evidence for reference base (int)
         """
         ix = ALLELE_INDEX[self.refmask[loc]]
-        return self.alleles[loc, 1, ix]
+        return self.allele_quals[loc, ix]
 
     def ref_fraction(self, loc):
         """
@@ -924,16 +1463,36 @@ class ScaffoldCallData:
         return self.ref_qual(loc) / self.qual_total(loc)
 
     def allele_count(self, loc, allele):
-        return self.alleles[loc, 0, ALLELE_INDEX[allele]]
+        return self.allele_counts[loc, ALLELE_INDEX[allele]]
 
     def allele_qual(self, loc, allele):
-        return self.alleles[loc, 1, ALLELE_INDEX[allele]]
+        return self.allele_quals[loc, ALLELE_INDEX[allele]]
 
     def mean_mq(self, loc):
         d = self.depth(loc)
         return self.mq_sum[loc] / d if d else 0
 
 
+class PileupBatch:
+    """
+    Reads of consecutive pileup columns on a single scaffold, buffered so
+    the read filters can be applied to all of them at once. Per read, the
+    reference position, allele index (see `ALLELE_INDEX`), base and mapping
+    quality are stored, and whether the read was discarded during read QC.
+    """
+
+    def __init__(self, scaffold):
+        self.scaffold = scaffold
+        self.positions = array.array('q')
+        self.allele_indices = array.array('B')
+        self.base_qualities = array.array('B')
+        self.mapping_qualities = array.array('B')
+        self.discarded = array.array('B')
+
+    def __len__(self):
+        return len(self.positions)
+
+
 class VariantCaller:
     """
     This class collects read alignments and updates any call statistics per
@@ -941,16 +1500,26 @@ class VariantCaller:
     """
 
     def __init__(self, min_qual, min_pileup_qual, min_qual_frac,
-                 min_mapping_quality, min_gap_size, max_num_mismatches):
+                 min_mapping_quality, min_gap_size, max_num_mismatches,
+                 threads=1):
         self.min_qual = min_qual
         self.min_pileup_qual = min_pileup_qual
         self.min_qual_frac = min_qual_frac
         self.min_mapping_quality = min_mapping_quality
         self.min_gap_size = min_gap_size
         self.max_num_mismatches = max_num_mismatches
+        self.threads = threads
         self.discarded_reads = set()
 
-    def process(self, reference, bamfile):
+        # Reference ranges where reads may align that passed read QC, but
+        # whose name was discarded afterwards, see `_mark_late_discards`
+        self._late_discard_ranges = []
+
+        # Per scaffold, a boolean array marking the positions where reads of
+        # discarded pairs may align, see `_build_discard_masks`
+        self._discard_masks = {}
+
+    def process(self, reference, bamfile, regions=None):
         """
         Process the pileups from a BAM file and collect all statistics and
         data reequired for variant calling
@@ -958,11 +1527,19 @@ class VariantCaller:
         :type reference: Reference
         :param bamfile: BAM file to process
         :type bamfile: pysam.AlignmentFile
+        :param regions: Optional list of (scaffold, start, end) tuples. If
+            given, only pileup columns within these regions are processed.
+            Regions should not overlap. Coverage statistics, allele calls
+            and gaps are restricted to these regions. Read QC and abundance
+            estimation still use all reads.
+        :type regions: list
         :return:
         """
         scaffolds = dict(zip(reference.scaffolds.keys(), reference.lengths))
         call_data = VariantCallData(scaffolds, self.min_gap_size)
         call_data.load_reference(reference)
+        if regions is not None:
+            call_data.set_regions(regions)
 
         call_data.total_reads = bamfile.mapped + bamfile.unmapped
 
@@ -971,39 +1548,116 @@ class VariantCaller:
                            "abundance estimates may be incorrect.")
 
         logger.info("Performing read QC and estimating abundance...")
+
+        # Reference IDs of passing reads, counted per scaffold in bulk
+        # afterwards instead of updating the counters for each read.
+        passing_ids = array.array('i')
         for alignment in bamfile.fetch():
             # The names of discarded reads are remembered and used later
-            qc_result = self.read_qc(call_data, alignment)
+            if self.read_qc(call_data, alignment):
+                passing_ids.append(alignment.reference_id)
+
+        call_data.flush_read_ranges()
 
-            if qc_result:
-                scaffold = alignment.reference_name
-                call_data.passing_read(scaffold)
+        read_counts = numpy.bincount(
+            numpy.frombuffer(passing_ids, dtype=numpy.intc),
+            minlength=bamfile.nreferences
+        )
+        for scaffold, count in zip(bamfile.references, read_counts):
+            if count:
+                call_data.passing_read(scaffold, int(count))
 
         logger.info("%d read pairs discarded", len(self.discarded_reads))
         logger.info("%d passing reads", call_data.passing_reads)
         logger.info("%d low mapping quality reads", call_data.lowmq_reads)
 
-        logger.info("Processing pileups...")
-        for column in bamfile.pileup():
-            scaffold = column.reference_name
-            refpos = column.reference_pos
+        self._build_discard_masks(call_data)
 
-            for read in column.pileups:
-                self._assess_allele(call_data, scaffold, refpos, read)
+        logger.info("Processing pileups...")
+        if self.threads > 1:
+            self._process_pileups_parallel(call_data, bamfile, regions)
+        else:
+            self._process_pileups(call_data, bamfile, regions)
 
         logger.info("Done.")
         logger.info("Analyzing coverage...")
-        call_data.analyze_coverage()
+        call_data.analyze_coverage(self.threads)
 
         logger.info("Calling alleles...")
-        call_data.call_alleles(self.min_pileup_qual, self.min_qual_frac)
+        call_data.call_alleles(self.min_pileup_qual, self.min_qual_frac,
+                               self.threads)
 
         logger.info("Finding gaps...")
-        call_data.find_gaps()
+        call_data.find_gaps(self.threads)
         logger.info("Done.")
 
         return call_data
 
+    def _process_pileups(self, call_data, bamfile, regions=None):
+        """Update the pileup stats in `call_data` with all pileup columns,
+        or only those within the given regions."""
+
+        if regions is None:
+            columns = bamfile.pileup()
+        else:
+            columns = itertools.chain.from_iterable(
+                bamfile.pileup(scaffold, start, end, truncate=True)
+                for scaffold, start, end in regions
+            )
+
+        batch = None
+        for column in columns:
+            scaffold = column.reference_name
+            if (batch is None or batch.scaffold != scaffold or
+                    len(batch) >= PILEUP_BUFFER_SIZE):
+                if batch is not None:
+                    self._apply_batch(call_data, batch)
+
+                batch = PileupBatch(scaffold)
+
+            self._assess_column(call_data, batch, column)
+
+        if batch is not None:
+            self._apply_batch(call_data, batch)
+
+        call_data.flush_observations()
+
+    def _process_pileups_parallel(self, call_data, bamfile, regions=None):
+        """
+        Process the pileups of each scaffold in a separate worker process,
+        each with its own handle to the BAM file. Pileup processing is CPU
+        bound Python code, so threads wouldn't help here.
+
+        Workers send back the pileup arrays of the scaffolds they touched,
+        which are added to `call_data`. A worker can touch other scaffolds
+        than the one it processes through alternative alignments of
+        multi-mapped reads.
+        """
+
+        if regions is None:
+            regions = [(scaffold, 0, length) for scaffold, length in
+                       zip(bamfile.references, bamfile.lengths)]
+
+        # Largest scaffolds first, so a big one isn't started last
+        tasks = [list(group) for _, group in itertools.groupby(
+            sorted(regions), key=itemgetter(0))]
+        tasks.sort(key=lambda t: sum(end - start for _, start, end in t),
+                   reverse=True)
+
+        if not tasks:
+            return
+
+        scaffolds = {name: scaffold.length for name, scaffold in
+                     call_data.scaffolds_data.items()}
+
+        with multiprocessing.Pool(
+                min(self.threads, len(tasks)),
+                initializer=_init_pileup_worker,
+                initargs=(self, bamfile.filename, scaffolds)) as pool:
+            for result in pool.imap_unordered(_process_pileups_worker, tasks):
+                for name, arrays in result.items():
+                    call_data.scaffolds_data[name].add_pileup_arrays(arrays)
+
     def read_qc(self, call_data, alignment):
         """
         Perform quality control on reads.
@@ -1021,31 +1675,39 @@ class VariantCaller:
         of discarded reads per position in the genome.
         """
 
-        if alignment.query_name in self.discarded_reads:
+        query_name = alignment.query_name
+        if query_name in self.discarded_reads:
             # It's mate was discarded, discard this read too
             call_data.discard_read(alignment)
             return False
 
-        # if this is a paired read, make sure the pairs are properly aligned
-        if alignment.is_paired and not alignment.is_proper_pair:
-            self.discarded_reads.add(alignment.query_name)
+        flag = alignment.flag
+        paired = flag & BAM_FPAIRED
+        query_length = alignment.query_length
+
+        discard = (
+            # if this is a paired read, make sure the pairs are properly
+            # aligned
+            (paired and not flag & BAM_FPROPER_PAIR)
+            # restrict ourselves to full-length alignments (not clipped)
+            or alignment.query_alignment_length != query_length
+            # check that inferred insert size is at least read length
+            or (paired and abs(alignment.template_length) < query_length)
+        )
+
+        if discard:
+            self.discarded_reads.add(query_name)
             call_data.discard_read(alignment)
+            self._mark_late_discards(alignment, flag)
             return False
 
-        # restrict ourselves to full-length alignments (not clipped)
-        if alignment.query_alignment_length != alignment.query_length:
-            # alignment is clipped
-            self.discarded_reads.add(alignment.query_name)
-            call_data.discard_read(alignment)
-            return False
-
-        # check that inferred insert size is at least read length
-        if alignment.is_paired:
-            tlen = alignment.template_length
-            if abs(tlen) < alignment.query_length:
-                self.discarded_reads.add(alignment.query_name)
-                call_data.discard_read(alignment)
-                return False
+        if flag & BAM_FSUPPLEMENTARY and alignment.reference_end is not None:
+            # Supplementary alignments aren't referred to by the mate, so
+            # always check them for discarded names in the pileups
+            self._late_discard_ranges.append((
+                alignment.reference_name, alignment.reference_start,
+                alignment.reference_end
+            ))
 
         if alignment.mapping_quality < self.min_mapping_quality:
             # We're not adding this read to `discarded_reads` because its mate
@@ -1054,94 +1716,234 @@ class VariantCaller:
             return False
 
         if self.max_num_mismatches > 0:
-            num_mismatches = 0
-            if alignment.has_tag('NM'):
+            try:
                 num_mismatches = alignment.get_tag('NM')
+            except KeyError:
+                num_mismatches = 0
 
             if num_mismatches > self.max_num_mismatches:
-                self.discarded_reads.add(alignment.query_name)
+                self.discarded_reads.add(query_name)
                 call_data.discard_read(alignment)
+                self._mark_late_discards(alignment, flag)
                 return False
 
         return True
 
-    def _assess_allele(self, call_data, scaffold, refpos, read):
-        alignment = read.alignment
+    def _mark_late_discards(self, alignment, flag):
+        """
+        Remember where other alignments of a newly discarded read's pair may
+        be located, which possibly passed read QC before the read's name was
+        discarded: the mate, and the other parts of a chimeric alignment
+        listed in the SA tag. Supplementary alignments of the mate are
+        handled in `read_qc`.
+
+        The mate's aligned length is obtained from the MC tag if available.
+        Otherwise, both mates lie within the template length from the
+        leftmost mate. If neither is known, the rest of the scaffold is
+        marked.
+        """
 
-        if alignment.query_name in self.discarded_reads:
-            # Ignore reads removed in earlier QC step
+        ranges = self._late_discard_ranges
+
+        if flag & BAM_FPAIRED and not flag & BAM_FMUNMAP:
+            mate_scaffold = alignment.next_reference_name
+            mate_start = alignment.next_reference_start
+            try:
+                mate_end = mate_start + cigar_reference_length(
+                    alignment.get_tag("MC"))
+            except KeyError:
+                tlen = alignment.template_length
+                if tlen and mate_scaffold == alignment.reference_name:
+                    mate_start = min(mate_start, alignment.reference_start)
+                    mate_end = mate_start + abs(tlen)
+                else:
+                    mate_end = None
+
+            ranges.append((mate_scaffold, mate_start, mate_end))
+
+        try:
+            sa = alignment.get_tag("SA")
+        except KeyError:
             return
 
-        # get base quality (note this is next base if deletion, but we won't
-        # use that)
-        pos = read.query_position_or_next
-        qual = alignment.query_qualities[pos]
-        if qual < self.min_qual:
-            call_data.bad_read(scaffold, refpos)
+        for aln in sa.split(';'):
+            if not aln:
+                continue
+
+            scaffold, pos, _, cigar, *_ = aln.split(',')
+            start = int(pos) - 1
+            ranges.append((scaffold, start,
+                           start + cigar_reference_length(cigar)))
+
+    def _build_discard_masks(self, call_data):
+        """
+        Mark the positions where reads of discarded pairs may align. Pileup
+        columns elsewhere don't need to be checked for discarded reads.
+
+        This runs after read QC and before processing any pileups, so the
+        `bad` counter contains only the discarded reads at that point.
+        """
+
+        self._discard_masks = {}
+        if not self.discarded_reads:
             return
 
-        # insertions and deletions are treated like alleles
-        if read.is_del:
-            base = Allele.DEL
-        elif read.indel > 0:
-            # then it must be an insertion
-            base = Allele.INS
+        for name, scaffold in call_data.scaffolds_data.items():
+            self._discard_masks[name] = scaffold.bad > 0
+
+        for scaffold, start, end in self._late_discard_ranges:
+            if scaffold in self._discard_masks:
+                self._discard_masks[scaffold][start:end] = True
+
+        self._late_discard_ranges = []
+
+    def _assess_column(self, call_data, batch, column):
+        """
+        Add all reads aligned to a pileup column to the batch.
+
+        The query names, bases and qualities are obtained for the whole
+        column at once using pysam's column accessors, and added to the
+        batch as is. Reads are only checked one by one for alternative
+        alignments of multi-mapped reads, the other filters are applied to
+        the whole batch in `_apply_batch`.
+        """
+
+        refpos = column.reference_pos
+        sequences = column.get_query_sequences(add_indels=True)
+        quals = column.get_query_qualities()
+        mqs = column.get_mapping_qualities()
+        if not sequences:
+            return
+
+        # Most entries are a single base, which can be looked up as is.
+        # Entries followed by an indel need to be parsed.
+        indices = list(map(PILEUP_ALLELE_INDEX.get, sequences,
+                           itertools.repeat(None)))
+        if None in indices:
+            indices = [parse_pileup_entry(seq) if ix is None else ix
+                       for seq, ix in zip(sequences, indices)]
+
+        # Query names are only needed to check for discarded reads, so
+        # don't retrieve them at all if no discarded read aligns here
+        discarded = self.discarded_reads
+        discard_mask = self._discard_masks.get(batch.scaffold)
+        if discard_mask is not None and discard_mask[refpos]:
+            is_discarded = list(map(discarded.__contains__,
+                                    column.get_query_names()))
+            batch.discarded.extend(is_discarded)
         else:
-            # base call must be real base (e.g., not N)
-            base = Allele.from_str(alignment.query_sequence[pos])
-            if not base:
-                call_data.bad_allele(scaffold, refpos)
-                return
+            is_discarded = None
+            batch.discarded.frombytes(bytes(len(sequences)))
+
+        batch.positions.extend([refpos] * len(sequences))
+        batch.allele_indices.extend(indices)
+        batch.base_qualities.extend(quals)
+        batch.mapping_qualities.extend(mqs)
+
+        if self.min_mapping_quality == 0 and min(mqs) <= 3:
+            # The min_mapping_quality filter is disabled, and some reads
+            # likely align at multiple places. Make sure the allele in those
+            # reads is counted at every alignment location.
+            pileups = column.pileups
+            min_qual = self.min_qual
+            for i, (mq, qual) in enumerate(zip(mqs, quals)):
+                # Cheapest and most selective checks first
+                if (mq > 3 or qual < min_qual or
+                        indices[i] == INVALID_ALLELE_INDEX or
+                        (is_discarded and is_discarded[i])):
+                    continue
 
-        mq = alignment.mapping_quality
+                base = INDEX_ALLELES[indices[i]]
+                for alt_scaffold, pos, rc in self._alternative_aln_pos(
+                        pileups[i].alignment, refpos):
+                    call_data.good_read(alt_scaffold, pos, base, qual, mq,
+                                        rc)
 
-        if mq < self.min_mapping_quality:
+    def _apply_batch(self, call_data, batch):
+        """
+        Apply the read filters to all reads in a batch at once, and update
+        the pileup stats of the batch's scaffold.
+
+        Reads removed in the earlier QC step are ignored. Bases with low
+        quality or which aren't a real base (e.g., N) are counted as bad.
+        The remaining reads are counted as good if their mapping quality is
+        high enough. Note that for deletions, the base quality is of the next
+        base, but we won't use that.
+        """
+
+        if not batch:
             return
 
-        # We're good! Update the pileup stats...
-        call_data.good_read(scaffold, refpos, base, qual, mq, False)
+        scaffold = call_data.scaffolds_data[batch.scaffold]
+
+        positions = numpy.frombuffer(batch.positions, dtype=numpy.int64)
+        indices = numpy.frombuffer(batch.allele_indices, dtype=numpy.uint8)
+        quals = numpy.frombuffer(batch.base_qualities, dtype=numpy.uint8)
+        mqs = numpy.frombuffer(batch.mapping_qualities, dtype=numpy.uint8)
+        keep = numpy.frombuffer(batch.discarded, dtype=numpy.uint8) == 0
 
-        if mq <= 3 and self.min_mapping_quality == 0:
-            # If we reach here the min_mapping_quality filter is disabed, and
-            # it means that this read likely aligns at multiple places. Make
-            # sure the allele in this read is counted at every alignment
-            # location.
-            for scaffold, pos, rc in self._alternative_aln_pos(alignment,
-                                                               refpos):
-                call_data.good_read(scaffold, pos, base, qual, mq, rc)
+        bad = keep & ((quals < self.min_qual) |
+                      (indices == INVALID_ALLELE_INDEX))
+        numpy.add.at(scaffold.bad, positions[bad], 1)
+
+        good = keep & ~bad & (mqs >= self.min_mapping_quality)
+        scaffold.add_observation_arrays(positions[good], indices[good],
+                                        quals[good], mqs[good])
 
     def _alternative_aln_pos(self, read, loc):
         """Translate a location of the read's primary alignment to a scaffold
-        position of an alternative alignment."""
+        position of an alternative alignment. Only called for reads with
+        mapping quality <= 3, other reads don't need their XA tag checked."""
 
-        if read.has_tag("XA"):
+        try:
             xa = read.get_tag("XA")
-            nm = int(read.get_tag("NM"))
-            read_rc = read.is_reverse
-            offset = (read.reference_end - loc - 1 if read_rc else
-                      loc - read.reference_start)
-            # logger.info(xa + ' ' + str(nm))
-            for aln in xa.split(';'):
-                if not aln:
-                    continue
+        except KeyError:
+            return
 
-                scaffold, pos, cigar, alt_nm = aln.split(',')
+        nm = int(read.get_tag("NM"))
+        read_rc = bool(read.flag & BAM_FREVERSE)
+        offset = (read.reference_end - loc - 1 if read_rc else
+                  loc - read.reference_start)
 
-                if ('S' in cigar or 'H' in cigar or 'D' in cigar or
-                        'I' in cigar):
-                    # Clipped alignment, ignore. Also ignore alt alignments
-                    # with indels to keep things in sync.
-                    logger.debug("Ignoring clipped alternative alignment")
-                    continue
+        # Coordinates on alternative alignments on the forward and reverse
+        # strand are pos + fwd_offset and pos + rc_offset respectively
+        fwd_offset = offset
+        rc_offset = read.query_length - offset - 1
+        for scaffold, pos, rc in ungapped_xa_alignments(xa, nm):
+            yield (scaffold, pos + (rc_offset if rc else fwd_offset),
+                   rc != read_rc)
+
+
+# State of a pileup worker process, see `_init_pileup_worker`
+_pileup_worker_state = None
+
+
+def _init_pileup_worker(caller, bam_path, scaffolds):
+    global _pileup_worker_state
+
+    _pileup_worker_state = (caller, pysam.AlignmentFile(bam_path),
+                            VariantCallData(scaffolds, caller.min_gap_size))
+
+
+def _process_pileups_worker(regions):
+    """
+    Process the pileups in the given regions of a single scaffold. Returns
+    the pileup arrays of each scaffold that was touched, which are then reset
+    in this worker's call data for the next task.
+    """
+
+    caller, bamfile, call_data = _pileup_worker_state
+    caller._process_pileups(call_data, bamfile, regions)
 
-                alt_nm = int(alt_nm)
-                if alt_nm <= nm:
-                    pos = int(pos)
-                    rc = pos < 0
+    touched = {scaffold for scaffold, _, _ in regions}
+    touched.update(name for name, scaffold in call_data.scaffolds_data.items()
+                   if scaffold.num_observations)
 
-                    # Turn into a 0-based coordinate system
-                    pos = abs(pos) - 1
-                    coord = (pos + read.query_length - offset - 1 if rc
-                             else pos + offset)
+    result = {}
+    for name in touched:
+        scaffold = call_data.scaffolds_data[name]
+        result[name] = scaffold.pileup_arrays()
+        call_data.scaffolds_data[name] = ScaffoldCallData(name,
+                                                          scaffold.length)
 
-                    yield scaffold, coord, rc != read_rc
+    return result
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+#  Copyright (c) 2016-2019, Broad Institute, Inc. All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+#  * Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+#  * Neither the name Broad Institute, Inc. nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#  AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#  SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+#  CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#  OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+#  OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+Check that variant calls with `straingr call --regions-bed` match the calls
+of a run over the whole BAM file, within the given regions.
+
+Usage: regions_check.py reference.fa sample.bam regions.bed
+"""
+
+import sys
+
+import numpy
+import pysam
+
+from strainge.io.variants import read_bed_regions
+from strainge.variant_caller import Reference, VariantCaller
+
+
+def call(reference, bam, regions=None):
+    caller = VariantCaller(5, 50, 0.1, 5, 2000, 0)
+    return caller.process(reference, pysam.AlignmentFile(bam), regions)
+
+
+def main():
+    reference = Reference(sys.argv[1])
+    regions = read_bed_regions(sys.argv[3])
+
+    full = call(reference, sys.argv[2])
+    subset = call(reference, sys.argv[2], regions)
+
+    ok = True
+    for name, start, end in regions:
+        for attr in ("strong", "weak"):
+            expected = getattr(full.scaffolds_data[name], attr)[start:end]
+            actual = getattr(subset.scaffolds_data[name], attr)[start:end]
+            num_diff = numpy.count_nonzero(expected != actual)
+
+            print(f"{name}:{start}-{end} {attr}: "
+                  f"{numpy.count_nonzero(expected)} calls in full run, "
+                  f"{numpy.count_nonzero(actual)} with regions, "
+                  f"{num_diff} differ")
+            ok = ok and num_diff == 0
+
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())